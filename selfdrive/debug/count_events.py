@@ -5,7 +5,7 @@ from pprint import pprint
 from tqdm import tqdm
 
 from tools.lib.route import Route
-from tools.lib.logreader import LogReader
+from tools.lib.parallel_logreader import ParallelLogReader
 
 if __name__ == "__main__":
   r = Route(sys.argv[1])
@@ -13,16 +13,12 @@ if __name__ == "__main__":
   cnt_valid: Counter = Counter()
   cnt_events: Counter = Counter()
 
-  for q in tqdm(r.qlog_paths()):
-    if q is None:
-      continue
-    lr = list(LogReader(q))
-    for msg in lr:
-      if msg.which() == 'carEvents':
-        for e in msg.carEvents:
-          cnt_events[e.name] += 1
-      if not msg.valid:
-        cnt_valid[msg.which()] += 1
+  for msg in tqdm(ParallelLogReader(r.qlog_paths())):
+    if msg.which() == 'carEvents':
+      for e in msg.carEvents:
+        cnt_events[e.name] += 1
+    if not msg.valid:
+      cnt_valid[msg.which()] += 1
 
   print("Events")
   pprint(cnt_events)
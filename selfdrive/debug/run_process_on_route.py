@@ -4,7 +4,7 @@ import argparse
 
 from selfdrive.test.process_replay.compare_logs import save_log
 from selfdrive.test.process_replay.process_replay import CONFIGS, replay_process
-from tools.lib.logreader import MultiLogIterator
+from tools.lib.parallel_logreader import ParallelLogReader
 from tools.lib.route import Route
 
 if __name__ == "__main__":
@@ -17,7 +17,7 @@ if __name__ == "__main__":
   cfg = [c for c in CONFIGS if c.proc_name == args.process][0]
 
   route = Route(args.route)
-  lr = MultiLogIterator(route.log_paths())
+  lr = ParallelLogReader(route.log_paths())
   inputs = list(lr)
 
   outputs = replay_process(cfg, inputs)
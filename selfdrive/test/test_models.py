@@ -61,7 +61,7 @@ class TestCarModel(unittest.TestCase):
 
     for seg in [2, 1, 0]:
       try:
-        lr = LogReader(get_url(cls.route, seg))
+        lr = LogReader(get_url(cls.route, seg), services=["can", "carParams"])
       except Exception:
         continue
 
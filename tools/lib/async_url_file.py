@@ -0,0 +1,226 @@
+import asyncio
+import weakref
+import pycurl
+from io import BytesIO
+from tenacity import retry, wait_random_exponential, stop_after_attempt
+from tools.lib.url_file import CHUNK_SIZE, DOWNLOAD_WORKERS, READAHEAD_CHUNKS, BaseURLFile, check_response, \
+                               maybe_prune_cache
+
+
+class CurlMulti:
+  """Runs curl transfers on an asyncio event loop.
+
+     All transfers of a loop share one CurlMulti, and so one connection pool
+     capped at DOWNLOAD_WORKERS connections.
+  """
+  _instances: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, CurlMulti]" = weakref.WeakKeyDictionary()
+
+  def __init__(self, loop):
+    self._loop = loop
+    self._multi = pycurl.CurlMulti()
+    self._multi.setopt(pycurl.M_SOCKETFUNCTION, self._on_socket)
+    self._multi.setopt(pycurl.M_TIMERFUNCTION, self._on_timer)
+    self._multi.setopt(pycurl.M_MAX_TOTAL_CONNECTIONS, DOWNLOAD_WORKERS)
+    self._timer = None
+    self._futures = {}
+    self._free = []
+
+  @classmethod
+  def get(cls):
+    loop = asyncio.get_event_loop()
+    if loop not in cls._instances:
+      cls._instances[loop] = cls(loop)
+    return cls._instances[loop]
+
+  def _on_socket(self, event, fd, multi, data):
+    if event in (pycurl.POLL_IN, pycurl.POLL_INOUT):
+      self._loop.add_reader(fd, self._on_action, fd, pycurl.CSELECT_IN)
+    else:
+      self._loop.remove_reader(fd)
+    if event in (pycurl.POLL_OUT, pycurl.POLL_INOUT):
+      self._loop.add_writer(fd, self._on_action, fd, pycurl.CSELECT_OUT)
+    else:
+      self._loop.remove_writer(fd)
+
+  def _on_timer(self, timeout_ms):
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+    if timeout_ms >= 0:
+      self._timer = self._loop.call_later(timeout_ms / 1000, self._on_action, pycurl.SOCKET_TIMEOUT, 0)
+
+  def _on_action(self, fd, event):
+    while True:
+      ret, _ = self._multi.socket_action(fd, event)
+      if ret != pycurl.E_CALL_MULTI_PERFORM:
+        break
+
+    while True:
+      queued, ok, failed = self._multi.info_read()
+      for c in ok:
+        self._finish(c, None)
+      for c, errno, msg in failed:
+        self._finish(c, pycurl.error(errno, msg))
+      if queued == 0:
+        break
+
+  def _finish(self, c, error):
+    self._multi.remove_handle(c)
+    future = self._futures.pop(c)
+    if not future.done():
+      if error is None:
+        future.set_result(c.getinfo(pycurl.RESPONSE_CODE))
+      else:
+        future.set_exception(error)
+
+  async def perform(self, url, headers=None, nobody=False, debug=False):
+    """Returns the response code and body, or content length when nobody is set."""
+    c = self._free.pop() if len(self._free) else pycurl.Curl()
+    dats = BytesIO()
+    c.setopt(pycurl.URL, url)
+    c.setopt(pycurl.NOSIGNAL, 1)
+    c.setopt(pycurl.TIMEOUT_MS, 500000)
+    c.setopt(pycurl.FOLLOWLOCATION, True)
+    c.setopt(pycurl.WRITEDATA, dats)
+    if headers is not None:
+      c.setopt(pycurl.HTTPHEADER, headers)
+    if nobody:
+      c.setopt(pycurl.NOBODY, 1)
+    if debug:
+      print("downloading", url)
+
+    future = self._loop.create_future()
+    self._futures[c] = future
+    self._multi.add_handle(c)
+    try:
+      response_code = await future
+      result = int(c.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD)) if nobody else dats.getvalue()
+    finally:
+      if c in self._futures:  # cancelled
+        del self._futures[c]
+        self._multi.remove_handle(c)
+      c.reset()
+      self._free.append(c)
+    return response_code, result
+
+
+class AsyncURLFile(BaseURLFile):
+  """asyncio version of URLFile, sharing its download cache."""
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, traceback):
+    for task in self._readahead.values():
+      task.cancel()
+    for chunk, task in self._readahead.items():
+      await self._wait_readahead(chunk, task)
+    self._readahead = {}
+    self._close_store()
+
+  @retry(wait=wait_random_exponential(multiplier=1, max=5), stop=stop_after_attempt(3), reraise=True)
+  async def get_length_online(self):
+    _, length = await CurlMulti.get().perform(self._url, nobody=True, debug=self._debug)
+    return length
+
+  async def get_length(self):
+    length = self._cached_length()
+    if length is not None:
+      return length
+    return self._set_length(await self.get_length_online())
+
+  @retry(wait=wait_random_exponential(multiplier=1, max=5), stop=stop_after_attempt(3), reraise=True)
+  async def _download_range(self, start, end):
+    if start >= end:
+      return b""
+    headers = ["Connection: keep-alive", f"Range: bytes={start}-{end - 1}"]
+    response_code, data = await CurlMulti.get().perform(self._url, headers, debug=self._debug)
+    check_response(response_code, headers, self._url, data, download_range=True)
+    return data
+
+  async def _gather_limited(self, coros):
+    #  Like asyncio.gather, but with at most self._parallel running at once
+    sem = asyncio.Semaphore(self._parallel)
+
+    async def run(coro):
+      async with sem:
+        return await coro
+    return await asyncio.gather(*[run(c) for c in coros])
+
+  @staticmethod
+  async def _in_executor(fn, *args):
+    #  Chunk reads and writes checksum every chunk, evicting walks the whole cache
+    #  directory, none of that is done on the loop
+    return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+  async def _chunk_store(self):
+    return self._open_store(await self.get_length())
+
+  async def _download_chunk(self, chunk):
+    length = await self.get_length()
+    data = await self._download_range(chunk * CHUNK_SIZE, min((chunk + 1) * CHUNK_SIZE, length))
+    await self._in_executor((await self._chunk_store()).write, chunk, data)
+    await self._in_executor(maybe_prune_cache)
+    return data
+
+  async def _readahead_chunk(self, chunk):
+    #  The data goes to the cache, the task doesn't keep it around
+    await self._download_chunk(chunk)
+
+  async def _wait_readahead(self, chunk, task):
+    try:
+      await task
+      return True
+    except asyncio.CancelledError:
+      return False
+    except Exception as e:
+      self._readahead_failed(chunk, e)
+      return False
+
+  async def _read_chunks(self, first_chunk, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    store = await self._chunk_store()
+    missing = await self._in_executor(store.read_into, buf, first_chunk)
+
+    async def get(chunk):
+      start = (chunk - first_chunk) * CHUNK_SIZE
+      task = self._readahead.pop(chunk, None)
+      if task is not None and await self._wait_readahead(chunk, task):
+        if len(await self._in_executor(store.read_into, view[start:start + CHUNK_SIZE], chunk)) == 0:
+          return
+      data = await self._download_chunk(chunk)
+      buf[start:start + len(data)] = data
+
+    await self._gather_limited([get(c) for c in missing])
+    return buf
+
+  async def _schedule_readahead(self, end):
+    #  Finished downloads are in the cache, only failures are worth reporting
+    for chunk, task in list(self._readahead.items()):
+      if task.done():
+        del self._readahead[chunk]
+        await self._wait_readahead(chunk, task)
+
+    for chunk in self._readahead_chunks(end):
+      self._readahead[chunk] = asyncio.ensure_future(self._readahead_chunk(chunk))
+
+  async def read(self, ll=None):
+    length = await self.get_length()
+    file_begin, file_end = self._read_range(ll, length)
+    if file_begin >= file_end:
+      return b""
+
+    if self._force_download:
+      ranges = self._chunk_ranges(file_begin, file_end)
+      response = b"".join(await self._gather_limited([self._download_range(*r) for r in ranges]))
+      self._pos = file_end
+      return response
+
+    first_chunk, aligned_begin, aligned_end = self._aligned(file_begin, file_end, length)
+    buf = await self._read_chunks(first_chunk, aligned_end - aligned_begin)
+    response, sequential = self._finish_read(buf, file_begin, file_end, aligned_begin)
+
+    #  Sequential reads download the next chunks in the background
+    if READAHEAD_CHUNKS > 0 and sequential:
+      await self._schedule_readahead(file_end)
+    return response
@@ -1,11 +1,45 @@
 import os
+import asyncio
 from tools.lib.url_file import URLFile
+from tools.lib.async_url_file import AsyncURLFile
 
 DATA_ENDPOINT = os.getenv("DATA_ENDPOINT", "http://data-raw.internal/")
 
-def FileReader(fn, debug=False):
+def resolve_name(fn):
   if fn.startswith("cd:/"):
-    fn = fn.replace("cd:/", DATA_ENDPOINT)
+    return fn.replace("cd:/", DATA_ENDPOINT)
+  return fn
+
+def FileReader(fn, debug=False):
+  fn = resolve_name(fn)
   if fn.startswith("http://") or fn.startswith("https://"):
     return URLFile(fn, debug=debug)
   return open(fn, "rb")
+
+
+class AsyncLocalFile:
+  """Local file with the AsyncURLFile interface, reads run in the default executor."""
+  def __init__(self, fn):
+    self._f = open(fn, "rb")
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, traceback):
+    self._f.close()
+
+  async def get_length(self):
+    return os.fstat(self._f.fileno()).st_size
+
+  async def read(self, ll=None):
+    return await asyncio.get_event_loop().run_in_executor(None, self._f.read, ll)
+
+  def seek(self, pos):
+    self._f.seek(pos)
+
+
+def async_file_reader(fn, debug=False):
+  fn = resolve_name(fn)
+  if fn.startswith("http://") or fn.startswith("https://"):
+    return AsyncURLFile(fn, debug=debug)
+  return AsyncLocalFile(fn)
@@ -0,0 +1,240 @@
+import os
+import sys
+import fcntl
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from hashlib import sha256
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+#  Bytes of decoded frames each FrameReader keeps around
+FRAME_CACHE_SIZE = int(os.getenv("FRAME_CACHE_SIZE", str(256 * 1024 * 1024)))
+
+ARENA_MAGIC = b"FCACHE02"
+#  magic, slots, frame bytes, tick, refs, ndim, shape
+ARENA_HEADER = struct.Struct("<8sQQQQQ4Q")
+TICK_OFFSET = 24
+REFS_OFFSET = 32
+EMPTY = -1
+
+
+def open_shared_memory(name, create=False, size=0):
+  #  The last process to close an arena unlinks it, so no process may have it
+  #  unlinked by the resource tracker when it exits
+  try:
+    return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+  except TypeError:
+    #  python < 3.13 always tracks
+    shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def unlink_shared_memory(shm):
+  if sys.version_info < (3, 13):
+    #  unlink() unregisters it, which the tracker expects to know about
+    resource_tracker.register(shm._name, "shared_memory")
+  shm.unlink()
+
+
+class FrameCache:
+  """LRU cache of decoded frames, bounded by the bytes they take up."""
+  def __init__(self, max_bytes=None):
+    self.max_bytes = FRAME_CACHE_SIZE if max_bytes is None else max_bytes
+    self.size = 0
+    self.frames = OrderedDict()
+    self.lock = threading.Lock()
+
+  def __contains__(self, key):
+    return key in self.frames
+
+  def get(self, key):
+    with self.lock:
+      frame = self.frames.get(key)
+      if frame is not None:
+        self.frames.move_to_end(key)
+      return frame
+
+  def put(self, key, frame):
+    with self.lock:
+      old = self.frames.pop(key, None)
+      if old is not None:
+        self.size -= old.nbytes
+      self.frames[key] = frame
+      self.size += frame.nbytes
+      while self.size > self.max_bytes and len(self.frames) > 1:
+        _, evicted = self.frames.popitem(last=False)
+        self.size -= evicted.nbytes
+
+  def close(self):
+    with self.lock:
+      self.frames.clear()
+      self.size = 0
+
+
+class SharedFrameArena:
+  """Fixed number of frame slots in shared memory, LRU by a shared tick counter.
+
+     Every access takes an flock, so processes never see a half written frame.
+     Frames are copied out, a slot can be reused as soon as the lock is released.
+
+     The header counts the processes that have the arena open. The last one to
+     close it unlinks it and removes the lock file, while still holding the lock.
+  """
+  def __init__(self, name, frame_shape=None, max_bytes=FRAME_CACHE_SIZE):
+    self.name = name
+    self.lock = threading.Lock()
+    self.lock_path = os.path.join(tempfile.gettempdir(), name + ".lock")
+    #  Without a frame_shape the arena is only attached to, if it doesn't exist
+    #  there's no lock file to leave behind either
+    self.shm = open_shared_memory(name) if frame_shape is None else None
+    self.lock_file = self._open_lock_file()
+    try:
+      self._open(frame_shape, max_bytes)
+    except BaseException:
+      self.lock_file.close()
+      raise
+    fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+  def _open_lock_file(self):
+    #  Returns the lock file, locked. One opened before the last process closed
+    #  the arena and removed it is stale, so it's checked once the lock is held
+    while True:
+      lock_file = open(self.lock_path, "a")
+      fcntl.flock(lock_file, fcntl.LOCK_EX)
+      try:
+        if os.stat(self.lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+          return lock_file
+      except FileNotFoundError:
+        pass
+      lock_file.close()
+
+  def _refs(self):
+    return struct.unpack_from("<Q", self.shm.buf, REFS_OFFSET)[0]
+
+  def _open(self, frame_shape, max_bytes):
+    #  Called with the lock file locked
+    if self.shm is not None and self._refs() == 0:
+      #  Closed by the last process after it was attached to
+      self.shm.close()
+      self.shm = None
+    try:
+      if self.shm is None:
+        self.shm = open_shared_memory(self.name)
+    except FileNotFoundError:
+      if frame_shape is None:
+        os.remove(self.lock_path)
+        raise
+      frame_bytes = int(np.prod(frame_shape))
+      slots = max(1, max_bytes // frame_bytes)
+      table_bytes = ARENA_HEADER.size + 16 * slots
+      self.shm = open_shared_memory(self.name, create=True, size=table_bytes + slots * frame_bytes)
+      shape = tuple(frame_shape) + (0,) * (4 - len(frame_shape))
+      ARENA_HEADER.pack_into(self.shm.buf, 0, ARENA_MAGIC, slots, frame_bytes, 0, 0, len(frame_shape), *shape)
+      np.ndarray((slots, 2), dtype=np.int64, buffer=self.shm.buf, offset=ARENA_HEADER.size)[:] = EMPTY
+
+    magic, self.slots, frame_bytes, _, refs, ndim, *shape = ARENA_HEADER.unpack_from(self.shm.buf, 0)
+    assert magic == ARENA_MAGIC, f"{self.name} is not a frame cache"
+    struct.pack_into("<Q", self.shm.buf, REFS_OFFSET, refs + 1)
+    self.frame_shape = tuple(shape[:ndim])
+    self.table = np.ndarray((self.slots, 2), dtype=np.int64, buffer=self.shm.buf, offset=ARENA_HEADER.size)
+    self.data = np.ndarray((self.slots,) + self.frame_shape, dtype=np.uint8, buffer=self.shm.buf,
+                           offset=ARENA_HEADER.size + 16 * self.slots)
+
+  @contextmanager
+  def _locked(self):
+    #  flock excludes other processes, the lock other threads sharing the fd
+    with self.lock:
+      fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+  def _tick(self):
+    tick = struct.unpack_from("<Q", self.shm.buf, TICK_OFFSET)[0] + 1
+    struct.pack_into("<Q", self.shm.buf, TICK_OFFSET, tick)
+    return tick
+
+  def __contains__(self, num):
+    with self._locked():
+      return bool(np.any(self.table[:, 0] == num))
+
+  def get(self, num):
+    with self._locked():
+      slot = np.flatnonzero(self.table[:, 0] == num)
+      if len(slot) == 0:
+        return None
+      self.table[slot[0], 1] = self._tick()
+      return self.data[slot[0]].copy()
+
+  def put(self, num, frame):
+    with self._locked():
+      slot = np.flatnonzero(self.table[:, 0] == num)
+      slot = slot[0] if len(slot) else np.argmin(self.table[:, 1])
+      self.table[slot] = (EMPTY, 0)
+      self.data[slot] = frame
+      self.table[slot] = (num, self._tick())
+
+  def close(self):
+    with self._locked():
+      refs = self._refs() - 1
+      struct.pack_into("<Q", self.shm.buf, REFS_OFFSET, refs)
+      del self.table, self.data
+      self.shm.close()
+      if refs == 0:
+        unlink_shared_memory(self.shm)
+        os.remove(self.lock_path)
+    self.lock_file.close()
+
+
+class SharedFrameCache:
+  """Frame cache in shared memory, shared by every process that uses the same name.
+
+     There is one arena of max_bytes per output format. An arena is removed once
+     every process that opened it has closed it.
+  """
+  def __init__(self, name, max_bytes=None):
+    self.name = name
+    self.max_bytes = FRAME_CACHE_SIZE if max_bytes is None else max_bytes
+    self.arenas = {}
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def name_for_file(fn):
+    return "fc_" + sha256(fn.encode()).hexdigest()[:20]
+
+  def _arena(self, fmt, frame_shape=None):
+    with self.lock:
+      arena = self.arenas.get(fmt)
+      if arena is None:
+        try:
+          arena = SharedFrameArena(f"{self.name}_{fmt}", frame_shape, self.max_bytes)
+        except FileNotFoundError:
+          return None
+        self.arenas[fmt] = arena
+      return arena
+
+  def __contains__(self, key):
+    num, fmt = key
+    arena = self._arena(fmt)
+    return arena is not None and num in arena
+
+  def get(self, key):
+    num, fmt = key
+    arena = self._arena(fmt)
+    return arena.get(num) if arena is not None else None
+
+  def put(self, key, frame):
+    num, fmt = key
+    self._arena(fmt, frame.shape).put(num, frame)
+
+  def close(self):
+    with self.lock:
+      for arena in self.arenas.values():
+        arena.close()
+      self.arenas = {}
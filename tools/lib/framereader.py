@@ -1,28 +1,40 @@
 # pylint: skip-file
-import json
+import mmap
 import os
-import pickle
+import select
 import struct
 import subprocess
 import tempfile
 import threading
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
 from enum import IntEnum
 from functools import wraps
 
 import numpy as np
-from lru import LRU
 
 import _io
 from tools.lib.cache import cache_path_for_file_path
 from tools.lib.exceptions import DataUnreadableError
+from tools.lib.frame_cache import FrameCache, SharedFrameCache
+from tools.lib.hevc_index import hevc_index, hevc_index_many
 from common.file_helpers import atomic_write_in_dir
 
-from tools.lib.filereader import FileReader
+from tools.lib.filereader import FileReader, resolve_name
 
 HEVC_SLICE_B = 0
 HEVC_SLICE_P = 1
 HEVC_SLICE_I = 2
 
+HEVC_NAL_VPS = 32
+HEVC_NAL_SEI_SUFFIX = 40
+
+#  Max number of idle ffmpeg decoders kept per output format
+DECODER_WORKERS = int(os.getenv("FFMPEG_DECODERS", "4"))
+#  Seconds to wait on a decoder before giving up on it
+DECODER_TIMEOUT = 10
+#  GOPs decoded at once when reading ahead
+READAHEAD_WORKERS = int(os.getenv("FRAMEREADER_READAHEAD_WORKERS", str(min(4, os.cpu_count() or 1))))
+
 
 class GOPReader:
   def get_gop(self, num):
@@ -30,14 +42,6 @@ class GOPReader:
     raise NotImplementedError
 
 
-class DoNothingContextManager:
-  def __enter__(self):
-    return self
-
-  def __exit__(self, *x):
-    pass
-
-
 class FrameType(IntEnum):
   raw = 1
   h265_stream = 2
@@ -59,46 +63,65 @@ def fingerprint_video(fn):
     raise NotImplementedError(fn)
 
 
-def ffprobe(fn, fmt=None):
-  cmd = ["ffprobe",
-         "-v", "quiet",
-         "-print_format", "json",
-         "-show_format", "-show_streams"]
-  if fmt:
-    cmd += ["-f", fmt]
-  cmd += [fn]
-
-  try:
-    ffprobe_output = subprocess.check_output(cmd)
-  except subprocess.CalledProcessError:
-    raise DataUnreadableError(fn)
-
-  return json.loads(ffprobe_output)
+#  Index cache files are a header, the index rows and then the prefix, so the index can be mapped in place
+INDEX_CACHE_MAGIC = b"VIDX"
+INDEX_CACHE_VERSION = 1
+#  magic, version, width, height, source size, source mtime in ns, index rows, prefix length
+INDEX_CACHE_HEADER = struct.Struct("<4sIIIQQQQ")
 
 
-def vidindex(fn, typ):
-  vidindex_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "vidindex")
-  vidindex = os.path.join(vidindex_dir, "vidindex")
-
-  subprocess.check_call(["make"], cwd=vidindex_dir, stdout=open("/dev/null", "w"))
-
-  with tempfile.NamedTemporaryFile() as prefix_f, \
-       tempfile.NamedTemporaryFile() as index_f:
-    try:
-      subprocess.check_call([vidindex, typ, fn, prefix_f.name, index_f.name])
-    except subprocess.CalledProcessError:
-      raise DataUnreadableError(f"vidindex failed on file {fn}")
-    with open(index_f.name, "rb") as f:
-      index = f.read()
-    with open(prefix_f.name, "rb") as f:
-      prefix = f.read()
+def source_stat(fn):
+  #  Remote files never change, only local ones are checked against their size and mtime
+  fn = resolve_name(fn)
+  if fn.startswith("http://") or fn.startswith("https://"):
+    return None, 0
+  try:
+    st = os.stat(fn)
+  except FileNotFoundError:
+    return None, -1
+  return st.st_size, st.st_mtime_ns
+
+
+def write_index_cache(cache_path, fn, index_data):
+  index = np.ascontiguousarray(index_data['index'], dtype=np.uint32)
+  prefix = index_data['global_prefix']
+  stream = index_data['probe']['streams'][0]
+  size, mtime = source_stat(fn)
+  if size is None:
+    size = int(index[-1, 1])
+
+  header = INDEX_CACHE_HEADER.pack(INDEX_CACHE_MAGIC, INDEX_CACHE_VERSION, stream['width'], stream['height'],
+                                   size, mtime, len(index), len(prefix))
+  with atomic_write_in_dir(cache_path, mode="wb", overwrite=True) as cache_file:
+    cache_file.write(header)
+    cache_file.write(index.tobytes())
+    cache_file.write(prefix)
+
+
+def read_index_cache(cache_path, fn):
+  """Maps a cached index, returns None if it's missing, from another version or out of date."""
+  try:
+    with open(cache_path, "rb") as cache_file:
+      mm = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+  except (FileNotFoundError, ValueError):
+    #  mmap raises ValueError on empty files
+    return None
 
-  index = np.frombuffer(index, np.uint32).reshape(-1, 2)
+  if len(mm) < INDEX_CACHE_HEADER.size:
+    return None
+  magic, version, w, h, size, mtime, rows, prefix_len = INDEX_CACHE_HEADER.unpack_from(mm, 0)
+  if magic != INDEX_CACHE_MAGIC or version != INDEX_CACHE_VERSION or \
+     len(mm) != INDEX_CACHE_HEADER.size + rows * 8 + prefix_len:
+    return None
 
-  assert index[-1, 0] == 0xFFFFFFFF
-  assert index[-1, 1] == os.path.getsize(fn)
+  src_size, src_mtime = source_stat(fn)
+  if src_mtime != mtime or src_size not in (None, size):
+    return None
 
-  return index, prefix
+  #  The array keeps the mapping open
+  index = np.frombuffer(mm, dtype=np.uint32, count=rows * 2, offset=INDEX_CACHE_HEADER.size).reshape(-1, 2)
+  prefix_offset = INDEX_CACHE_HEADER.size + rows * 8
+  return stream_index_data(index, mm[prefix_offset:prefix_offset + prefix_len], w, h)
 
 
 def cache_fn(func):
@@ -110,72 +133,65 @@ def cache_fn(func):
       cache_prefix = kwargs.pop('cache_prefix', None)
       cache_path = cache_path_for_file_path(fn, cache_prefix)
 
-    if cache_path and os.path.exists(cache_path):
-      with open(cache_path, "rb") as cache_file:
-        cache_value = pickle.load(cache_file)
-    else:
+    cache_value = read_index_cache(cache_path, fn) if cache_path else None
+    if cache_value is None:
       cache_value = func(fn, *args, **kwargs)
 
       if cache_path:
-        with atomic_write_in_dir(cache_path, mode="wb", overwrite=True) as cache_file:
-          pickle.dump(cache_value, cache_file, -1)
+        write_index_cache(cache_path, fn, cache_value)
 
     return cache_value
 
   return cache_inner
 
 
+def stream_index_data(index, prefix, w, h):
+  #  probe only holds the fields of the ffprobe output that are used
+  return {
+    'index': index,
+    'global_prefix': prefix,
+    'probe': {'streams': [{'codec_name': "hevc", 'width': w, 'height': h}]},
+  }
+
+
 @cache_fn
 def index_stream(fn, typ):
   assert typ in ("hevc", )
 
-  with FileReader(fn) as f:
-    assert os.path.exists(f.name), fn
-    index, prefix = vidindex(f.name, typ)
-    probe = ffprobe(f.name, typ)
+  #  Indexed while it's read, remote files don't have to be downloaded first
+  index, prefix, (w, h) = hevc_index(fn)
+  return stream_index_data(index, prefix, w, h)
 
-  return {
-    'index': index,
-    'global_prefix': prefix,
-    'probe': probe
-  }
 
+def index_videos(camera_paths, cache_prefix=None, processes=None):
+  """Requires that paths in camera_paths are contiguous and of the same type.
 
-def index_videos(camera_paths, cache_prefix=None):
-  """Requires that paths in camera_paths are contiguous and of the same type."""
+     Videos that aren't cached yet are indexed in parallel on a process pool.
+  """
   if len(camera_paths) < 1:
     raise ValueError("must provide at least one video to index")
 
   frame_type = fingerprint_video(camera_paths[0])
-  for fn in camera_paths:
-    index_video(fn, frame_type, cache_prefix)
-
+  if frame_type != FrameType.h265_stream:
+    raise NotImplementedError("Only h265 supported")
 
-def index_video(fn, frame_type=None, cache_prefix=None):
-  cache_path = cache_path_for_file_path(fn, cache_prefix)
+  todo = [fn for fn in camera_paths if read_index_cache(cache_path_for_file_path(fn, cache_prefix), fn) is None]
+  for fn, (index, prefix, (w, h)) in zip(todo, hevc_index_many(todo, processes)):
+    write_index_cache(cache_path_for_file_path(fn, cache_prefix), fn, stream_index_data(index, prefix, w, h))
 
-  if os.path.exists(cache_path):
-    return
 
+def index_video(fn, frame_type=None, cache_prefix=None):
   if frame_type is None:
     frame_type = fingerprint_video(fn[0])
 
   if frame_type == FrameType.h265_stream:
-    index_stream(fn, "hevc", cache_prefix=cache_prefix)
+    return index_stream(fn, "hevc", cache_prefix=cache_prefix)
   else:
     raise NotImplementedError("Only h265 supported")
 
 
 def get_video_index(fn, frame_type, cache_prefix=None):
-  cache_path = cache_path_for_file_path(fn, cache_prefix)
-
-  if not os.path.exists(cache_path):
-    index_video(fn, frame_type, cache_prefix)
-
-  if not os.path.exists(cache_path):
-    return None
-  with open(cache_path, "rb") as cache_file:
-    return pickle.load(cache_file)
+  return index_video(fn, frame_type, cache_prefix)
 
 
 def read_file_check_size(f, sz, cookie):
@@ -185,28 +201,316 @@ def read_file_check_size(f, sz, cookie):
   return buff
 
 
-def rgb24toyuv420(rgb):
-  yuv_from_rgb = np.array([[ 0.299     ,  0.587     ,  0.114      ],
-                           [-0.14714119, -0.28886916,  0.43601035 ],
-                           [ 0.61497538, -0.51496512, -0.10001026 ]])
-  img = np.dot(rgb.reshape(-1, 3), yuv_from_rgb.T).reshape(rgb.shape)
+#  yuv_from_rgb in 20 bit fixed point, the luma coefficients sum to 1 << 20
+YUV_BITS = 20
+Y_FROM_RGB = (313524, 615514, 119538)
+U_FROM_RGB = (-154289, -302901, 457190)
+V_FROM_RGB = (644848, -539980, -104868)
+
 
-  y_len = img.shape[0] * img.shape[1]
+def rgb24toyuv420(rgb, out=None):
+  """Converts a (h, w, 3) rgb24 frame, or a (n, h, w, 3) batch of them, to yuv420p.
+
+     Integer arithmetic only, results are within 1 of the float conversion.
+     out is an optional (h*w*3//2,) or (n, h*w*3//2) uint8 array to write into.
+  """
+  batch = rgb[None] if rgb.ndim == 3 else rgb
+  n, h, w, _ = batch.shape
+  y_len = h * w
   uv_len = y_len // 4
+  if out is None:
+    out = np.empty((n, y_len + 2 * uv_len), dtype=np.uint8)
+  yuv420 = out.reshape(n, y_len + 2 * uv_len)
+
+  r, g, b = batch[..., 0], batch[..., 1], batch[..., 2]
+  acc = np.empty((n, h, w), dtype=np.int32)
+  tmp = np.empty_like(acc)
+  np.multiply(r, np.int32(Y_FROM_RGB[0]), out=acc)
+  acc += np.multiply(g, np.int32(Y_FROM_RGB[1]), out=tmp)
+  acc += np.multiply(b, np.int32(Y_FROM_RGB[2]), out=tmp)
+  acc >>= YUV_BITS
+  yuv420[:, :y_len] = acc.reshape(n, y_len)
+
+  # chroma is linear, so it's computed once from the sums of every 2x2 block
+  sums = []
+  for c in (r, g, b):
+    s = np.add(c[:, ::2, ::2], c[:, 1::2, ::2], dtype=np.int32)
+    s += c[:, ::2, 1::2]
+    s += c[:, 1::2, 1::2]
+    sums.append(s)
+  for i, coefs in enumerate((U_FROM_RGB, V_FROM_RGB)):
+    chroma = sums[0] * np.int32(coefs[0])
+    chroma += sums[1] * np.int32(coefs[1])
+    chroma += sums[2] * np.int32(coefs[2])
+    chroma >>= YUV_BITS + 2
+    chroma += 128
+    np.clip(chroma, 0, 255, out=chroma)
+    yuv420[:, y_len + i * uv_len:y_len + (i + 1) * uv_len] = chroma.reshape(n, uv_len)
+
+  return out[0] if rgb.ndim == 3 and out.ndim == 2 else out
+
+
+def debayer(raw, out=None):
+  """Debayers a (960, 1280) raw frame, or a (n, 960, 1280) batch of them, to half resolution rgb24.
+
+     out is an optional (480, 640, 3) or (n, 480, 640, 3) uint8 array to write into.
+  """
+  batch = raw[None] if raw.ndim == 2 else raw
+  n, h, w = batch.shape
+  if out is None:
+    out = np.empty((n, h // 2, w // 2, 3), dtype=np.uint8)
+  rgb = out.reshape(n, h // 2, w // 2, 3)
+
+  g = np.add(batch[:, 0::2, 0::2], batch[:, 1::2, 1::2], dtype=np.uint16)
+  g >>= 1
+  rgb[..., 0] = batch[:, 0::2, 1::2]
+  rgb[..., 1] = g
+  rgb[..., 2] = batch[:, 1::2, 0::2]
+
+  return out[0] if raw.ndim == 2 and out.ndim == 4 else out
+
+
+def frames_from_buffer(dat, w, h, pix_fmt):
+  if pix_fmt == "rgb24":
+    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, h, w, 3)
+  elif pix_fmt == "yuv420p":
+    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, (h*w*3//2))
+  elif pix_fmt == "yuv444p":
+    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, 3, h, w)
+  else:
+    raise NotImplementedError
+
+  #  Frames are shared through the frame cache, so they can't be written to,
+  #  even when decoded into a bytearray
+  ret.flags.writeable = False
+  return ret
+
+
+def frame_size(w, h, pix_fmt):
+  if pix_fmt == "yuv420p":
+    return w*h*3//2
+  elif pix_fmt in ("rgb24", "yuv444p"):
+    return w*h*3
+  raise NotImplementedError
 
-  ys = img[:, :, 0]
-  us = (img[::2, ::2, 1] + img[1::2, ::2, 1] + img[::2, 1::2, 1] + img[1::2, 1::2, 1]) / 4 + 128
-  vs = (img[::2, ::2, 2] + img[1::2, ::2, 2] + img[::2, 1::2, 2] + img[1::2, 1::2, 2]) / 4 + 128
 
-  yuv420 = np.empty(y_len + 2 * uv_len, dtype=img.dtype)
-  yuv420[:y_len] = ys.reshape(-1)
-  yuv420[y_len:y_len + uv_len] = us.reshape(-1)
-  yuv420[y_len + uv_len:y_len + 2 * uv_len] = vs.reshape(-1)
+def frame_shape(w, h, pix_fmt):
+  if pix_fmt == "rgb24":
+    return (h, w, 3)
+  elif pix_fmt == "yuv420p":
+    return (h*w*3//2,)
+  elif pix_fmt == "yuv444p":
+    return (3, h, w)
+  raise NotImplementedError
+
+
+class OutputFormat:
+  """Pixel format, crop box and size of decoded frames.
+
+     Frames are cropped to crop=(x, y, w, h) and then scaled to size=(w, h) by
+     ffmpeg, w and h are the size of the frames that come out of the decoder.
+     The crop box has to be even, it's applied to the decoder's yuv420p output.
+  """
+  def __init__(self, w, h, pix_fmt, size=None, crop=None):
+    if pix_fmt not in ("yuv420p", "rgb24", "yuv444p"):
+      raise ValueError(f"Unsupported pixel format {pix_fmt!r}")
+    self.pix_fmt = pix_fmt
+
+    filters = []
+    x, y, cw, ch = (0, 0, w, h) if crop is None else map(int, crop)
+    if crop is not None:
+      if x < 0 or y < 0 or cw <= 0 or ch <= 0 or x + cw > w or y + ch > h:
+        raise ValueError(f"crop {crop} is outside of the {w}x{h} frame")
+      if x % 2 or y % 2 or cw % 2 or ch % 2:
+        #  ffmpeg would round it down to whole chroma samples
+        raise ValueError(f"crop {crop} has to be at even offsets with an even size")
+      filters.append(f"crop={cw}:{ch}:{x}:{y}")
+      w, h = cw, ch
+    if size is not None and tuple(map(int, size)) != (w, h):
+      w, h = map(int, size)
+      if w <= 0 or h <= 0:
+        raise ValueError(f"invalid size {size}")
+      filters.append(f"scale={w}:{h}")
+    if pix_fmt == "yuv420p" and (w % 2 or h % 2):
+      raise ValueError(f"yuv420p frames must have an even size, not {w}x{h}")
+
+    self.w, self.h = w, h
+    self.vf = ",".join(filters) or None
+    # frame cache key, also part of shared cache names
+    self.key = pix_fmt if self.vf is None else f"{pix_fmt}_{x}_{y}_{cw}x{ch}_{w}x{h}"
+
+
+def check_out(out, count, w, h, pix_fmt):
+  shape = frame_shape(w, h, pix_fmt)
+  if out.dtype != np.uint8 or out.shape[0] < count or out.shape[1:] != shape:
+    raise ValueError(f"out must be a uint8 array of shape ({count}, {', '.join(map(str, shape))}), got {out.dtype} {out.shape}")
+
+
+def readinto_full(f, view):
+  pos = 0
+  while pos < len(view):
+    n = f.readinto(view[pos:])
+    if not n:
+      break
+    pos += n
+  return pos
+
+
+def hevc_frames(dat):
+  """Returns the (start, end) offsets of the VCL NALs of every frame in an hevc bytestream."""
+  frames = []
+  start = None
+  pos = dat.find(b"\x00\x00\x01")
+  while pos != -1 and pos + 5 < len(dat):
+    nal_type = (dat[pos + 3] >> 1) & 0x3f
+    if nal_type < HEVC_NAL_VPS:
+      first_slice = dat[pos + 5] & 0x80
+      if first_slice:
+        if start is not None:
+          frames.append((start, pos))
+        start = pos
+    elif start is not None and nal_type != HEVC_NAL_SEI_SUFFIX:
+      #  Parameter sets, AUDs and prefix SEIs belong to the next frame
+      frames.append((start, pos))
+      start = None
+    pos = dat.find(b"\x00\x00\x01", pos + 3)
+  if start is not None:
+    frames.append((start, len(dat)))
+  return frames
+
+
+class DecoderWorker:
+  """Long running ffmpeg process that decodes one GOP after another.
+
+     ffmpeg only outputs a frame once the next one starts, so every GOP is
+     followed by a copy of its first frame and an AUD. That copy comes out at
+     the start of the next GOP's output and is dropped. GOPs are separated by
+     EOS NALs, otherwise repeated CRA frames decode as duplicate POCs and are dropped.
+  """
+  AUD = b"\x00\x00\x00\x01\x46\x01\x50"
+  EOS = b"\x00\x00\x00\x01\x48\x01"
+
+  def __init__(self, vid_fmt, w, h, pix_fmt, vf=None):
+    # w and h are the size of the output frames, after the vf filters
+    self.w, self.h, self.pix_fmt = w, h, pix_fmt
+    self.frame_size = frame_size(w, h, pix_fmt)
+    self.pending = 0
 
-  return yuv420.clip(0, 255).astype('uint8')
+    threads = os.getenv("FFMPEG_THREADS", "0")
+    cuda = os.getenv("FFMPEG_CUDA", "0") == "1"
+    self.proc = subprocess.Popen(
+      ["ffmpeg",
+       "-threads", threads,
+       #  frame threading delays output by more frames
+       "-thread_type", "slice",
+       "-hwaccel", "none" if not cuda else "cuda",
+       "-c:v", "hevc",
+       "-analyzeduration", "0",
+       "-probesize", "32",
+       "-vsync", "0",
+       "-f", vid_fmt,
+       "-flags2", "showall",
+       "-i", "pipe:0",
+       "-threads", threads,
+       *(["-vf", vf] if vf else []),
+       "-f", "rawvideo",
+       "-pix_fmt", pix_fmt,
+       "-flush_packets", "1",
+       "pipe:1"],
+      stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0)
+
+  def close(self):
+    self.proc.kill()
+    self.proc.wait()
+
+  def detach(self):
+    #  In a forked child, the process belongs to the parent. Only the child's
+    #  copies of the pipes are closed, so ffmpeg still sees EOF when the parent closes it
+    self.proc.stdin.close()
+    self.proc.stdout.close()
+
+  def _write(self, dat):
+    try:
+      self.proc.stdin.write(dat)
+    except (BrokenPipeError, ValueError):
+      pass
+
+  def decode(self, rawdat):
+    frames = hevc_frames(rawdat)
+    if len(frames) == 0:
+      raise DataUnreadableError("no frames in GOP")
+    sentinel = rawdat[frames[0][0]:frames[0][1]]
+
+    #  Written from another thread, ffmpeg blocks on its output while we read it
+    writer = threading.Thread(target=self._write, args=(self.EOS + bytes(rawdat) + self.EOS + sentinel + self.AUD,), daemon=True)
+    writer.start()
+
+    buf = bytearray((self.pending + len(frames)) * self.frame_size)
+    view = memoryview(buf)
+    pos = 0
+    while pos < len(buf):
+      ready, _, _ = select.select([self.proc.stdout], [], [], DECODER_TIMEOUT)
+      n = self.proc.stdout.readinto(view[pos:]) if ready else 0
+      if not n:
+        raise DataUnreadableError("ffmpeg decoder stalled")
+      pos += n
+    writer.join()
+
+    ret = frames_from_buffer(buf, self.w, self.h, self.pix_fmt)[self.pending:]
+    self.pending = 1
+    return ret
 
 
-def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
+class DecoderPool:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.idle = {}
+
+  def decode(self, rawdat, vid_fmt, w, h, pix_fmt, vf=None):
+    key = (vid_fmt, w, h, pix_fmt, vf)
+    with self.lock:
+      workers = self.idle.setdefault(key, [])
+      worker = workers.pop() if len(workers) else None
+    if worker is None:
+      worker = DecoderWorker(vid_fmt, w, h, pix_fmt, vf)
+
+    try:
+      ret = worker.decode(rawdat)
+    except Exception:
+      worker.close()
+      raise
+
+    with self.lock:
+      if len(self.idle[key]) < DECODER_WORKERS:
+        self.idle[key].append(worker)
+        worker = None
+    if worker is not None:
+      worker.close()
+    return ret
+
+  def after_fork(self):
+    #  A forked child starts its own workers, the idle ones are the parent's
+    self.lock = threading.Lock()
+    for workers in self.idle.values():
+      for worker in workers:
+        worker.detach()
+    self.idle = {}
+
+
+decoder_pool = DecoderPool()
+os.register_at_fork(after_in_child=decoder_pool.after_fork)
+
+
+def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt, vf=None):
+  if vid_fmt == "hevc" and DECODER_WORKERS > 0:
+    try:
+      return decoder_pool.decode(rawdat, vid_fmt, w, h, pix_fmt, vf)
+    except DataUnreadableError:
+      pass
+  return decompress_video_data_once(rawdat, vid_fmt, w, h, pix_fmt, vf)
+
+
+def decompress_video_data_once(rawdat, vid_fmt, w, h, pix_fmt, vf=None):
   # using a tempfile is much faster than proc.communicate for some reason
 
   with tempfile.TemporaryFile() as tmpf:
@@ -225,6 +529,7 @@ def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
        "-flags2", "showall",
        "-i", "pipe:0",
        "-threads", threads,
+       *(["-vf", vf] if vf else []),
        "-f", "rawvideo",
        "-pix_fmt", pix_fmt,
        "pipe:1"],
@@ -235,16 +540,7 @@ def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
     if proc.wait() != 0:
       raise DataUnreadableError("ffmpeg failed")
 
-  if pix_fmt == "rgb24":
-    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, h, w, 3)
-  elif pix_fmt == "yuv420p":
-    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, (h*w*3//2))
-  elif pix_fmt == "yuv444p":
-    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, 3, h, w)
-  else:
-    raise NotImplementedError
-
-  return ret
+  return frames_from_buffer(dat, w, h, pix_fmt)
 
 
 class BaseFrameReader:
@@ -259,18 +555,27 @@ class BaseFrameReader:
   def close(self):
     pass
 
-  def get(self, num, count=1, pix_fmt="yuv420p"):
+  def get(self, num, count=1, pix_fmt="yuv420p", size=None, crop=None):
     raise NotImplementedError
 
+  def get_into(self, num, count, out, pix_fmt="yuv420p", size=None, crop=None):
+    """Like get, but writes the frames into out[:count] instead of returning a list."""
+    fmt = OutputFormat(self.w, self.h, pix_fmt, size, crop)
+    check_out(out, count, fmt.w, fmt.h, pix_fmt)
+    for i, frame in enumerate(self.get(num, count, pix_fmt, size, crop)):
+      out[i] = frame
+    return out
+
 
-def FrameReader(fn, cache_prefix=None, readahead=False, readbehind=False, index_data=None):
+def FrameReader(fn, cache_prefix=None, readahead=False, readbehind=False, index_data=None, cache_size=None, shared_cache=False):
   frame_type = fingerprint_video(fn)
   if frame_type == FrameType.raw:
     return RawFrameReader(fn)
   elif frame_type in (FrameType.h265_stream,):
     if not index_data:
       index_data = get_video_index(fn, frame_type, cache_prefix)
-    return StreamFrameReader(fn, frame_type, index_data, readahead=readahead, readbehind=readbehind)
+    return StreamFrameReader(fn, frame_type, index_data, readahead=readahead, readbehind=readbehind,
+                             cache_size=cache_size, shared_cache=shared_cache)
   else:
     raise NotImplementedError(frame_type)
 
@@ -285,6 +590,12 @@ class RawData:
     self.f.seek((self.lenn+4)*i + 4)
     return self.f.read(self.lenn)
 
+  def read_batch(self, i, count):
+    # frames are each preceded by their length, returns a (count, lenn) view without copying them
+    self.f.seek((self.lenn+4)*i)
+    dat = read_file_check_size(self.f, (self.lenn+4)*count, None)
+    return np.frombuffer(dat, dtype=np.uint8).reshape(count, self.lenn+4)[:, 4:]
+
 
 class RawFrameReader(BaseFrameReader):
   def __init__(self, fn):
@@ -297,37 +608,46 @@ class RawFrameReader(BaseFrameReader):
 
   def load_and_debayer(self, img):
     img = np.frombuffer(img, dtype='uint8').reshape(960, 1280)
-    cimg = np.dstack([img[0::2, 1::2], ((img[0::2, 0::2].astype("uint16") + img[1::2, 1::2].astype("uint16")) >> 1).astype("uint8"), img[1::2, 0::2]])
-    return cimg
+    return debayer(img)
 
-  def get(self, num, count=1, pix_fmt="yuv420p"):
+  def get(self, num, count=1, pix_fmt="yuv420p", size=None, crop=None):
     assert self.frame_count is not None
     assert num+count <= self.frame_count
 
     if pix_fmt not in ("yuv420p", "rgb24"):
       raise ValueError(f"Unsupported pixel format {pix_fmt!r}")
+    if size is not None or crop is not None:
+      raise NotImplementedError("raw frames can't be scaled or cropped")
 
-    app = []
-    for i in range(num, num+count):
-      dat = self.rawfile.read(i)
-      rgb_dat = self.load_and_debayer(dat)
-      if pix_fmt == "rgb24":
-        app.append(rgb_dat)
-      elif pix_fmt == "yuv420p":
-        app.append(rgb24toyuv420(rgb_dat))
-      else:
-        raise NotImplementedError
+    return list(self._convert(num, count, pix_fmt))
 
-    return app
+  def get_into(self, num, count, out, pix_fmt="yuv420p", size=None, crop=None):
+    assert num+count <= self.frame_count
+    if size is not None or crop is not None:
+      raise NotImplementedError("raw frames can't be scaled or cropped")
+    check_out(out, count, self.w, self.h, pix_fmt)
+    self._convert(num, count, pix_fmt, out[:count])
+    return out
+
+  def _convert(self, num, count, pix_fmt, out=None):
+    raw = self.rawfile.read_batch(num, count).reshape(count, 960, 1280)
+    if pix_fmt == "rgb24":
+      return debayer(raw, out)
+    elif pix_fmt == "yuv420p":
+      return rgb24toyuv420(debayer(raw), out)
+    else:
+      raise NotImplementedError
 
 
 class VideoStreamDecompressor:
-  def __init__(self, fn, vid_fmt, w, h, pix_fmt):
+  def __init__(self, fn, vid_fmt, w, h, pix_fmt, vf=None):
+    # w and h are the size of the output frames, after the vf filters
     self.fn = fn
     self.vid_fmt = vid_fmt
     self.w = w
     self.h = h
     self.pix_fmt = pix_fmt
+    self.vf = vf
 
     if pix_fmt == "yuv420p":
       self.out_size = w*h*3//2  # yuv420p
@@ -351,7 +671,7 @@ class VideoStreamDecompressor:
     finally:
       self.proc.stdin.close()
 
-  def read(self):
+  def _cmd(self):
     threads = os.getenv("FFMPEG_THREADS", "0")
     cuda = os.getenv("FFMPEG_CUDA", "0") == "1"
     cmd = [
@@ -368,11 +688,15 @@ class VideoStreamDecompressor:
       "-f", self.vid_fmt,
       "-i", "pipe:0",
       "-threads", threads,
+      *(["-vf", self.vf] if self.vf else []),
       "-f", "rawvideo",
       "-pix_fmt", self.pix_fmt,
       "pipe:1"
     ]
-    self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return cmd
+
+  def read(self):
+    self.proc = subprocess.Popen(self._cmd(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
     try:
       self.t.start()
 
@@ -397,6 +721,38 @@ class VideoStreamDecompressor:
       self.proc.kill()
       self.t.join()
 
+  def read_into(self, out):
+    """Decodes straight into out, yields the number of frames written each time it's full and at the end.
+
+       out is reused, so its frames have to be consumed before resuming.
+    """
+    check_out(out, 1, self.w, self.h, self.pix_fmt)
+    if not out.flags.c_contiguous:
+      raise ValueError("out must be contiguous")
+    self.proc = subprocess.Popen(self._cmd(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    frames = out.reshape(len(out), -1)
+    try:
+      self.t.start()
+
+      n = 0
+      while True:
+        got = readinto_full(self.proc.stdout, memoryview(frames[n]))
+        if got == 0:
+          break
+        assert got == self.out_size
+        n += 1
+        if n == len(out):
+          yield n
+          n = 0
+      if n:
+        yield n
+
+      result_code = self.proc.wait()
+      assert result_code == 0, result_code
+    finally:
+      self.proc.kill()
+      self.t.join()
+
 class StreamGOPReader(GOPReader):
   def __init__(self, fn, frame_type, index_data):
     assert frame_type == FrameType.h265_stream
@@ -418,31 +774,27 @@ class StreamGOPReader(GOPReader):
     self.num_prefix_frames = 0
     self.vid_fmt = "hevc"
 
-    i = 0
-    while i < self.index.shape[0] and self.index[i, 0] != HEVC_SLICE_I:
-      i += 1
-    self.first_iframe = i
+    self.frame_count = len(self.index) - 1
+
+    # every GOP starts at an I frame, the table holds (frame_b, frame_e, offset_b, offset_e) per GOP
+    iframes = np.flatnonzero(self.index[:-1, 0] == HEVC_SLICE_I)
+    self.first_iframe = iframes[0] if len(iframes) else self.frame_count
 
     assert self.first_iframe == 0
 
-    self.frame_count = len(self.index) - 1
+    bounds = np.append(iframes, self.frame_count)
+    self.gop_table = np.stack([bounds[:-1], bounds[1:], self.index[bounds[:-1], 1], self.index[bounds[1:], 1]], axis=1).astype(np.int64)
 
     self.w = probe['streams'][0]['width']
     self.h = probe['streams'][0]['height']
 
-  def _lookup_gop(self, num):
-    frame_b = num
-    while frame_b > 0 and self.index[frame_b, 0] != HEVC_SLICE_I:
-      frame_b -= 1
+  def gop_num(self, num):
+    """Returns the row of the GOP table holding frame num."""
+    return int(np.searchsorted(self.gop_table[:, 0], num, side="right")) - 1
 
-    frame_e = num + 1
-    while frame_e < (len(self.index) - 1) and self.index[frame_e, 0] != HEVC_SLICE_I:
-      frame_e += 1
-
-    offset_b = self.index[frame_b, 1]
-    offset_e = self.index[frame_e, 1]
-
-    return (frame_b, frame_e, offset_b, offset_e)
+  def _lookup_gop(self, num):
+    frame_b, frame_e, offset_b, offset_e = self.gop_table[self.gop_num(num)]
+    return (int(frame_b), int(frame_e), int(offset_b), int(offset_e))
 
   def get_gop(self, num):
     frame_b, frame_e, offset_b, offset_e = self._lookup_gop(num)
@@ -470,23 +822,25 @@ class StreamGOPReader(GOPReader):
 class GOPFrameReader(BaseFrameReader):
   #FrameReader with caching and readahead for formats that are group-of-picture based
 
-  def __init__(self, readahead=False, readbehind=False):
+  def __init__(self, readahead=False, readbehind=False, cache_size=None, shared_cache=False):
     self.open_ = True
 
     self.readahead = readahead
     self.readbehind = readbehind
-    self.frame_cache = LRU(64)
+    # cache_size is in bytes, a shared cache is used by every process reading the same file
+    if shared_cache:
+      self.frame_cache = SharedFrameCache(SharedFrameCache.name_for_file(self.fn), cache_size)
+    else:
+      self.frame_cache = FrameCache(cache_size)
+
+    # GOPs being decoded, (gop, fmt.key) -> Future. The lock is never held across a decode
+    self.decoding = {}
+    self.decoding_lock = threading.Lock()
 
     if self.readahead:
-      self.cache_lock = threading.RLock()
-      self.readahead_last = None
       self.readahead_len = 30
-      self.readahead_c = threading.Condition()
-      self.readahead_thread = threading.Thread(target=self._readahead_thread)
-      self.readahead_thread.daemon = True
-      self.readahead_thread.start()
-    else:
-      self.cache_lock = DoNothingContextManager()
+      self.readahead_workers = READAHEAD_WORKERS
+      self.readahead_pool = ThreadPoolExecutor(max_workers=self.readahead_workers, thread_name_prefix="readahead")
 
   def close(self):
     if not self.open_:
@@ -494,88 +848,155 @@ class GOPFrameReader(BaseFrameReader):
     self.open_ = False
 
     if self.readahead:
-      self.readahead_c.acquire()
-      self.readahead_c.notify()
-      self.readahead_c.release()
-      self.readahead_thread.join()
+      with self.decoding_lock:
+        for f in self.decoding.values():
+          f.cancel()
+      self.readahead_pool.shutdown(wait=True)
 
-  def _readahead_thread(self):
-    while True:
-      self.readahead_c.acquire()
-      try:
-        if not self.open_:
-          break
-        self.readahead_c.wait()
-      finally:
-        self.readahead_c.release()
-      if not self.open_:
-        break
-      assert self.readahead_last
-      num, pix_fmt = self.readahead_last
-
-      if self.readbehind:
-        for k in range(num - 1, max(0, num - self.readahead_len), -1):
-          self._get_one(k, pix_fmt)
-      else:
-        for k in range(num, min(self.frame_count, num + self.readahead_len)):
-          self._get_one(k, pix_fmt)
-
-  def _get_one(self, num, pix_fmt):
-    assert num < self.frame_count
+    self.frame_cache.close()
 
-    if (num, pix_fmt) in self.frame_cache:
-      return self.frame_cache[(num, pix_fmt)]
+  def _decode_gop(self, gop, fmt):
+    frame_b, num_frames, skip_frames, rawdat = self.get_gop(int(self.gop_table[gop, 0]))
 
-    with self.cache_lock:
-      if (num, pix_fmt) in self.frame_cache:
-        return self.frame_cache[(num, pix_fmt)]
+    ret = decompress_video_data(rawdat, self.vid_fmt, fmt.w, fmt.h, fmt.pix_fmt, fmt.vf)
+    ret = ret[skip_frames:]
+    assert ret.shape[0] == num_frames
 
-      frame_b, num_frames, skip_frames, rawdat = self.get_gop(num)
+    for i in range(ret.shape[0]):
+      self.frame_cache.put((frame_b+i, fmt.key), ret[i])
+    return ret
 
-      ret = decompress_video_data(rawdat, self.vid_fmt, self.w, self.h, pix_fmt)
-      ret = ret[skip_frames:]
-      assert ret.shape[0] == num_frames
+  def _readahead_gop(self, gop, fmt):
+    try:
+      return self._decode_gop(gop, fmt)
+    finally:
+      with self.decoding_lock:
+        self.decoding.pop((gop, fmt.key), None)
 
-      for i in range(ret.shape[0]):
-        self.frame_cache[(frame_b+i, pix_fmt)] = ret[i]
+  def _gop_frames(self, gop, fmt):
+    # waits for the GOP if it's being decoded already, decodes it otherwise
+    key = (gop, fmt.key)
+    while True:
+      with self.decoding_lock:
+        future = self.decoding.get(key)
+        if future is None:
+          future = self.decoding[key] = Future()
+          # running, so _schedule_readahead can't cancel it from another thread
+          future.set_running_or_notify_cancel()
+          break
+      try:
+        return future.result()
+      except CancelledError:
+        pass
+
+    try:
+      ret = self._decode_gop(gop, fmt)
+      future.set_result(ret)
+      return ret
+    except Exception as e:
+      future.set_exception(e)
+      raise
+    finally:
+      with self.decoding_lock:
+        self.decoding.pop(key, None)
+
+  def _schedule_readahead(self, num, fmt):
+    # decodes the GOPs holding the next readahead_len frames, at least one per worker
+    if self.readbehind:
+      first, last = self.gop_num(max(0, num - self.readahead_len)), self.gop_num(max(0, num - 1))
+      gops = range(last, max(-1, min(first, last - self.readahead_workers + 1) - 1), -1)
+    else:
+      if num >= self.frame_count:
+        return
+      first, last = self.gop_num(num), self.gop_num(min(self.frame_count, num + self.readahead_len) - 1)
+      gops = range(first, min(len(self.gop_table), max(last, first + self.readahead_workers - 1) + 1))
+
+    with self.decoding_lock:
+      # work for GOPs that aren't needed anymore is dropped if it hasn't started yet
+      for key, future in list(self.decoding.items()):
+        if key[0] not in gops and future.cancel():
+          del self.decoding[key]
+
+      for gop in gops:
+        key = (gop, fmt.key)
+        if key not in self.decoding and (int(self.gop_table[gop, 0]), fmt.key) not in self.frame_cache:
+          self.decoding[key] = self.readahead_pool.submit(self._readahead_gop, gop, fmt)
+
+  def _get_one(self, num, fmt):
+    assert num < self.frame_count
+
+    frame = self.frame_cache.get((num, fmt.key))
+    if frame is not None:
+      return frame
 
-      return self.frame_cache[(num, pix_fmt)]
+    gop = self.gop_num(num)
+    return self._gop_frames(gop, fmt)[num - int(self.gop_table[gop, 0])]
 
-  def get(self, num, count=1, pix_fmt="yuv420p"):
+  def _frames(self, num, count, fmt):
     assert self.frame_count is not None
 
     if num + count > self.frame_count:
       raise ValueError(f"{num + count} > {self.frame_count}")
 
-    if pix_fmt not in ("yuv420p", "rgb24", "yuv444p"):
-      raise ValueError(f"Unsupported pixel format {pix_fmt!r}")
+    if self.readahead:
+      self._schedule_readahead(num, fmt)
 
-    ret = [self._get_one(num + i, pix_fmt) for i in range(count)]
+    for i in range(count):
+      yield self._get_one(num + i, fmt)
 
     if self.readahead:
-      self.readahead_last = (num+count, pix_fmt)
-      self.readahead_c.acquire()
-      self.readahead_c.notify()
-      self.readahead_c.release()
+      self._schedule_readahead(num + count, fmt)
 
-    return ret
+  def get(self, num, count=1, pix_fmt="yuv420p", size=None, crop=None):
+    """Returns count frames from num on, optionally cropped to crop=(x, y, w, h) and scaled to size=(w, h)."""
+    return list(self._frames(num, count, OutputFormat(self.w, self.h, pix_fmt, size, crop)))
+
+  def get_into(self, num, count, out, pix_fmt="yuv420p", size=None, crop=None):
+    #  Each frame is copied once, from the cache or the decoder output
+    fmt = OutputFormat(self.w, self.h, pix_fmt, size, crop)
+    check_out(out, count, fmt.w, fmt.h, pix_fmt)
+    for i, frame in enumerate(self._frames(num, count, fmt)):
+      out[i] = frame
+    return out
 
 
 class StreamFrameReader(StreamGOPReader, GOPFrameReader):
-  def __init__(self, fn, frame_type, index_data, readahead=False, readbehind=False):
+  def __init__(self, fn, frame_type, index_data, readahead=False, readbehind=False, cache_size=None, shared_cache=False):
     StreamGOPReader.__init__(self, fn, frame_type, index_data)
-    GOPFrameReader.__init__(self, readahead, readbehind)
+    GOPFrameReader.__init__(self, readahead, readbehind, cache_size, shared_cache)
 
 
-def GOPFrameIterator(gop_reader, pix_fmt):
-  dec = VideoStreamDecompressor(gop_reader.fn, gop_reader.vid_fmt, gop_reader.w, gop_reader.h, pix_fmt)
+def GOPFrameIterator(gop_reader, pix_fmt, size=None, crop=None):
+  fmt = OutputFormat(gop_reader.w, gop_reader.h, pix_fmt, size, crop)
+  dec = VideoStreamDecompressor(gop_reader.fn, gop_reader.vid_fmt, fmt.w, fmt.h, pix_fmt, fmt.vf)
   yield from dec.read()
 
 
-def FrameIterator(fn, pix_fmt, **kwargs):
+def GOPFrameIteratorInto(gop_reader, pix_fmt, out, size=None, crop=None):
+  fmt = OutputFormat(gop_reader.w, gop_reader.h, pix_fmt, size, crop)
+  dec = VideoStreamDecompressor(gop_reader.fn, gop_reader.vid_fmt, fmt.w, fmt.h, pix_fmt, fmt.vf)
+  yield from dec.read_into(out)
+
+
+def FrameIterator(fn, pix_fmt, size=None, crop=None, **kwargs):
   fr = FrameReader(fn, **kwargs)
   if isinstance(fr, GOPReader):
-    yield from GOPFrameIterator(fr, pix_fmt)
+    yield from GOPFrameIterator(fr, pix_fmt, size, crop)
   else:
     for i in range(fr.frame_count):
-      yield fr.get(i, pix_fmt=pix_fmt)[0]
+      yield fr.get(i, pix_fmt=pix_fmt, size=size, crop=crop)[0]
+
+
+def FrameIteratorInto(fn, pix_fmt, out, size=None, crop=None, **kwargs):
+  """Fills the preallocated batch out with consecutive frames, yields how many were written.
+
+     out is reused for every batch, so out[:n] has to be consumed before resuming.
+  """
+  fr = FrameReader(fn, **kwargs)
+  if isinstance(fr, GOPReader):
+    yield from GOPFrameIteratorInto(fr, pix_fmt, out, size, crop)
+  else:
+    for i in range(0, fr.frame_count, len(out)):
+      count = min(len(out), fr.frame_count - i)
+      fr.get_into(i, count, out, pix_fmt=pix_fmt, size=size, crop=crop)
+      yield count
@@ -0,0 +1,154 @@
+import multiprocessing
+
+import numpy as np
+
+from tools.lib.exceptions import DataUnreadableError
+from tools.lib.filereader import FileReader
+from tools.lib.url_file import CHUNK_SIZE, DOWNLOAD_WORKERS
+
+#  Bytes read at once. Uncached remote files download every chunk of a read
+#  concurrently, a single chunk would be downloaded one request at a time
+READ_SIZE = CHUNK_SIZE * max(1, DOWNLOAD_WORKERS)
+
+START_CODE = b"\x00\x00\x01"
+
+HEVC_NAL_BLA_W_LP = 16
+HEVC_NAL_RSV_IRAP_VCL23 = 23
+HEVC_NAL_CRA = 21
+HEVC_NAL_VPS = 32
+HEVC_NAL_SPS = 33
+HEVC_NAL_PPS = 34
+
+
+class BitReader:
+  """Reads an RBSP, emulation prevention bytes are removed up front."""
+  def __init__(self, dat):
+    self.dat = bytes(dat).replace(b"\x00\x00\x03", b"\x00\x00")
+    self.pos = 0
+
+  def u(self, n):
+    v = 0
+    for _ in range(n):
+      byte = self.dat[self.pos >> 3] if (self.pos >> 3) < len(self.dat) else 0
+      v = (v << 1) | ((byte >> (7 - (self.pos & 7))) & 1)
+      self.pos += 1
+    return v
+
+  def ue(self):
+    zeros = 0
+    while self.u(1) == 0:
+      zeros += 1
+      if zeros > 31:
+        raise DataUnreadableError("invalid exp-golomb code")
+    return (1 << zeros) - 1 + self.u(zeros)
+
+
+def sps_size(nal):
+  """Returns the displayed (width, height) of an hevc SPS NAL, without its start code."""
+  bs = BitReader(nal[2:])
+  bs.u(4)  # sps_video_parameter_set_id
+  max_sub_layers_minus1 = bs.u(3)
+  bs.u(1)  # sps_temporal_id_nesting_flag
+
+  # profile_tier_level
+  bs.u(2 + 1 + 5 + 32 + 48 + 8)
+  sub_layers = [(bs.u(1), bs.u(1)) for _ in range(max_sub_layers_minus1)]
+  if max_sub_layers_minus1 > 0:
+    bs.u(2 * (8 - max_sub_layers_minus1))
+  for profile_present, level_present in sub_layers:
+    bs.u(88 * profile_present + 8 * level_present)
+
+  bs.ue()  # sps_seq_parameter_set_id
+  chroma_format_idc = bs.ue()
+  if chroma_format_idc == 3:
+    bs.u(1)  # separate_colour_plane_flag
+  w, h = bs.ue(), bs.ue()
+  if bs.u(1):  # conformance_window_flag
+    left, right, top, bottom = bs.ue(), bs.ue(), bs.ue(), bs.ue()
+    sub_w = 2 if chroma_format_idc in (1, 2) else 1
+    sub_h = 2 if chroma_format_idc == 1 else 1
+    w -= sub_w * (left + right)
+    h -= sub_h * (top + bottom)
+  return w, h
+
+
+class HEVCIndexer:
+  """Builds the frame index of an hevc bytestream fed to it in pieces.
+
+     The index has a (slice_type, offset) row per frame and a final
+     (0xFFFFFFFF, file size) row. The prefix holds the parameter sets.
+  """
+  def __init__(self):
+    self.buf = bytearray()
+    self.base = 0  # file offset of buf[0]
+    self.index = []
+    self.prefix = bytearray()
+    self.w, self.h = None, None
+
+  def feed(self, dat):
+    #  Only the new bytes need to be searched, a NAL can span many reads
+    scan = max(len(self.buf) - 2, 0)
+    self.buf += dat
+    start = self.buf.find(START_CODE)
+    while start != -1:
+      end = self.buf.find(START_CODE, max(start + 3, scan))
+      if end == -1:
+        break
+      self._nal(start, end)
+      start = end
+    if start == -1:
+      #  Keep a possible partial start code
+      start = max(len(self.buf) - 2, 0)
+    del self.buf[:start]
+    self.base += start
+
+  def _nal(self, start, end):
+    if end - start < 6:
+      return
+    nal_type = (self.buf[start + 3] >> 1) & 0x3f
+    if nal_type in (HEVC_NAL_VPS, HEVC_NAL_SPS, HEVC_NAL_PPS):
+      self.prefix += self.buf[start:end]
+      if nal_type == HEVC_NAL_SPS and self.w is None:
+        self.w, self.h = sps_size(self.buf[start + 3:end])
+    elif nal_type <= HEVC_NAL_CRA:
+      #  slice_segment_header, only the first slice of a picture starts a frame
+      bs = BitReader(self.buf[start + 5:start + 16])
+      if not bs.u(1):  # first_slice_segment_in_pic_flag
+        return
+      if HEVC_NAL_BLA_W_LP <= nal_type <= HEVC_NAL_RSV_IRAP_VCL23:
+        bs.u(1)  # no_output_of_prior_pics_flag
+      bs.ue()  # slice_pic_parameter_set_id
+      self.index.append((bs.ue(), self.base + start))
+
+  def finish(self):
+    """Returns the index, prefix and frame size once the whole stream was fed."""
+    start = self.buf.find(START_CODE)
+    if start != -1:
+      self._nal(start, len(self.buf))
+    size = self.base + len(self.buf)
+    self.buf = bytearray()
+    if self.w is None:
+      raise DataUnreadableError("no SPS in stream")
+
+    index = np.array(self.index + [(0xFFFFFFFF, size)], dtype=np.uint32).reshape(-1, 2)
+    return index, bytes(self.prefix), (self.w, self.h)
+
+
+def hevc_index(fn):
+  """Indexes an hevc file while reading it, so remote files are indexed as they download."""
+  indexer = HEVCIndexer()
+  with FileReader(fn) as f:
+    while True:
+      dat = f.read(READ_SIZE)
+      if len(dat) == 0:
+        break
+      indexer.feed(dat)
+  return indexer.finish()
+
+
+def hevc_index_many(fns, processes=None):
+  """Indexes the files on a process pool, returns their hevc_index results in order."""
+  if len(fns) <= 1:
+    return [hevc_index(fn) for fn in fns]
+  with multiprocessing.Pool(min(processes or multiprocessing.cpu_count(), len(fns))) as pool:
+    return pool.map(hevc_index, fns)
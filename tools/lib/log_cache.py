@@ -0,0 +1,70 @@
+import os
+import urllib.parse
+
+from common.file_helpers import mkdirs_exists_ok, atomic_write_in_dir
+from tools.lib.url_file import CACHE_DIR, evict_lru, hash_256
+
+# decompressed logs, evicted least recently used first once they take up more than LOG_CACHE_SIZE bytes
+LOG_CACHE_DIR = os.environ.get("LOG_CACHE_DIR", os.path.join(CACHE_DIR, "logs"))
+LOG_CACHE_SIZE = int(os.environ.get("LOG_CACHE_SIZE", 20 * 1024 * 1024 * 1024))
+LOG_CACHE_EXT = ".log"
+
+
+def cache_enabled(cache=None):
+  # same default as URLFile
+  if cache is not None:
+    return cache
+  return bool(int(os.environ.get("FILEREADER_CACHE", "0")))
+
+
+def cache_key(fn):
+  key = fn
+  if urllib.parse.urlparse(fn).scheme == "":
+    # local files can change, so they're keyed by their size and mtime as well
+    st = os.stat(fn)
+    key = f"{os.path.abspath(fn)}:{st.st_size}:{st.st_mtime_ns}"
+  return hash_256(key)
+
+
+def cache_path(fn):
+  return os.path.join(LOG_CACHE_DIR, cache_key(fn) + LOG_CACHE_EXT)
+
+
+def lookup(fn):
+  """Returns the path of the cached decompressed log at fn, or None."""
+  path = cache_path(fn)
+  try:
+    # mtime is the last access time used for eviction
+    os.utime(path)
+  except FileNotFoundError:
+    return None
+  return path
+
+
+def write(fn, dat):
+  mkdirs_exists_ok(LOG_CACHE_DIR)
+  path = cache_path(fn)
+  with atomic_write_in_dir(path, mode="wb", overwrite=True) as f:
+    f.write(dat)
+  evict(keep=path)
+
+
+def evict(max_size=None, keep=None):
+  """Deletes the least recently used logs until the cache fits in max_size bytes."""
+  max_size = LOG_CACHE_SIZE if max_size is None else max_size
+
+  entries = []
+  try:
+    with os.scandir(LOG_CACHE_DIR) as it:
+      for e in it:
+        if not e.name.endswith(LOG_CACHE_EXT):
+          continue
+        try:
+          st = e.stat()
+        except FileNotFoundError:
+          continue
+        entries.append((st.st_mtime, st.st_size, [e.path]))
+  except FileNotFoundError:
+    return
+
+  evict_lru(entries, max_size, keep)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+import os
+import sys
+from collections import defaultdict
+
+import capnp
+import numpy as np
+
+from common.file_helpers import mkdirs_exists_ok, atomic_write_in_dir
+from tools.lib.cache import DEFAULT_CACHE_DIR
+from tools.lib.log_cache import cache_key
+from tools.lib.logreader import LogReader
+
+COLUMN_CACHE_DIR = os.path.join(DEFAULT_CACHE_DIR, "columns")
+TIME_COLUMN = "logMonoTime"
+
+
+def _parse_fields(fields):
+  # "radarState.leadOne.dRel" -> {"radarState": ["leadOne.dRel"]}
+  by_service = defaultdict(list)
+  for field in fields:
+    service, _, path = field.partition(".")
+    if not path:
+      raise ValueError(f"field {field!r} has to be of the form service.field")
+    if path not in by_service[service]:
+      by_service[service].append(path)
+  return by_service
+
+
+def _column_path(fn, service, column):
+  return os.path.join(COLUMN_CACHE_DIR, cache_key(fn), f"{service}.{column}.npy")
+
+
+def _load_column(path):
+  arr = np.load(path)
+  if not isinstance(arr, np.lib.npyio.NpzFile):
+    return arr
+
+  # a ragged column, see _save_column
+  with arr:
+    values, offsets, is_bytes = arr["values"], arr["offsets"], bool(arr["is_bytes"])
+  col = np.empty(len(offsets) - 1, dtype=object)
+  for i in range(len(col)):
+    v = values[offsets[i]:offsets[i + 1]]
+    col[i] = v.tobytes() if is_bytes else v
+  return col
+
+
+def _save_column(f, arr):
+  if arr.dtype != object:
+    np.save(f, arr)
+    return
+
+  # lists and Data are object arrays, which can't be stored without pickling.
+  # They're stored as all their values in one array, and where each one starts
+  is_bytes = len(arr) > 0 and isinstance(arr[0], bytes)
+  if is_bytes:
+    values = np.frombuffer(b"".join(arr), dtype=np.uint8)
+  else:
+    values = [v for v in arr if len(v)]
+    values = np.concatenate(values) if len(values) else np.array([])
+  offsets = np.cumsum([0] + [len(v) for v in arr], dtype=np.int64)
+  np.savez(f, values=values, offsets=offsets, is_bytes=is_bytes)
+
+
+def _load_cached(fn, service, columns):
+  try:
+    return {c: _load_column(_column_path(fn, service, c)) for c in columns}
+  except FileNotFoundError:
+    return None
+
+
+def _save_cached(fn, service, segment_columns):
+  mkdirs_exists_ok(os.path.dirname(_column_path(fn, service, TIME_COLUMN)))
+  for column, arr in segment_columns.items():
+    with atomic_write_in_dir(_column_path(fn, service, column), mode="wb", overwrite=True) as f:
+      _save_column(f, arr)
+
+
+def _value(field, v):
+  # enums as their names and lists as python lists, so every column can be stored
+  if isinstance(v, capnp.lib.capnp._DynamicEnum):
+    return str(v)
+  if isinstance(v, capnp.lib.capnp._DynamicListReader):
+    return [_value(field, x) for x in v]
+  if isinstance(v, capnp.lib.capnp._DynamicStructReader):
+    raise ValueError(f"field {field!r} is a struct, ask for its fields instead")
+  return v
+
+
+def _column(values):
+  if len(values) and isinstance(values[0], (list, bytes)):
+    # one entry per event, lists become arrays of their own
+    col = np.empty(len(values), dtype=object)
+    for i, v in enumerate(values):
+      col[i] = v if isinstance(v, bytes) else np.array(v)
+    return col
+  return np.array(values)
+
+
+def _extract(fn, by_service):
+  values = {service: defaultdict(list) for service in by_service}
+  for msg in LogReader(fn, services=list(by_service)):
+    service = msg.which()
+    out = values[service]
+    out[TIME_COLUMN].append(msg.logMonoTime)
+
+    ev = getattr(msg, service)
+    for path in by_service[service]:
+      v = ev
+      for attr in path.split("."):
+        v = getattr(v, attr)
+      out[path].append(_value(f"{service}.{path}", v))
+
+  ret = {}
+  for service, paths in by_service.items():
+    ret[service] = {TIME_COLUMN: np.array(values[service][TIME_COLUMN], dtype=np.uint64)}
+    for path in paths:
+      ret[service][path] = _column(values[service][path])
+  return ret
+
+
+def log_frame(log_paths, fields, cache=True):
+  """Extracts fields, given as dotted paths like "carState.vEgo", from the events of
+  one log or a list of logs into contiguous numpy arrays. Returns a dict per service
+  mapping every field path, and logMonoTime, to its column. Enums are read as their
+  names, list and Data fields as object arrays with one entry per event. Columns are
+  cached on disk per segment, so only fields that were never extracted before require
+  reading the log."""
+  if isinstance(log_paths, str):
+    log_paths = [log_paths]
+  by_service = _parse_fields(fields)
+
+  segments = []
+  for fn in log_paths:
+    if fn is None:
+      continue
+
+    seg = {}
+    missing = {}
+    for service, paths in by_service.items():
+      cached = _load_cached(fn, service, [TIME_COLUMN] + paths) if cache else None
+      if cached is None:
+        missing[service] = paths
+      else:
+        seg[service] = cached
+
+    if len(missing):
+      extracted = _extract(fn, missing)
+      if cache:
+        for service, segment_columns in extracted.items():
+          _save_cached(fn, service, segment_columns)
+      seg.update(extracted)
+    segments.append(seg)
+
+  frame = {}
+  for service, paths in by_service.items():
+    frame[service] = {}
+    for column in [TIME_COLUMN] + paths:
+      arrs = [seg[service][column] for seg in segments if len(seg[service][column])]
+      if len(arrs):
+        frame[service][column] = np.concatenate(arrs)
+      else:
+        frame[service][column] = np.array([], dtype=np.uint64 if column == TIME_COLUMN else np.float64)
+  return frame
+
+
+if __name__ == "__main__":
+  frame = log_frame(sys.argv[1], sys.argv[2:])
+  for service, columns in frame.items():
+    for column, arr in columns.items():
+      print(f"{service}.{column}", arr.dtype, arr.shape)
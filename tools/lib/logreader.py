@@ -2,54 +2,537 @@
 import os
 import sys
 import bz2
+import mmap
+import heapq
+import struct
 import urllib.parse
+from array import array
+from bisect import bisect_left
+from itertools import accumulate, islice
 import capnp
+import numpy as np
 
+from common.file_helpers import mkdirs_exists_ok, atomic_write_in_dir
+from tools.lib import log_cache, parallel_bz2
+from tools.lib.exceptions import DataUnreadableError
 from tools.lib.filereader import FileReader
+from tools.lib.url_file import CACHE_DIR, hash_256
 from cereal import log as capnp_log
 
+# streaming mode reads and decompresses the log this many bytes at a time
+STREAM_CHUNK_SIZE = 1024 * 1024
+# number of events buffered to restore time order when streaming with sort_by_time
+STREAM_SORT_WINDOW = 4096
+
+# layout of the Event union discriminant, used to filter by service without decoding
+_EVENT_STRUCT = capnp_log.Event.schema.node.struct
+EVENT_WHICH_OFFSET = _EVENT_STRUCT.discriminantOffset * 2
+EVENT_WHICH_VALUES = {f.name: f.discriminantValue for f in _EVENT_STRUCT.fields if f.discriminantValue != 0xffff}
+EVENT_MONO_TIME_OFFSET = next(f.slot.offset * 8 for f in _EVENT_STRUCT.fields if f.name == "logMonoTime")
+# discriminant used for events of a type the schema doesn't know
+EVENT_WHICH_UNKNOWN = 0xffff
+# segment count - 1 and size of the first segment
+_SEGMENT_TABLE = struct.Struct("<II")
+
+LOG_INDEX_MAGIC = b"LIDX"
+LOG_INDEX_VERSION = 2
+LOG_INDEX_HEADER = struct.Struct("<4sIQQQ")
+
+
+def _capnp_message_size(dat, offset=0):
+  # returns the size in bytes of the framed capnp message at offset,
+  # or None if dat is too short to hold its segment table
+  if len(dat) - offset < 4:
+    return None
+  num_segments = struct.unpack_from("<I", dat, offset)[0] + 1
+  header_size = (4 + 4 * num_segments + 7) & ~7
+  if len(dat) - offset < header_size:
+    return None
+  segment_sizes = struct.unpack_from(f"<{num_segments}I", dat, offset + 4)
+  return header_size + 8 * sum(segment_sizes)
+
+
+def _root_data(dat, offset=0):
+  # returns the position and size of the root struct's data section of the
+  # message at offset, or None if the root is behind a far pointer
+  num_segments = struct.unpack_from("<I", dat, offset)[0] + 1
+  root = offset + ((4 + 4 * num_segments + 7) & ~7)
+  ptr_offset, data_words = struct.unpack_from("<iH", dat, root)
+  if ptr_offset & 3 != 0:
+    return None
+  return root + 8 + (ptr_offset >> 2) * 8, data_words * 8
+
+
+def _event_which(dat, offset=0):
+  # returns the union discriminant of the Event at offset, reading only the
+  # segment table and the root struct pointer, or None if it can't be found
+  root_data = _root_data(dat, offset)
+  if root_data is None:
+    return None
+  data, data_size = root_data
+  if EVENT_WHICH_OFFSET + 2 > data_size:
+    return 0
+  return struct.unpack_from("<H", dat, data + EVENT_WHICH_OFFSET)[0]
+
+
+def _event_mono_time(dat, offset=0):
+  root_data = _root_data(dat, offset)
+  if root_data is None:
+    return None
+  data, data_size = root_data
+  if EVENT_MONO_TIME_OFFSET + 8 > data_size:
+    return 0
+  return struct.unpack_from("<Q", dat, data + EVENT_MONO_TIME_OFFSET)[0]
+
+
+def _decoded_which(dat, offset=0):
+  # union discriminant of the Event at offset, decoding it
+  size = _capnp_message_size(dat, offset)
+  try:
+    return EVENT_WHICH_VALUES[capnp_log.Event.from_bytes(dat[offset:offset + size]).which()]
+  except capnp.lib.capnp.KjException:
+    # not a type this schema knows about
+    return None
+
+
+def _message_mono_time(dat, offset=0):
+  t = _event_mono_time(dat, offset)
+  if t is None:
+    size = _capnp_message_size(dat, offset)
+    t = capnp_log.Event.from_bytes(dat[offset:offset + size]).logMonoTime
+  return t
+
+
+def _services_filter(services):
+  if services is None:
+    return None
+  unknown = set(services) - set(EVENT_WHICH_VALUES)
+  if len(unknown):
+    raise ValueError(f"unknown services {sorted(unknown)}")
+  return frozenset(EVENT_WHICH_VALUES[s] for s in services)
+
+
+def _wanted(dat, offset, which):
+  if which is None:
+    return True
+  w = _event_which(dat, offset)
+  if w is None:
+    # the root is behind a far pointer
+    w = _decoded_which(dat, offset)
+  return w in which
+
+
+def _split_messages(dat, which=None):
+  # yields the bytes of every capnp message in dat whose discriminant is in which
+  pos = 0
+  while pos < len(dat):
+    size = _capnp_message_size(dat, pos)
+    if size is None or pos + size > len(dat):
+      raise DataUnreadableError(f"truncated message at offset {pos}")
+    if _wanted(dat, pos, which):
+      yield dat[pos:pos + size]
+    pos += size
+
+
+def _read_chunks(f):
+  while True:
+    dat = f.read(STREAM_CHUNK_SIZE)
+    if len(dat) == 0:
+      break
+    yield dat
+
+
+def _bz2_chunks(f):
+  # handles concatenated bz2 streams like bz2.decompress does
+  decomp = bz2.BZ2Decompressor()
+  started, finished = False, False
+  while True:
+    if decomp.eof:
+      dat = decomp.unused_data
+      decomp = bz2.BZ2Decompressor()
+      started, finished = False, True
+    elif decomp.needs_input:
+      dat = b""
+    else:
+      dat = None
+
+    if dat is not None:
+      if len(dat) == 0:
+        dat = f.read(STREAM_CHUNK_SIZE)
+      if len(dat) == 0:
+        if started:
+          raise ValueError("Compressed data ended before the end-of-stream marker was reached")
+        break
+      started = True
+
+    try:
+      yield decomp.decompress(b"" if dat is None else dat, max_length=STREAM_CHUNK_SIZE)
+    except OSError:
+      if finished:
+        # leftover data after a complete stream isn't a bz2 stream, ignored like bz2.decompress does
+        break
+      raise
+
+
+def _stream_messages(fn, which=None):
+  # yields the bytes of every capnp message in the log, decompressing incrementally
+  _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
+  if ext == "":
+    chunk_fn = _read_chunks
+  elif ext == ".bz2":
+    chunk_fn = _bz2_chunks
+  else:
+    raise Exception(f"unknown extension {ext}")
+
+  buf = b""
+  with FileReader(fn) as f:
+    for chunk in chunk_fn(f):
+      buf += chunk
+      pos = 0
+      while True:
+        size = _capnp_message_size(buf, pos)
+        if size is None or pos + size > len(buf):
+          break
+        if _wanted(buf, pos, which):
+          yield buf[pos:pos + size]
+        pos += size
+      buf = buf[pos:]
+
+  if len(buf):
+    raise DataUnreadableError(f"{fn} ends with a truncated message ({len(buf)} bytes)")
+
+
+def _sort_window(ents, window):
+  # restores time order of events that are at most window events out of place
+  heap = []
+  for i, ent in enumerate(ents):
+    heapq.heappush(heap, (ent.logMonoTime, i, ent))
+    if len(heap) > window:
+      yield heapq.heappop(heap)[2]
+  while heap:
+    yield heapq.heappop(heap)[2]
+
+
+def _map_file(path):
+  # read only shared mapping, so processes reading the same log share the page cache
+  with open(path, "rb") as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return b""
+    return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def _decompressed_data(fn, cache=False, workers=None):
+  # returns the decompressed log, as a view into a mapping of the file
+  # for uncompressed local logs and cache hits. workers is the number of
+  # threads decompressing bz2 blocks, cpu_count by default
+  _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
+  if ext not in ("", ".bz2"):
+    raise Exception(f"unknown extension {ext}")
+
+  if ext == "" and urllib.parse.urlparse(fn).scheme == "":
+    return _map_file(fn)
+
+  cache = cache and ext == ".bz2"
+  if cache:
+    path = log_cache.lookup(fn)
+    if path is not None:
+      try:
+        return _map_file(path)
+      except FileNotFoundError:
+        # evicted by another process
+        pass
+
+  with FileReader(fn) as f:
+    dat = f.read()
+
+  if ext == ".bz2":
+    dat = parallel_bz2.decompress(dat, workers)
+    if cache:
+      log_cache.write(fn, dat)
+  # old rlogs weren't bz2 compressed
+  return dat
+
+
+def _message_offsets(dat):
+  # offset of every capnp message in dat, single segment messages take the fast path
+  offsets = array('Q')
+  unpack_from = _SEGMENT_TABLE.unpack_from
+  end = len(dat)
+  pos = 0
+  while pos < end:
+    size = None
+    if end - pos >= 8:
+      num_segments_minus1, segment_size = unpack_from(dat, pos)
+      size = 8 + 8 * segment_size if num_segments_minus1 == 0 else _capnp_message_size(dat, pos)
+    if size is None or pos + size > end:
+      raise DataUnreadableError(f"truncated message at offset {pos}")
+    offsets.append(pos)
+    pos += size
+  return np.frombuffer(offsets, dtype=np.uint64).astype(np.int64)
+
+
+def _message_columns(dat):
+  # offset, size, logMonoTime and union discriminant of every message in dat.
+  # Messages are word aligned, so their root pointers and data sections are read for
+  # all of them at once, only roots behind far pointers are decoded
+  offsets = _message_offsets(dat)
+  if len(offsets) == 0:
+    return offsets, offsets, offsets.astype(np.uint64), offsets.astype(np.uint16)
+  sizes = np.diff(offsets, append=len(dat))
+  words = np.frombuffer(dat, dtype='<u8', count=len(dat) // 8)
+
+  num_segments = words.view('<u4')[offsets // 4].astype(np.int64) + 1
+  root = offsets // 8 + (4 + 4 * num_segments + 7) // 8
+  ptr = words[root]
+  data = root + 1 + ((ptr & 0xffffffff).astype(np.uint32).view(np.int32) >> 2)
+  data_size = ((ptr >> 32) & 0xffff).astype(np.int64) * 8
+  near = ((ptr & 3) == 0) & (data * 8 >= offsets) & (data * 8 + data_size <= offsets + sizes)
+
+  has_which = near & (data_size >= EVENT_WHICH_OFFSET + 2)
+  whiches = np.where(has_which, words.view('<u2')[np.where(has_which, data * 4 + EVENT_WHICH_OFFSET // 2, 0)], 0)
+  has_time = near & (data_size >= EVENT_MONO_TIME_OFFSET + 8)
+  ts = np.where(has_time, words[np.where(has_time, data + EVENT_MONO_TIME_OFFSET // 8, 0)], 0)
+
+  for i in np.flatnonzero(~near):
+    w = _decoded_which(dat, int(offsets[i]))
+    whiches[i] = EVENT_WHICH_UNKNOWN if w is None else w
+    ts[i] = _message_mono_time(dat, int(offsets[i]))
+  return offsets, sizes, ts, whiches.astype(np.uint16)
+
+
+def _message_table(dat, which=None, sort_by_time=False):
+  # offset, size and logMonoTime of every message in dat whose discriminant is in which,
+  # and the time of the first message of all of them, or the earliest with sort_by_time
+  offsets, sizes, ts, whiches = _message_columns(dat)
+  if len(offsets) == 0:
+    return offsets, sizes, ts, None
+
+  start_time = int(ts.min() if sort_by_time else ts[0])
+  if which is not None:
+    keep = np.isin(whiches, list(which))
+    offsets, sizes, ts = offsets[keep], sizes[keep], ts[keep]
+  return offsets, sizes, ts, start_time
+
+
+def _stream_start_time(fn, sort_by_time=False):
+  # time of the first message in the log, or the first a stream mode LogReader
+  # without a services filter yields with sort_by_time
+  ts = (_message_mono_time(dat) for dat in _stream_messages(fn))
+  if sort_by_time:
+    return min(islice(ts, STREAM_SORT_WINDOW + 1), default=None)
+  return next(ts, None)
+
+
+class _LazyEvents:
+  """Sequence of the events in a decompressed log, the capnp reader
+  for an event is only created when it is accessed."""
+
+  def __init__(self, dat, offsets, sizes):
+    # readers are created over views of dat, nothing is copied
+    self._view = memoryview(dat)
+    self._offsets = offsets
+    self._sizes = sizes
+
+  def __len__(self):
+    return len(self._offsets)
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self[j] for j in range(*i.indices(len(self)))]
+    offset = self._offsets[i]
+    return capnp_log.Event.from_bytes(self._view[offset:offset + self._sizes[i]])
+
+  def __iter__(self):
+    for offset, size in zip(self._offsets, self._sizes):
+      yield capnp_log.Event.from_bytes(self._view[offset:offset + size])
+
+
+def _source_stat(fn):
+  # only local files are checked for changes, uploaded logs never change
+  if urllib.parse.urlparse(fn).scheme in ("", "file"):
+    st = os.stat(fn)
+    return st.st_size, st.st_mtime_ns
+  return 0, 0
+
+
+def log_index_path(fn):
+  return os.path.join(CACHE_DIR, hash_256(fn) + "_logindex")
+
+
+class LogIndex:
+  """logMonoTime, offset into the decompressed log and service of every event
+  in a log, in file order. Built once per log and cached next to the download
+  cache, so scrubbing through a route doesn't require decoding anything."""
+
+  def __init__(self, ts, offsets, which, source_stat=(0, 0)):
+    self.ts = ts
+    self.offsets = offsets
+    self.which = which
+    self.source_stat = source_stat
+
+  def __len__(self):
+    return len(self.ts)
+
+  @classmethod
+  def build(cls, fn, cache=None):
+    # the decompressed log is cached as well, so a LogReader opened after this doesn't decompress it again
+    dat = _decompressed_data(fn, log_cache.cache_enabled(cache))
+    offsets, _, ts, which = _message_columns(dat)
+    return cls(array('Q', ts.astype(np.uint64).tobytes()), array('Q', offsets.astype(np.uint64).tobytes()),
+               array('H', which.tobytes()), _source_stat(fn))
+
+  @classmethod
+  def load(cls, path):
+    with open(path, "rb") as f:
+      dat = f.read()
+    if len(dat) < LOG_INDEX_HEADER.size:
+      return None
+    magic, version, count, source_size, source_mtime = LOG_INDEX_HEADER.unpack_from(dat)
+    if magic != LOG_INDEX_MAGIC or version != LOG_INDEX_VERSION or len(dat) != LOG_INDEX_HEADER.size + 18 * count:
+      return None
+
+    ts, offsets, which = array('Q'), array('Q'), array('H')
+    pos = LOG_INDEX_HEADER.size
+    for arr in (ts, offsets, which):
+      size = arr.itemsize * count
+      arr.frombytes(dat[pos:pos + size])
+      pos += size
+    return cls(ts, offsets, which, (source_size, source_mtime))
+
+  def save(self, path):
+    with atomic_write_in_dir(path, mode="wb", overwrite=True) as f:
+      f.write(LOG_INDEX_HEADER.pack(LOG_INDEX_MAGIC, LOG_INDEX_VERSION, len(self), *self.source_stat))
+      f.write(self.ts.tobytes())
+      f.write(self.offsets.tobytes())
+      f.write(self.which.tobytes())
+
+  def service_offsets(self, service):
+    # offsets into the decompressed log of every event of one service
+    w = EVENT_WHICH_VALUES[service]
+    return array('Q', (o for o, x in zip(self.offsets, self.which) if x == w))
+
+  def event_times(self, which=None, sort_by_time=False):
+    # times of the events a LogReader with the same arguments holds, in the same order
+    ts = self.ts if which is None else array('Q', (t for t, x in zip(self.ts, self.which) if x in which))
+    return array('Q', sorted(ts)) if sort_by_time else ts
+
+
+def get_log_index(fn, cache=None):
+  path = log_index_path(fn)
+  if os.path.exists(path):
+    index = LogIndex.load(path)
+    # local logs are checked for changes by size and mtime, like the decompressed log cache
+    if index is not None and index.source_stat == _source_stat(fn):
+      return index
+
+  index = LogIndex.build(fn, cache)
+  # kept and evicted alongside the downloads, so only when those are cached
+  if log_cache.cache_enabled(cache):
+    mkdirs_exists_ok(CACHE_DIR)
+    index.save(path)
+  return index
+
+
 # this is an iterator itself, and uses private variables from LogReader
 class MultiLogIterator:
-  def __init__(self, log_paths, sort_by_time=False):
+  def __init__(self, log_paths, sort_by_time=False, stream=False, services=None):
     self._log_paths = log_paths
     self.sort_by_time = sort_by_time
+    self.stream = stream
+    self.services = services
 
     self._first_log_idx = next(i for i in range(len(log_paths)) if log_paths[i] is not None)
     self._current_log = self._first_log_idx
     self._idx = 0
     self._log_readers = [None]*len(log_paths)
-    self.start_time = self._log_reader(self._first_log_idx)._ts[0]
+    self._log_max_times = [None]*len(log_paths)
+
+    if self.stream:
+      self._stream_seek_log(self._current_log)
+      # from all events, so it doesn't depend on services
+      self.start_time = _stream_start_time(log_paths[self._first_log_idx], sort_by_time)
+    else:
+      self.start_time = self._log_reader(self._first_log_idx)._start_time
 
   def _log_reader(self, i):
     if self._log_readers[i] is None and self._log_paths[i] is not None:
       log_path = self._log_paths[i]
-      self._log_readers[i] = LogReader(log_path, sort_by_time=self.sort_by_time)
+      self._log_readers[i] = LogReader(log_path, sort_by_time=self.sort_by_time, services=self.services)
 
     return self._log_readers[i]
 
+  def _seek_idx(self, i, ts):
+    # index of the first event at or after ts, in the same order _inc walks them.
+    # Only the log seeked into is loaded, it's read by the next __next__ anyway
+    if self._log_max_times[i] is None:
+      self._log_max_times[i] = list(accumulate(self._log_reader(i)._ts, max))
+    return bisect_left(self._log_max_times[i], self.start_time + ts * 1e9)
+
   def __iter__(self):
     return self
 
+  def _stream_seek_log(self, i):
+    # in stream mode only the current log is open, and the next event is kept
+    # around so tell() can report its time
+    self._current_log = i
+    self._stream_ents = iter(LogReader(self._log_paths[i], sort_by_time=self.sort_by_time, stream=True, services=self.services))
+    self._stream_next_ent = None
+    self._stream_inc()
+
+  def _stream_inc(self):
+    while True:
+      self._stream_next_ent = next(self._stream_ents, None)
+      if self._stream_next_ent is not None:
+        return
+
+      self._current_log = next(i for i in range(self._current_log + 1, len(self._log_paths) + 1)
+                               if i == len(self._log_paths) or self._log_paths[i] is not None)
+      if self._current_log == len(self._log_paths):
+        self._stream_ents = iter(())
+        return
+      self._stream_ents = iter(LogReader(self._log_paths[self._current_log], sort_by_time=self.sort_by_time, stream=True, services=self.services))
+
+  def _at_end(self):
+    return self._current_log == len(self._log_readers)
+
   def _inc(self):
-    lr = self._log_reader(self._current_log)
-    if self._idx < len(lr._ents)-1:
+    # past the last event, _current_log is len(self._log_readers)
+    if self._idx < len(self._log_reader(self._current_log)._ts)-1:
       self._idx += 1
     else:
       self._idx = 0
       self._current_log = next(i for i in range(self._current_log + 1, len(self._log_readers) + 1)
                                if i == len(self._log_readers) or self._log_paths[i] is not None)
-      if self._current_log == len(self._log_readers):
-        raise StopIteration
 
   def __next__(self):
+    if self.stream:
+      ret = self._stream_next_ent
+      if ret is None:
+        raise StopIteration
+      self._stream_inc()
+      return ret
+
     while 1:
+      if self._at_end():
+        raise StopIteration
       lr = self._log_reader(self._current_log)
+      if len(lr._ents) == 0:
+        # nothing left after filtering by service
+        self._inc()
+        continue
       ret = lr._ents[self._idx]
       self._inc()
       return ret
 
   def tell(self):
     # returns seconds from start of log
+    if self.stream:
+      if self._stream_next_ent is None:
+        raise StopIteration
+      return (self._stream_next_ent.logMonoTime - self.start_time) * 1e-9
+    if self._at_end():
+      raise StopIteration
+    # the current log is loaded by the next __next__ anyway
     return (self._log_reader(self._current_log)._ts[self._idx] - self.start_time) * 1e-9
 
   def seek(self, ts):
@@ -58,38 +541,62 @@ class MultiLogIterator:
     if minute >= len(self._log_paths) or self._log_paths[minute] is None:
       return False
 
-    self._current_log = minute
+    if self.stream:
+      self._stream_seek_log(minute)
+      while self._stream_next_ent is not None and self.tell() < ts:
+        self._stream_inc()
+      return True
 
-    # HACK: O(n) seek afterward
-    self._idx = 0
-    while self.tell() < ts:
+    self._current_log = minute
+    self._idx = self._seek_idx(minute, ts)
+    while self._idx == len(self._log_reader(self._current_log)._ts):
+      # every event in this log is before ts, continue in the next one
+      self._idx = len(self._log_reader(self._current_log)._ts) - 1
       self._inc()
+      if self._at_end():
+        break
+      self._idx = self._seek_idx(self._current_log, ts)
     return True
 
 
 class LogReader:
-  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False):
-    data_version = None
-    _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
-    with FileReader(fn) as f:
-      dat = f.read()
+  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False, stream=False, services=None, cache=None):
+    self._fn = fn
+    self._sort_by_time = sort_by_time
+    self._only_union_types = only_union_types
+    self.data_version = None
 
-    if ext == "":
-      # old rlogs weren't bz2 compressed
-      ents = capnp_log.Event.read_multiple_bytes(dat)
-    elif ext == ".bz2":
-      dat = bz2.decompress(dat)
-      ents = capnp_log.Event.read_multiple_bytes(dat)
-    else:
-      raise Exception(f"unknown extension {ext}")
+    # only events of these types are decoded, the rest are skipped
+    # after reading their union discriminant
+    self._which = _services_filter(services)
 
-    self._ents = list(sorted(ents, key=lambda x: x.logMonoTime) if sort_by_time else ents)
-    self._ts = [x.logMonoTime for x in self._ents]
-    self.data_version = data_version
-    self._only_union_types = only_union_types
+    # stream mode keeps no events around, the log is decompressed and parsed
+    # incrementally every time it is iterated over
+    self.stream = stream
+    if self.stream:
+      return
+
+    # decompressed logs are cached on disk when downloads are
+    dat = _decompressed_data(fn, log_cache.cache_enabled(cache))
+
+    # events are kept as one buffer plus their offsets and times, instead of a reader per event
+    offsets, sizes, ts, self._start_time = _message_table(dat, self._which, sort_by_time)
+    if sort_by_time:
+      order = np.argsort(ts, kind="stable")
+      offsets, sizes, ts = offsets[order], sizes[order], ts[order]
+
+    self._ents = _LazyEvents(dat, array('Q', offsets.astype(np.uint64).tobytes()), array('Q', sizes.astype(np.uint64).tobytes()))
+    self._ts = array('Q', ts.astype(np.uint64).tobytes())
+
+  def _stream_ents(self):
+    ents = (capnp_log.Event.from_bytes(dat) for dat in _stream_messages(self._fn, self._which))
+    if self._sort_by_time:
+      ents = _sort_window(ents, STREAM_SORT_WINDOW)
+    return ents
 
   def __iter__(self):
-    for ent in self._ents:
+    ents = self._stream_ents() if self.stream else self._ents
+    for ent in ents:
       if self._only_union_types:
         try:
           ent.which()
@@ -0,0 +1,73 @@
+import os
+import bz2
+from concurrent.futures import ThreadPoolExecutor
+
+# bz2 blocks and the end of stream marker are identified by these 48 bit
+# magic numbers, which are not byte aligned
+BLOCK_MAGIC = 0x314159265359
+EOS_MAGIC = 0x177245385090
+MAGIC_MASK = (1 << 48) - 1
+
+
+def _find_bit_pattern(dat, magic):
+  # returns the bit offsets of every occurrence of the 48 bit magic in dat
+  positions = []
+  for shift in range(8):
+    # the bytes of an 8 byte window that are fully covered by the magic when it starts shift bits in
+    window = (magic << (16 - shift)).to_bytes(8, "big")
+    first = 0 if shift == 0 else 1
+    needle = window[first:6]
+
+    pos = dat.find(needle)
+    while pos != -1:
+      bit = (pos - first) * 8 + shift
+      if bit >= 0:
+        b0, b1 = bit // 8, (bit + 48 + 7) // 8
+        val = int.from_bytes(dat[b0:b1], "big") >> (b1 * 8 - bit - 48)
+        if val & MAGIC_MASK == magic:
+          positions.append(bit)
+      pos = dat.find(needle, pos + 1)
+  return sorted(positions)
+
+
+def _decompress_block(dat, start, end):
+  # wraps the block between bit offsets start and end in its own single block
+  # stream, whose combined crc is just the block crc
+  b0, b1 = start // 8, (end + 7) // 8
+  nbits = end - start
+  block = (int.from_bytes(dat[b0:b1], "big") >> (b1 * 8 - end)) & ((1 << nbits) - 1)
+  crc = (block >> (nbits - 80)) & 0xffffffff
+
+  total = nbits + 80
+  pad = -total % 8
+  stream = ((block << 80) | (EOS_MAGIC << 32) | crc) << pad
+  return bz2.decompress(b"BZh9" + stream.to_bytes((total + pad) // 8, "big"))
+
+
+def decompress(dat, workers=None):
+  """Same as bz2.decompress, but decompresses the blocks of the stream in parallel like pbzip2."""
+  if not dat.startswith(b"BZh"):
+    return bz2.decompress(dat)
+
+  blocks = _find_bit_pattern(dat, BLOCK_MAGIC)
+  ends = _find_bit_pattern(dat, EOS_MAGIC)
+  if len(blocks) < 2 or len(ends) == 0 or ends[-1] < blocks[-1]:
+    return bz2.decompress(dat)
+
+  # every block ends where the next block or end of stream marker starts
+  markers = sorted(blocks + ends)
+  spans = []
+  block_set = set(blocks)
+  for i, m in enumerate(markers[:-1]):
+    if m in block_set:
+      spans.append((m, markers[i + 1]))
+
+  workers = workers if workers is not None else os.cpu_count()
+  try:
+    # bz2 releases the GIL while decompressing, so threads run in parallel
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+      return b"".join(pool.map(lambda s: _decompress_block(dat, *s), spans))
+  except (OSError, ValueError, EOFError):
+    # a magic number showed up inside compressed data, or the file is corrupt.
+    # the serial path either succeeds or raises the usual error
+    return bz2.decompress(dat)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+import os
+import sys
+import heapq
+import multiprocessing
+from array import array
+from collections import deque
+
+from tools.lib.log_cache import cache_enabled
+from tools.lib.logreader import _decompressed_data, _event_mono_time, _services_filter, _split_messages
+from cereal import log as capnp_log
+
+# number of segments decoded ahead of the one being merged
+DEFAULT_PREFETCH = 4
+
+
+def _load_segment(fn, which):
+  # runs in a worker, returns the segment's messages sorted by time as one
+  # buffer, with the start offset and logMonoTime of every message.
+  # The pool already runs a worker per cpu, so bz2 blocks are decompressed serially
+  msgs = []
+  for dat in _split_messages(_decompressed_data(fn, cache_enabled(), workers=1), which):
+    t = _event_mono_time(dat)
+    if t is None:
+      t = capnp_log.Event.from_bytes(dat).logMonoTime
+    msgs.append((t, dat))
+  msgs.sort(key=lambda m: m[0])
+
+  ts, offsets = array('Q'), array('Q')
+  offset = 0
+  for t, dat in msgs:
+    ts.append(t)
+    offsets.append(offset)
+    offset += len(dat)
+  offsets.append(offset)
+  return b"".join(dat for _, dat in msgs), offsets, ts
+
+
+class ParallelLogReader:
+  """Reads the logs of a route on a process pool and yields their events in
+  logMonoTime order. At most prefetch segments are decoded ahead of the merge."""
+
+  def __init__(self, log_paths, services=None, workers=None, prefetch=DEFAULT_PREFETCH):
+    self._log_paths = [p for p in log_paths if p is not None]
+    self._which = _services_filter(services)
+    self._workers = workers if workers is not None else os.cpu_count()
+    self._prefetch = max(1, prefetch)
+
+  def __iter__(self):
+    with multiprocessing.Pool(min(self._workers, max(1, len(self._log_paths)))) as pool:
+      paths = iter(self._log_paths)
+      pending = deque()
+
+      def submit():
+        fn = next(paths, None)
+        if fn is not None:
+          pending.append(pool.apply_async(_load_segment, (fn, self._which)))
+
+      def next_segment():
+        if len(pending) == 0:
+          return None
+        seg = pending.popleft().get()
+        submit()
+        return seg
+
+      for _ in range(self._prefetch):
+        submit()
+
+      # k-way merge, a segment joins the heap once the merge reaches its first event
+      heap = []
+      segments = {}
+      seg_id = 0
+      seg = next_segment()
+      while True:
+        while seg is not None and (len(heap) == 0 or len(seg[2]) == 0 or seg[2][0] <= heap[0][0]):
+          if len(seg[2]):
+            segments[seg_id] = seg
+            heapq.heappush(heap, (seg[2][0], seg_id, 0))
+          seg_id += 1
+          seg = next_segment()
+
+        if len(heap) == 0:
+          break
+
+        _, i, idx = heapq.heappop(heap)
+        buf, offsets, ts = segments[i]
+        yield capnp_log.Event.from_bytes(memoryview(buf)[offsets[idx]:offsets[idx + 1]])
+
+        if idx + 1 < len(ts):
+          heapq.heappush(heap, (ts[idx + 1], i, idx + 1))
+        else:
+          del segments[i]
+
+
+if __name__ == "__main__":
+  import codecs
+  codecs.register_error("strict", codecs.backslashreplace_errors)
+  for msg in ParallelLogReader(sys.argv[1:]):
+    print(msg)
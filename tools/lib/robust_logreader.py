@@ -1,16 +1,84 @@
 #!/usr/bin/env python3
 import os
+import re
 import bz2
+import struct
 import urllib.parse
 import subprocess
-import tqdm
 import glob
 from tempfile import TemporaryDirectory
 import capnp
 
-from tools.lib.logreader import FileReader, LogReader
+from tools.lib import parallel_bz2
+from tools.lib.logreader import FileReader, LogReader, _capnp_message_size
 from cereal import log as capnp_log
 
+# a message starts with its segment count - 1, little endian
+FRAME_START = re.compile(rb"(?=[\x00-\x3f]\x00\x00\x00)")
+
+
+def _read_event(dat, pos):
+  # returns the event at pos and its size, or None if it can't be read
+  size = _capnp_message_size(dat, pos)
+  if size is None or pos + size > len(dat):
+    return None
+
+  # a null root pointer reads as a default Event, zeroed memory looks like that
+  root = pos + ((4 + 4 * (struct.unpack_from("<I", dat, pos)[0] + 1) + 7) & ~7)
+  if root + 8 > pos + size or dat[root:root + 8] == b"\x00" * 8:
+    return None
+
+  try:
+    ent = capnp_log.Event.from_bytes(dat[pos:pos + size])
+    ent.which()
+  except (capnp.lib.capnp.KjException, ValueError):
+    return None
+  if ent.logMonoTime == 0:
+    return None
+  return ent, size
+
+
+def _resync(dat, pos):
+  # finds the next position after pos where two consecutive messages can be read,
+  # the second one not logged before the first
+  for m in FRAME_START.finditer(dat, pos + 1):
+    r = _read_event(dat, m.start())
+    if r is None:
+      continue
+    end = m.start() + r[1]
+    if end == len(dat):
+      return m.start()
+    nxt = _read_event(dat, end)
+    if nxt is not None and nxt[0].logMonoTime >= r[0].logMonoTime:
+      return m.start()
+  return None
+
+
+def recover_events(dat):
+  """Returns the events in dat that survived corruption, in one forward pass
+  over the message framing. Reading resumes after every corrupt region."""
+  ents = []
+  skipped = 0
+  pos = 0
+  while pos < len(dat):
+    r = _read_event(dat, pos)
+    if r is None:
+      nxt = _resync(dat, pos)
+      if nxt is None:
+        # nothing readable left, the log is truncated
+        skipped += len(dat) - pos
+        break
+
+      skipped += nxt - pos
+      pos = nxt
+      continue
+
+    ents.append(r[0])
+    pos += r[1]
+
+  print(f"Recovered {len(ents)} events, skipped {skipped} corrupt bytes")
+  return ents
+
 
 class RobustLogReader(LogReader):
   def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False):  # pylint: disable=super-init-not-called
@@ -23,7 +91,7 @@ class RobustLogReader(LogReader):
       pass
     elif ext == ".bz2":
       try:
-        dat = bz2.decompress(dat)
+        dat = parallel_bz2.decompress(dat)
       except ValueError:
         print("Failed to decompress, falling back to bzip2recover")
         with TemporaryDirectory() as directory:
@@ -33,28 +101,26 @@ class RobustLogReader(LogReader):
           subprocess.check_call(["bzip2recover", "out.bz2"], cwd=directory)
 
           # Decompress and concatenate parts
-          dat = b""
+          parts = []
           for n in sorted(glob.glob(f"{directory}/rec*.bz2")):
             print(f"Decompressing {n}")
             with open(n, 'rb') as f:
-              dat += bz2.decompress(f.read())
+              parts.append(bz2.decompress(f.read()))
+          dat = b"".join(parts)
     else:
       raise Exception(f"unknown extension {ext}")
 
-    progress = None
-    while True:
-      try:
-        ents = capnp_log.Event.read_multiple_bytes(dat)
-        self._ents = list(sorted(ents, key=lambda x: x.logMonoTime) if sort_by_time else ents)
-        break
-      except capnp.lib.capnp.KjException:
-        if progress is None:
-          progress = tqdm.tqdm(total=len(dat))
+    try:
+      ents = list(capnp_log.Event.read_multiple_bytes(dat))
+    except capnp.lib.capnp.KjException:
+      print("Failed to parse log, recovering intact events")
+      ents = recover_events(dat)
 
-        # Cut off bytes at the end until capnp is able to read
-        dat = dat[:-1]
-        progress.update(1)
+    self._ents = list(sorted(ents, key=lambda x: x.logMonoTime) if sort_by_time else ents)
 
     self._ts = [x.logMonoTime for x in self._ents]
+    # every event is kept, so the first one is the start of the log
+    self._start_time = self._ts[0] if len(self._ts) else None
     self.data_version = data_version
     self._only_union_types = only_union_types
+    self.stream = False
@@ -1,11 +1,16 @@
 import os
 import re
+import json
+import time
 from urllib.parse import urlparse
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 
+from common.file_helpers import mkdirs_exists_ok, atomic_write_in_dir
 from tools.lib.auth_config import get_token
-from tools.lib.api import CommaApi
+from tools.lib.api import API_HOST, CommaApi
+from tools.lib.cache import DEFAULT_CACHE_DIR
 from tools.lib.helpers import RE
 
 QLOG_FILENAMES = ['qlog.bz2']
@@ -15,14 +20,27 @@ CAMERA_FILENAMES = ['fcamera.hevc', 'video.hevc']
 DCAMERA_FILENAMES = ['dcamera.hevc']
 ECAMERA_FILENAMES = ['ecamera.hevc']
 
+ROUTE_CACHE_DIR = os.path.join(DEFAULT_CACHE_DIR, "routes")
+# seconds the file list of a route is reused for, the urls in it are signed and expire
+ROUTE_CACHE_TTL = int(os.getenv("ROUTE_CACHE_TTL", "600"))
+
+def load_routes(names, data_dir=None, workers=8):
+  """Returns the Route of every name in names, looked up concurrently."""
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    return list(pool.map(lambda name: Route(name, data_dir), names))
+
+def _scan_dir(path):
+  with os.scandir(path) as it:
+    return list(it)
+
 class Route:
-  def __init__(self, name, data_dir=None):
+  def __init__(self, name, data_dir=None, cache=True):
     self._name = RouteName(name)
     self.files = None
     if data_dir is not None:
       self._segments = self._get_segments_local(data_dir)
     else:
-      self._segments = self._get_segments_remote()
+      self._segments = self._get_segments_remote(cache)
     self.max_seg_number = self._segments[-1].name.segment_num
 
   @property
@@ -57,11 +75,31 @@ class Route:
     qcamera_path_by_seg_num = {s.name.segment_num: s.qcamera_path for s in self._segments}
     return [qcamera_path_by_seg_num.get(i, None) for i in range(self.max_seg_number+1)]
 
-  # TODO: refactor this, it's super repetitive
-  def _get_segments_remote(self):
+  def _get_files_remote(self, cache):
+    # the file list is kept in a manifest per route, so opening a route again doesn't hit the api
+    cache_path = os.path.join(ROUTE_CACHE_DIR, self.name.canonical_name.replace('|', '_') + '.json')
+    if cache:
+      try:
+        with open(cache_path) as f:
+          manifest = json.load(f)
+        if manifest['api_host'] == API_HOST and 0 <= time.time() - manifest['time'] < ROUTE_CACHE_TTL:
+          return manifest['files']
+      except (FileNotFoundError, ValueError, KeyError):
+        pass
+
     api = CommaApi(get_token())
     route_files = api.get('v1/route/' + self.name.canonical_name + '/files')
-    self.files = list(chain.from_iterable(route_files.values()))
+    files = list(chain.from_iterable(route_files.values()))
+
+    if cache:
+      mkdirs_exists_ok(ROUTE_CACHE_DIR)
+      with atomic_write_in_dir(cache_path, mode='w', overwrite=True) as f:
+        json.dump({'time': time.time(), 'api_host': API_HOST, 'files': files}, f)
+    return files
+
+  # TODO: refactor this, it's super repetitive
+  def _get_segments_remote(self, cache=True):
+    self.files = self._get_files_remote(cache)
 
     segments = {}
     for url in self.files:
@@ -91,11 +129,13 @@ class Route:
     return sorted(segments.values(), key=lambda seg: seg.name.segment_num)
 
   def _get_segments_local(self, data_dir):
-    files = os.listdir(data_dir)
     segment_files = defaultdict(list)
 
-    for f in files:
-      fullpath = os.path.join(data_dir, f)
+    for entry in _scan_dir(data_dir):
+      f = entry.name
+      # everything belonging to the route starts with its dongle id, the rest isn't matched
+      if not f.startswith(self.name.dongle_id):
+        continue
       explorer_match = re.match(RE.EXPLORER_FILE, f)
       op_match = re.match(RE.OP_SEGMENT_DIR, f)
 
@@ -103,20 +143,20 @@ class Route:
         segment_name = explorer_match.group('segment_name')
         fn = explorer_match.group('file_name')
         if segment_name.replace('_', '|').startswith(self.name.canonical_name):
-          segment_files[segment_name].append((fullpath, fn))
-      elif op_match and os.path.isdir(fullpath):
+          segment_files[segment_name].append((entry.path, fn))
+      elif op_match and entry.is_dir():
         segment_name = op_match.group('segment_name')
         if segment_name.startswith(self.name.canonical_name):
-          for seg_f in os.listdir(fullpath):
-            segment_files[segment_name].append((os.path.join(fullpath, seg_f), seg_f))
+          for seg_f in _scan_dir(entry.path):
+            segment_files[segment_name].append((seg_f.path, seg_f.name))
       elif f == self.name.canonical_name:
-        for seg_num in os.listdir(fullpath):
-          if not seg_num.isdigit():
+        for seg_num in _scan_dir(entry.path):
+          if not seg_num.name.isdigit():
             continue
 
-          segment_name = f'{self.name.canonical_name}--{seg_num}'
-          for seg_f in os.listdir(os.path.join(fullpath, seg_num)):
-            segment_files[segment_name].append((os.path.join(fullpath, seg_num, seg_f), seg_f))
+          segment_name = f'{self.name.canonical_name}--{seg_num.name}'
+          for seg_f in _scan_dir(seg_num.path):
+            segment_files[segment_name].append((seg_f.path, seg_f.name))
 
     segments = []
     for segment, files in segment_files.items():
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+import sys
+import queue
+import threading
+
+from tools.lib.framereader import FrameIterator
+from tools.lib.logreader import LogReader
+
+# number of decoded frames buffered ahead of the log
+DEFAULT_PREFETCH = 40
+
+CAMERA_STATES = ("roadCameraState", "wideRoadCameraState", "driverCameraState")
+
+
+class _FramePrefetcher:
+  # decodes frames on a background thread, ffmpeg runs in its own process so
+  # this doesn't hold up parsing the log
+  _DONE = object()
+
+  def __init__(self, camera_path, pix_fmt, size, crop, prefetch):
+    self._queue = queue.Queue(maxsize=max(1, prefetch))
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._run, args=(camera_path, pix_fmt, size, crop), daemon=True)
+    self._thread.start()
+
+  def _put(self, item):
+    while not self._stop.is_set():
+      try:
+        self._queue.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def _run(self, camera_path, pix_fmt, size, crop):
+    frames = FrameIterator(camera_path, pix_fmt, size=size, crop=crop)
+    try:
+      for frame in frames:
+        if not self._put(frame):
+          return
+      self._put(self._DONE)
+    except Exception as e:
+      self._put(e)
+    finally:
+      frames.close()
+
+  def get(self):
+    """Returns the next frame, or None after the last one."""
+    item = self._queue.get()
+    if isinstance(item, Exception):
+      raise item
+    if item is self._DONE:
+      self._queue.put(item)
+      return None
+    return item
+
+  def close(self):
+    self._stop.set()
+    self._thread.join()
+
+
+class SegmentReader:
+  """Iterates over a segment's log and one of its videos together.
+
+  Yields (frame, camera_state_event, surrounding_events) in logMonoTime order, one
+  per camera state event of camera. surrounding_events holds the events logged
+  since the previous camera state event. The n-th camera state event belongs to
+  the n-th frame of the video, which is decoded ahead on a background thread.
+  """
+
+  def __init__(self, log_path, camera_path, camera="roadCameraState", services=None,
+               pix_fmt="yuv420p", size=None, crop=None, prefetch=DEFAULT_PREFETCH):
+    if camera not in CAMERA_STATES:
+      raise ValueError(f"camera has to be one of {CAMERA_STATES}")
+    self._log_path = log_path
+    self._camera_path = camera_path
+    self._camera = camera
+    self._services = None if services is None else sorted(set(services) | {camera})
+    self._pix_fmt = pix_fmt
+    self._size = size
+    self._crop = crop
+    self._prefetch = prefetch
+
+  def __iter__(self):
+    frames = _FramePrefetcher(self._camera_path, self._pix_fmt, self._size, self._crop, self._prefetch)
+    try:
+      surrounding = []
+      for msg in LogReader(self._log_path, sort_by_time=True, stream=True, services=self._services):
+        if msg.which() != self._camera:
+          surrounding.append(msg)
+          continue
+
+        frame = frames.get()
+        if frame is None:
+          # the log can have camera states for frames that didn't make it into the video
+          break
+        yield frame, msg, surrounding
+        surrounding = []
+    finally:
+      frames.close()
+
+
+if __name__ == "__main__":
+  for frame, camera_state, events in SegmentReader(sys.argv[1], sys.argv[2]):
+    print(getattr(camera_state, camera_state.which()).frameId, frame.shape, len(events))
@@ -1,10 +1,46 @@
 #!/usr/bin/env python3
 import os
+import re
+import asyncio
 import shutil
+import multiprocessing
+import threading
 import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 os.environ["COMMA_CACHE"] = "/tmp/__test_cache__"
-from tools.lib.url_file import URLFile, CACHE_DIR
+from tools.lib.url_file import URLFile, ChunkStore, CACHE_DIR, CHUNK_SIZE, READAHEAD_CHUNKS, cache_entries, prune_cache
+from tools.lib.async_url_file import AsyncURLFile
+
+
+def read_url(url, cache, ll=None):
+  with URLFile(url, cache=cache) as f:
+    return f.read(ll=ll)
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+  data = b""
+
+  def log_message(self, *args):
+    pass
+
+  def do_HEAD(self):
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(self.data)))
+    self.end_headers()
+
+  def do_GET(self):
+    m = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+    if m is None:
+      self.send_response(200)
+      body = self.data
+    else:
+      self.send_response(206)
+      body = self.data[int(m.group(1)):int(m.group(2)) + 1]
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
 
 
 class TestFileDownload(unittest.TestCase):
@@ -65,5 +101,127 @@ class TestFileDownload(unittest.TestCase):
     self.compare_loads(large_file_url)
 
 
+class TestLocalDownload(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    RangeRequestHandler.data = os.urandom(int(CHUNK_SIZE * 5.5))
+    cls.server = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+    threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+    cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}/fcamera.hevc"
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.server.shutdown()
+
+  def setUp(self):
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+
+  def test_parallel_reads(self):
+    data = RangeRequestHandler.data
+    for cache in (False, True):
+      for parallel in (1, 4):
+        for start, length in ((0, None), (10, 100), (CHUNK_SIZE - 10, 3 * CHUNK_SIZE), (len(data) - 100, 100)):
+          f = URLFile(self.url, cache=cache, parallel=parallel)
+          f.seek(start)
+          end = start + length if length is not None else len(data)
+          self.assertEqual(f.read(ll=length), data[start:end])
+
+  def test_readahead(self):
+    f = URLFile(self.url, cache=True)
+    f.read(ll=CHUNK_SIZE)
+    f.read(ll=CHUNK_SIZE)
+    for future in list(f._readahead.values()):
+      future.result()
+    self.assertEqual(len(cache_entries()), 3)  # data, index and length
+    self.assertEqual(sum(f._chunk_store().has(c) for c in range(6)), 6)
+    self.assertEqual(f.read(), RangeRequestHandler.data[2 * CHUNK_SIZE:])
+
+  def test_readahead_sequential(self):
+    data = RangeRequestHandler.data
+    with URLFile(self.url, cache=True) as f:
+      for start in range(0, len(data), CHUNK_SIZE):
+        self.assertEqual(f.read(ll=CHUNK_SIZE), data[start:start + CHUNK_SIZE])
+      # finished downloads are dropped, and never hold on to their data
+      self.assertLessEqual(len(f._readahead), READAHEAD_CHUNKS)
+      self.assertTrue(all(future.result() is None for future in f._readahead.values()))
+    self.assertEqual(len(f._readahead), 0)
+
+  def test_forked_reads(self):
+    data = RangeRequestHandler.data
+    # the parent's download pool has idle threads when the workers are forked
+    f = URLFile(self.url, cache=True)
+    f.read(ll=CHUNK_SIZE)
+    f.read(ll=CHUNK_SIZE)
+    for future in list(f._readahead.values()):
+      future.result()
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+    with multiprocessing.get_context("fork").Pool(2) as pool:
+      # fewer downloads than idle threads in the parent's pool
+      for cache in (False, True):
+        self.assertEqual(pool.apply_async(read_url, (self.url, cache, 2 * CHUNK_SIZE)).get(timeout=30), data[:2 * CHUNK_SIZE])
+
+  def test_corrupt_chunk(self):
+    data = RangeRequestHandler.data
+    f = URLFile(self.url, cache=True)
+    f.read(ll=CHUNK_SIZE)
+    with open(f._chunk_store().data_path, "r+b") as cached:
+      cached.write(b"garbage")
+    self.assertEqual(URLFile(self.url, cache=True).read(ll=CHUNK_SIZE), data[:CHUNK_SIZE])
+
+  def test_prune(self):
+    files = [URLFile(self.url.replace("fcamera", f"fcamera{i}"), cache=True) for i in range(3)]
+    for i, f in enumerate(files):
+      f.read(ll=CHUNK_SIZE)
+      os.utime(f._chunk_store().data_path, (i, i))
+    prune_cache(3 * CHUNK_SIZE)
+    paths = {path for _, _, path in cache_entries()}
+    self.assertNotIn(files[0]._chunk_store().data_path, paths)
+    self.assertIn(files[2]._chunk_store().data_path, paths)
+
+  def test_async_reads(self):
+    data = RangeRequestHandler.data
+
+    async def read(cache, start, length):
+      async with AsyncURLFile(self.url, cache=cache, parallel=4) as f:
+        f.seek(start)
+        return await f.read(ll=length)
+
+    async def main():
+      reads = [(start, length) for start, length in ((0, None), (10, 100), (CHUNK_SIZE - 10, 3 * CHUNK_SIZE), (len(data) - 100, 100))]
+      for cache in (False, True, True):
+        results = await asyncio.gather(*[read(cache, start, length) for start, length in reads])
+        for (start, length), result in zip(reads, results):
+          end = start + length if length is not None else len(data)
+          self.assertEqual(result, data[start:end])
+
+    asyncio.run(main())
+
+  def test_async_readahead(self):
+    data = RangeRequestHandler.data
+    threads = set()
+
+    def on_thread(fn):
+      def wrapper(*args):
+        threads.add(threading.current_thread())
+        return fn(*args)
+      return wrapper
+
+    async def main():
+      async with AsyncURLFile(self.url, cache=True) as f:
+        self.assertEqual(await f.read(ll=CHUNK_SIZE), data[:CHUNK_SIZE])
+        self.assertEqual(await f.read(ll=CHUNK_SIZE), data[CHUNK_SIZE:2 * CHUNK_SIZE])
+        await asyncio.gather(*f._readahead.values())
+        store = await f._chunk_store()
+        self.assertEqual(sum(store.has(c) for c in range(6)), 6)
+        self.assertEqual(await f.read(), data[2 * CHUNK_SIZE:])
+
+    # the chunk store's reads and writes checksum whole chunks, that's not done on the loop
+    with mock.patch.object(ChunkStore, "read_into", on_thread(ChunkStore.read_into)), \
+         mock.patch.object(ChunkStore, "write", on_thread(ChunkStore.write)):
+      asyncio.run(main())
+    self.assertGreater(len(threads), 0)
+    self.assertNotIn(threading.main_thread(), threads)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import os
+import fcntl
+import tempfile
+import threading
+import time
+import unittest
+import multiprocessing
+
+import numpy as np
+
+from tools.lib.frame_cache import FrameCache, SharedFrameArena, SharedFrameCache
+
+FRAME_SHAPE = (12, 16, 3)
+
+
+def frame(num):
+  return np.full(FRAME_SHAPE, num, dtype=np.uint8)
+
+
+def read_shared(name):
+  cache = SharedFrameCache(name)
+  try:
+    return [cache.get((num, "rgb24")) for num in range(4)]
+  finally:
+    cache.close()
+
+
+class TestFrameCache(unittest.TestCase):
+  def test_byte_budget(self):
+    cache = FrameCache(3 * frame(0).nbytes)
+    for num in range(4):
+      cache.put((num, "rgb24"), frame(num))
+    self.assertIsNone(cache.get((0, "rgb24")))
+    self.assertEqual(cache.size, 3 * frame(0).nbytes)
+
+    # reading a frame makes it the most recently used
+    cache.get((1, "rgb24"))
+    cache.put((4, "rgb24"), frame(4))
+    self.assertIsNotNone(cache.get((1, "rgb24")))
+    self.assertIsNone(cache.get((2, "rgb24")))
+
+  def test_shared(self):
+    name = SharedFrameCache.name_for_file(f"test_{os.getpid()}")
+    cache = SharedFrameCache(name, 3 * frame(0).nbytes)
+    try:
+      for num in range(4):
+        cache.put((num, "rgb24"), frame(num))
+
+      with multiprocessing.get_context("spawn").Pool(1) as pool:
+        frames = pool.apply(read_shared, (name,))
+      self.assertIsNone(frames[0])
+      for num in range(1, 4):
+        np.testing.assert_array_equal(frames[num], frame(num))
+      self.assertIsNone(cache.get((0, "yuv420p")))
+      self.assertIn((1, "rgb24"), cache)
+      self.assertNotIn((0, "rgb24"), cache)
+      self.assertNotIn((0, "yuv420p"), cache)
+    finally:
+      cache.close()
+    self.assertIsNone(SharedFrameCache(name).get((1, "rgb24")))
+    self.assertNotIn((1, "rgb24"), SharedFrameCache(name))
+    # looking up an arena that doesn't exist leaves no lock file behind
+    self.assertFalse(os.path.exists(os.path.join(tempfile.gettempdir(), f"{name}_rgb24.lock")))
+    self.assertFalse(os.path.exists(os.path.join(tempfile.gettempdir(), f"{name}_yuv420p.lock")))
+
+  def test_shared_lifetime(self):
+    # removed once every process that opened it has closed it, not when its creator does
+    name = SharedFrameCache.name_for_file(f"test_lifetime_{os.getpid()}")
+    lock_path = os.path.join(tempfile.gettempdir(), f"{name}_rgb24.lock")
+    creator, reader = SharedFrameCache(name), SharedFrameCache(name)
+    try:
+      creator.put((0, "rgb24"), frame(0))
+      self.assertIn((0, "rgb24"), reader)
+      creator.close()
+
+      with multiprocessing.get_context("spawn").Pool(1) as pool:
+        frames = pool.apply(read_shared, (name,))
+      np.testing.assert_array_equal(frames[0], frame(0))
+      np.testing.assert_array_equal(reader.get((0, "rgb24")), frame(0))
+      self.assertTrue(os.path.exists(lock_path))
+    finally:
+      reader.close()
+    self.assertFalse(os.path.exists(lock_path))
+    self.assertIsNone(SharedFrameCache(name).get((0, "rgb24")))
+
+  def test_stale_lock_file(self):
+    # a lock file opened just before the last process closes the arena isn't used
+    name = SharedFrameCache.name_for_file(f"test_stale_{os.getpid()}")
+    lock_path = os.path.join(tempfile.gettempdir(), f"{name}.lock")
+    arena = SharedFrameArena(name, FRAME_SHAPE)
+    arenas = []
+    fcntl.flock(arena.lock_file, fcntl.LOCK_EX)
+    t = threading.Thread(target=lambda: arenas.append(SharedFrameArena(name, FRAME_SHAPE)))
+    t.start()
+    time.sleep(0.2)
+    arena.close()
+    t.join()
+
+    arena = arenas[0]
+    try:
+      self.assertEqual(os.fstat(arena.lock_file.fileno()).st_ino, os.stat(lock_path).st_ino)
+      arena.put(0, frame(0))
+      self.assertIn(0, arena)
+    finally:
+      arena.close()
+    self.assertFalse(os.path.exists(lock_path))
+
+
+if __name__ == "__main__":
+  unittest.main()
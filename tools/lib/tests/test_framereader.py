@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from concurrent.futures import Future
+
+import numpy as np
+
+from tools.lib.framereader import DecoderPool, DecoderWorker, FrameReader, FrameType, OutputFormat, StreamFrameReader, \
+                                  StreamGOPReader, check_out, debayer, decoder_pool, decompress_video_data, \
+                                  decompress_video_data_once, frame_shape, frames_from_buffer, index_stream, \
+                                  read_index_cache, rgb24toyuv420, stream_index_data, write_index_cache
+from tools.lib.tests.test_hevc_index import SMALL_HEVC
+
+
+def decode_gop(gop):
+  return len(decoder_pool.idle), decompress_video_data(gop, "hevc", 66, 50, "yuv420p")
+
+
+YUV_FROM_RGB = np.array([[ 0.299     ,  0.587     ,  0.114      ],
+                         [-0.14714119, -0.28886916,  0.43601035 ],
+                         [ 0.61497538, -0.51496512, -0.10001026 ]])
+
+
+def float_rgb24toyuv420(rgb):
+  img = np.dot(rgb.reshape(-1, 3), YUV_FROM_RGB.T).reshape(rgb.shape)
+  ys = img[:, :, 0]
+  us = (img[::2, ::2, 1] + img[1::2, ::2, 1] + img[::2, 1::2, 1] + img[1::2, 1::2, 1]) / 4 + 128
+  vs = (img[::2, ::2, 2] + img[1::2, ::2, 2] + img[::2, 1::2, 2] + img[1::2, 1::2, 2]) / 4 + 128
+  return np.concatenate([ys.reshape(-1), us.reshape(-1), vs.reshape(-1)]).clip(0, 255)
+
+
+class TestFrameConversion(unittest.TestCase):
+  def setUp(self):
+    self.rng = np.random.default_rng(0)
+
+  def test_rgb24toyuv420(self):
+    rgb = self.rng.integers(0, 256, (3, 48, 64, 3), dtype=np.uint8)
+    yuv = rgb24toyuv420(rgb)
+    self.assertEqual(yuv.shape, (3, 48 * 64 * 3 // 2))
+    for i in range(len(rgb)):
+      np.testing.assert_allclose(yuv[i], float_rgb24toyuv420(rgb[i]), atol=1)
+      np.testing.assert_array_equal(rgb24toyuv420(rgb[i]), yuv[i])
+
+    out = np.empty_like(yuv)
+    self.assertIs(rgb24toyuv420(rgb, out=out), out)
+    np.testing.assert_array_equal(out, yuv)
+
+    white = np.full((2, 2, 3), 255, dtype=np.uint8)
+    np.testing.assert_array_equal(rgb24toyuv420(white), [255, 255, 255, 255, 128, 128])
+
+  def test_debayer(self):
+    raw = self.rng.integers(0, 256, (2, 960, 1280), dtype=np.uint8)
+    rgb = debayer(raw)
+    self.assertEqual(rgb.shape, (2, 480, 640, 3))
+    for i in range(len(raw)):
+      img = raw[i]
+      g = (img[0::2, 0::2].astype(np.uint16) + img[1::2, 1::2]) >> 1
+      expected = np.dstack([img[0::2, 1::2], g.astype(np.uint8), img[1::2, 0::2]])
+      np.testing.assert_array_equal(rgb[i], expected)
+      np.testing.assert_array_equal(debayer(img), expected)
+
+  def test_check_out(self):
+    self.assertEqual(frame_shape(64, 48, "rgb24"), (48, 64, 3))
+    self.assertEqual(frame_shape(64, 48, "yuv420p"), (64 * 48 * 3 // 2,))
+    check_out(np.empty((4, 48, 64, 3), dtype=np.uint8), 3, 64, 48, "rgb24")
+    with self.assertRaises(ValueError):
+      check_out(np.empty((2, 48, 64, 3), dtype=np.uint8), 3, 64, 48, "rgb24")
+    with self.assertRaises(ValueError):
+      check_out(np.empty((3, 48, 64, 3), dtype=np.float32), 3, 64, 48, "rgb24")
+    with self.assertRaises(ValueError):
+      check_out(np.empty((3, 48, 64, 3), dtype=np.uint8), 3, 64, 48, "yuv420p")
+
+  def test_output_format(self):
+    fmt = OutputFormat(1928, 1208, "rgb24")
+    self.assertEqual((fmt.w, fmt.h, fmt.vf, fmt.key), (1928, 1208, None, "rgb24"))
+
+    fmt = OutputFormat(1928, 1208, "yuv420p", size=(482, 302))
+    self.assertEqual((fmt.w, fmt.h, fmt.vf), (482, 302, "scale=482:302"))
+    fmt = OutputFormat(1928, 1208, "rgb24", size=(200, 100), crop=(100, 50, 400, 200))
+    self.assertEqual((fmt.w, fmt.h, fmt.vf), (200, 100, "crop=400:200:100:50,scale=200:100"))
+    self.assertNotEqual(fmt.key, OutputFormat(1928, 1208, "rgb24", size=(200, 100)).key)
+
+    with self.assertRaises(ValueError):
+      OutputFormat(1928, 1208, "rgb24", crop=(1900, 0, 100, 100))
+    with self.assertRaises(ValueError):
+      OutputFormat(1928, 1208, "yuv420p", size=(481, 302))
+    for crop in ((101, 50, 400, 200), (100, 51, 400, 200), (100, 50, 401, 200), (100, 50, 400, 201)):
+      with self.assertRaises(ValueError):
+        OutputFormat(1928, 1208, "rgb24", crop=crop)
+
+
+@unittest.skipIf(shutil.which("ffmpeg") is None, "ffmpeg not installed")
+class TestDecode(unittest.TestCase):
+  def setUp(self):
+    self.index_data = index_stream(SMALL_HEVC, "hevc", no_cache=True)
+
+  def test_decoder_worker(self):
+    gop_reader = StreamGOPReader(SMALL_HEVC, FrameType.h265_stream, self.index_data)
+    gops = [gop_reader.get_gop(int(frame_b))[3] for frame_b in gop_reader.gop_table[:, 0]]
+    expected = [decompress_video_data_once(gop, "hevc", 66, 50, "yuv420p") for gop in gops]
+    order = np.random.default_rng(0).integers(0, len(gops), 12)
+
+    #  One ffmpeg process decodes them all, in any order
+    worker = DecoderWorker("hevc", 66, 50, "yuv420p")
+    try:
+      for i in order:
+        np.testing.assert_array_equal(worker.decode(gops[i]), expected[i])
+    finally:
+      worker.close()
+
+    pool = DecoderPool()
+    try:
+      for i in order:
+        np.testing.assert_array_equal(pool.decode(gops[i], "hevc", 66, 50, "yuv420p"), expected[i])
+      self.assertEqual(len(pool.idle[("hevc", 66, 50, "yuv420p", None)]), 1)
+    finally:
+      for workers in pool.idle.values():
+        for w in workers:
+          w.close()
+
+  def test_read_only(self):
+    for dat in (bytes(66 * 50 * 3), bytearray(66 * 50 * 3)):
+      self.assertFalse(frames_from_buffer(dat, 66, 50, "rgb24").flags.writeable)
+    gop_reader = StreamGOPReader(SMALL_HEVC, FrameType.h265_stream, self.index_data)
+    gop = gop_reader.get_gop(0)[3]
+    self.assertFalse(decompress_video_data(gop, "hevc", 66, 50, "yuv420p").flags.writeable)
+    with FrameReader(SMALL_HEVC, index_data=self.index_data) as fr:
+      frame = fr.get(3)[0]
+      self.assertFalse(frame.flags.writeable)
+      with self.assertRaises(ValueError):
+        frame[0] = 0
+
+  def test_forked_decode(self):
+    gop_reader = StreamGOPReader(SMALL_HEVC, FrameType.h265_stream, self.index_data)
+    gops = [gop_reader.get_gop(int(frame_b))[3] for frame_b in gop_reader.gop_table[:, 0]]
+    expected = [decompress_video_data_once(gop, "hevc", 66, 50, "yuv420p") for gop in gops]
+
+    #  The parent's idle worker isn't shared with the child, both keep decoding
+    np.testing.assert_array_equal(decompress_video_data(gops[0], "hevc", 66, 50, "yuv420p"), expected[0])
+    self.assertGreater(sum(len(w) for w in decoder_pool.idle.values()), 0)
+    with multiprocessing.get_context("fork").Pool(1) as pool:
+      idle, frames = pool.apply_async(decode_gop, (gops[1],)).get(timeout=30)
+      self.assertEqual(idle, 0)
+      np.testing.assert_array_equal(frames, expected[1])
+      for i in (2, 0):
+        np.testing.assert_array_equal(pool.apply_async(decode_gop, (gops[i],)).get(timeout=30)[1], expected[i])
+    for i in (2, 1):
+      np.testing.assert_array_equal(decompress_video_data(gops[i], "hevc", 66, 50, "yuv420p"), expected[i])
+
+  def _wait_readahead(self, fr):
+    for future in list(fr.decoding.values()):
+      future.result()
+
+  def test_readahead(self):
+    with FrameReader(SMALL_HEVC, index_data=self.index_data) as fr:
+      expected = fr.get(0, 12)
+
+    for readbehind, num in ((False, 0), (True, 11)):
+      with StreamFrameReader(SMALL_HEVC, FrameType.h265_stream, self.index_data, readahead=True, readbehind=readbehind) as fr:
+        np.testing.assert_array_equal(fr.get(num)[0], expected[num])
+        self._wait_readahead(fr)
+        #  Every GOP is within readahead_len, so all of them were decoded
+        for i in range(12):
+          np.testing.assert_array_equal(fr.frame_cache.get((i, "yuv420p")), expected[i])
+
+  def test_readahead_cancel(self):
+    with StreamFrameReader(SMALL_HEVC, FrameType.h265_stream, self.index_data) as fr:
+      expected, expected_rgb = fr.get(10, 2), fr.get(10, 2, pix_fmt="rgb24")
+
+    with StreamFrameReader(SMALL_HEVC, FrameType.h265_stream, self.index_data, readahead=True) as fr:
+      fr.readahead_len = 1
+
+      #  Readahead work that hasn't started, and a GOP another thread is decoding in the foreground
+      pending, running = Future(), Future()
+      running.set_running_or_notify_cancel()
+      fr.decoding[(0, "yuv420p")] = pending
+      fr.decoding[(1, "yuv420p")] = running
+      try:
+        np.testing.assert_array_equal(fr.get(10)[0], expected[0])
+        self.assertTrue(pending.cancelled())
+        self.assertNotIn((0, "yuv420p"), fr.decoding)
+        self.assertIs(fr.decoding[(1, "yuv420p")], running)
+
+        #  GOPs being decoded are waited for, not decoded again
+        waiting = Future()
+        waiting.set_running_or_notify_cancel()
+        fr.decoding[(2, "rgb24")] = waiting
+        frames = []
+        t = threading.Thread(target=lambda: frames.append(fr.get(11, pix_fmt="rgb24")[0]))
+        t.start()
+        t.join(0.2)
+        self.assertTrue(t.is_alive())
+        waiting.set_result(expected_rgb)
+        t.join()
+        self.assertIs(frames[0], expected_rgb[1])
+      finally:
+        running.set_result(None)
+
+  def test_crop(self):
+    crop = (2, 4, 40, 30)
+    with FrameReader(SMALL_HEVC, index_data=self.index_data) as fr:
+      full = np.stack(fr.get(3, 6, pix_fmt="rgb24"))
+      cropped = np.stack(fr.get(3, 6, pix_fmt="rgb24", crop=crop))
+      np.testing.assert_array_equal(cropped, full[:, 4:34, 2:42])
+
+      #  Every plane of a yuv420p crop is a slice of the full frame's
+      full = np.stack(fr.get(3, 6, pix_fmt="yuv420p"))
+      cropped = np.stack(fr.get(3, 6, pix_fmt="yuv420p", crop=crop))
+      for (w, h), (x, y, cw, ch), offset, crop_offset in (((66, 50), crop, 0, 0),
+                                                          ((33, 25), (1, 2, 20, 15), 66 * 50, 40 * 30),
+                                                          ((33, 25), (1, 2, 20, 15), 66 * 50 + 33 * 25, 40 * 30 + 20 * 15)):
+        plane = full[:, offset:offset + w * h].reshape(-1, h, w)
+        cropped_plane = cropped[:, crop_offset:crop_offset + cw * ch].reshape(-1, ch, cw)
+        np.testing.assert_array_equal(cropped_plane, plane[:, y:y + ch, x:x + cw])
+
+
+class TestIndexCache(unittest.TestCase):
+  def test_roundtrip(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      fn, cache_path = os.path.join(tmp, "fcamera.hevc"), os.path.join(tmp, "index")
+      with open(fn, "wb") as f:
+        f.write(b"\x00" * 100)
+      index = np.array([[2, 0], [1, 40], [0xFFFFFFFF, 100]], dtype=np.uint32)
+
+      self.assertIsNone(read_index_cache(cache_path, fn))
+      write_index_cache(cache_path, fn, stream_index_data(index, b"prefix", 64, 48))
+      index_data = read_index_cache(cache_path, fn)
+      np.testing.assert_array_equal(index_data['index'], index)
+      self.assertEqual(index_data['global_prefix'], b"prefix")
+      self.assertEqual(index_data['probe']['streams'][0]['width'], 64)
+      self.assertEqual(index_data['probe']['streams'][0]['height'], 48)
+
+      #  Stale once the video changes
+      st = os.stat(fn)
+      os.utime(fn, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+      self.assertIsNone(read_index_cache(cache_path, fn))
+
+
+if __name__ == "__main__":
+  unittest.main()
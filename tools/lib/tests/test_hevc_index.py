@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+import os
+import threading
+import unittest
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+
+from tools.lib.hevc_index import START_CODE, HEVCIndexer, hevc_index, hevc_index_many
+from tools.lib.tests.test_caching import RangeRequestHandler
+
+#  66x50 x265 stream with a GOP of 5, coded as 72x56 with a conformance window.
+#  The .index and .prefix files are the output of the C vidindex this replaced.
+SMALL_HEVC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "small.hevc")
+
+
+class TestHEVCIndex(unittest.TestCase):
+  def setUp(self):
+    with open(SMALL_HEVC, "rb") as f:
+      self.dat = f.read()
+    self.index = np.fromfile(SMALL_HEVC + ".index", dtype=np.uint32).reshape(-1, 2)
+    with open(SMALL_HEVC + ".prefix", "rb") as f:
+      self.prefix = f.read()
+
+  def _check(self, result):
+    index, prefix, size = result
+    np.testing.assert_array_equal(index, self.index)
+    self.assertEqual(prefix, self.prefix)
+    self.assertEqual(size, (66, 50))
+
+  def test_vidindex_output(self):
+    self._check(hevc_index(SMALL_HEVC))
+    for result in hevc_index_many([SMALL_HEVC, SMALL_HEVC], processes=2):
+      self._check(result)
+
+  def test_remote(self):
+    handler = type("HEVCRequestHandler", (RangeRequestHandler,), {"data": self.dat})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+      self._check(hevc_index(f"http://127.0.0.1:{server.server_address[1]}/fcamera.hevc"))
+    finally:
+      server.shutdown()
+
+  def test_feed_sizes(self):
+    for step in (1, 2, 3, 7, 4096):
+      indexer = HEVCIndexer()
+      for i in range(0, len(self.dat), step):
+        indexer.feed(self.dat[i:i + step])
+      self._check(indexer.finish())
+
+  def test_split_start_code(self):
+    #  Split inside every start code, before its last one and two bytes
+    starts = [i for i in range(len(self.dat)) if self.dat.startswith(START_CODE, i)]
+    for split in (1, 2):
+      indexer = HEVCIndexer()
+      pos = 0
+      for start in starts:
+        indexer.feed(self.dat[pos:start + split])
+        pos = start + split
+      indexer.feed(self.dat[pos:])
+      self._check(indexer.finish())
+
+
+if __name__ == "__main__":
+  unittest.main()
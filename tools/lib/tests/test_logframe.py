@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+import bz2
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from cereal import log as capnp_log
+from tools.lib import logframe
+from tools.lib.logframe import log_frame
+
+FIELDS = ["carState.vEgo", "carState.gearShifter", "controlsState.alertText1", "controlsState.canMonoTimes"]
+
+
+def car_state(t, v_ego, gear):
+  ent = capnp_log.Event.new_message()
+  ent.logMonoTime = t
+  cs = ent.init("carState")
+  cs.vEgo = v_ego
+  cs.gearShifter = gear
+  return ent.to_bytes()
+
+
+def controls_state(t, text, can_mono_times):
+  ent = capnp_log.Event.new_message()
+  ent.logMonoTime = t
+  cs = ent.init("controlsState")
+  cs.alertText1 = text
+  cs.canMonoTimes = can_mono_times
+  return ent.to_bytes()
+
+
+class TestLogFrame(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    patcher = mock.patch.object(logframe, "COLUMN_CACHE_DIR", os.path.join(self.tmp.name, "columns"))
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+    self.fns = [
+      self._write("0/rlog.bz2", [car_state(100, 1.5, "park"), controls_state(110, "", [1, 2]),
+                                 car_state(120, 2.5, "drive"), controls_state(130, "alert", [])]),
+      # no controlsState at all
+      self._write("1/rlog.bz2", [car_state(200, 3.5, "drive")]),
+      self._write("2/rlog.bz2", [controls_state(300, "second", [3, 4, 5]), car_state(310, 4.5, "drive")]),
+    ]
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def _write(self, name, events):
+    fn = os.path.join(self.tmp.name, name)
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with open(fn, "wb") as f:
+      f.write(bz2.compress(b"".join(events)))
+    return fn
+
+  def _check(self, frame):
+    cs = frame["carState"]
+    np.testing.assert_array_equal(cs["logMonoTime"], [100, 120, 200, 310])
+    self.assertEqual(cs["logMonoTime"].dtype, np.uint64)
+    np.testing.assert_allclose(cs["vEgo"], [1.5, 2.5, 3.5, 4.5])
+    self.assertEqual(list(cs["gearShifter"]), ["park", "drive", "drive", "drive"])
+
+    cs = frame["controlsState"]
+    np.testing.assert_array_equal(cs["logMonoTime"], [110, 130, 300])
+    self.assertEqual(list(cs["alertText1"]), ["", "alert", "second"])
+    self.assertEqual([list(v) for v in cs["canMonoTimes"]], [[1, 2], [], [3, 4, 5]])
+
+  def test_extract(self):
+    self._check(log_frame(self.fns, FIELDS, cache=False))
+    self.assertFalse(os.path.exists(logframe.COLUMN_CACHE_DIR))
+
+    frame = log_frame(self.fns[1], FIELDS, cache=False)
+    self.assertEqual(len(frame["controlsState"]["logMonoTime"]), 0)
+    self.assertEqual(len(frame["controlsState"]["canMonoTimes"]), 0)
+
+    with self.assertRaises(ValueError):
+      log_frame(self.fns, ["vEgo"])
+
+    # a list of structs can't be a column
+    ent = capnp_log.Event.new_message()
+    ent.logMonoTime = 400
+    ent.init("carState").init("events", 1)
+    fn = self._write("3/rlog.bz2", [ent.to_bytes()])
+    with self.assertRaises(ValueError):
+      log_frame(fn, ["carState.events"], cache=False)
+
+  def test_cache(self):
+    self._check(log_frame(self.fns, FIELDS))
+
+    # every column was stored, nothing is read again
+    with mock.patch.object(logframe, "_extract", side_effect=AssertionError("log read")):
+      self._check(log_frame(self.fns, FIELDS))
+      frame = log_frame([None, self.fns[0], None], ["carState.vEgo", "controlsState.canMonoTimes"])
+    np.testing.assert_allclose(frame["carState"]["vEgo"], [1.5, 2.5])
+
+    # only the segments a new field isn't cached for yet are read
+    with mock.patch.object(logframe, "_extract", wraps=logframe._extract) as extract:
+      log_frame(self.fns, ["carState.vEgo", "carState.standstill"])
+      log_frame(self.fns, ["carState.vEgo", "carState.standstill"])
+    self.assertEqual(extract.call_count, len(self.fns))
+
+  def test_cache_changed_log(self):
+    log_frame(self.fns[1], ["carState.vEgo"])
+    self._write("1/rlog.bz2", [car_state(200, 3.5, "drive"), car_state(210, 5.5, "drive")])
+    st = os.stat(self.fns[1])
+    os.utime(self.fns[1], ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    np.testing.assert_allclose(log_frame(self.fns[1], ["carState.vEgo"])["carState"]["vEgo"], [3.5, 5.5])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+import bz2
+import os
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+from cereal import log as capnp_log
+from tools.lib import log_cache
+from tools.lib.logreader import EVENT_WHICH_OFFSET, EVENT_WHICH_VALUES, LogReader, MultiLogIterator, _event_which, \
+                                _services_filter, _LazyEvents, get_log_index, log_index_path
+
+SERVICES = ("carState", "logMessage", "controlsState")
+
+
+def make_event(t, service):
+  ent = capnp_log.Event.new_message()
+  ent.logMonoTime = t
+  if service == "logMessage":
+    ent.logMessage = "message"
+  else:
+    ent.init(service)
+  return ent.to_bytes()
+
+
+def far_pointer_event(dat):
+  # moves the event's segment behind a far pointer in a segment of its own
+  num_segments_minus1, size = struct.unpack_from("<II", dat)
+  assert num_segments_minus1 == 0
+  return struct.pack("<IIII", 1, 1, size, 0) + struct.pack("<Q", 2 | (1 << 32)) + dat[8:]
+
+
+def unknown_event(dat):
+  # sets the union discriminant to a value the schema doesn't have
+  dat = bytearray(dat)
+  data = 16 + (struct.unpack_from("<i", dat, 8)[0] >> 2) * 8
+  struct.pack_into("<H", dat, data + EVENT_WHICH_OFFSET, 0xfffe)
+  return bytes(dat)
+
+
+class TestServicesFilter(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.events = [(1000 + i, SERVICES[i % len(SERVICES)]) for i in range(30)]
+    dats = [make_event(t, service) for t, service in self.events]
+    dats[4] = far_pointer_event(dats[4])
+    dats[9] = far_pointer_event(dats[9])
+    dats[7] = unknown_event(dats[7])
+    self.events[7] = (self.events[7][0], None)
+    dat = b"".join(dats)
+
+    self.fns = [os.path.join(self.tmp.name, "rlog"), os.path.join(self.tmp.name, "rlog.bz2")]
+    with open(self.fns[0], "wb") as f:
+      f.write(dat)
+    with open(self.fns[1], "wb") as f:
+      f.write(bz2.compress(dat))
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def test_event_which(self):
+    dat = make_event(1, "carState")
+    self.assertEqual(_event_which(dat), EVENT_WHICH_VALUES["carState"])
+    self.assertIsNone(_event_which(far_pointer_event(dat)))
+    self.assertEqual(_event_which(unknown_event(dat)), 0xfffe)
+
+    self.assertIsNone(_services_filter(None))
+    self.assertEqual(_services_filter(["carState"]), {EVENT_WHICH_VALUES["carState"]})
+    with self.assertRaises(ValueError):
+      _services_filter(["carState", "notAService"])
+
+  def test_filter(self):
+    for services in (["carState"], ["carState", "controlsState"], ["logMessage"]):
+      expected = [t for t, service in self.events if service in services]
+      for fn in self.fns:
+        for stream in (False, True):
+          with self.subTest(services=services, fn=fn, stream=stream):
+            lr = LogReader(fn, stream=stream, services=services)
+            self.assertEqual([ent.logMonoTime for ent in lr], expected)
+            self.assertTrue(all(ent.which() in services for ent in LogReader(fn, stream=stream, services=services)))
+
+  def test_unfiltered(self):
+    for fn in self.fns:
+      for stream in (False, True):
+        self.assertEqual(len(list(LogReader(fn, stream=stream))), len(self.events))
+        known = [t for t, service in self.events if service is not None]
+        self.assertEqual([ent.logMonoTime for ent in LogReader(fn, stream=stream, only_union_types=True)], known)
+
+  def test_start_time(self):
+    # the same for every filter, from the first event of the log
+    for stream in (False, True):
+      for services in (None, ["carState"], ["controlsState"]):
+        lr = MultiLogIterator([self.fns[1]], stream=stream, services=services)
+        self.assertEqual(lr.start_time, 1000)
+
+
+class TestLogReader(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    # out of order by a few events, the way logs are written by several processes
+    self.times = [1000 + i * 10 for i in range(20)]
+    self.times[3], self.times[5] = self.times[5], self.times[3]
+    self.times[12], self.times[13] = self.times[13], self.times[12]
+    self.events = [(t, SERVICES[i % len(SERVICES)]) for i, t in enumerate(self.times)]
+    self.dats = [make_event(t, service) for t, service in self.events]
+    self.dats[8] = far_pointer_event(self.dats[8])
+
+    self.fn = os.path.join(self.tmp.name, "rlog.bz2")
+    with open(self.fn, "wb") as f:
+      f.write(bz2.compress(b"".join(self.dats)))
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def test_lazy_events(self):
+    dat = b"".join(self.dats)
+    offsets = [sum(len(d) for d in self.dats[:i]) for i in range(len(self.dats))]
+    ents = _LazyEvents(dat, offsets, [len(d) for d in self.dats])
+    self.assertEqual(len(ents), len(self.times))
+    self.assertEqual([ent.logMonoTime for ent in ents], self.times)
+    for i in (0, 8, len(self.times) - 1, -1, -len(self.times)):
+      self.assertEqual(ents[i].logMonoTime, self.times[i])
+    for s in (slice(None), slice(2, 9), slice(None, None, 3), slice(-5, None), slice(10, 2, -2), slice(30, 40)):
+      self.assertEqual([ent.logMonoTime for ent in ents[s]], self.times[s])
+    with self.assertRaises(IndexError):
+      ents[len(self.times)]
+
+  def test_sort_by_time(self):
+    for stream in (False, True):
+      with self.subTest(stream=stream):
+        lr = LogReader(self.fn, stream=stream)
+        self.assertEqual([ent.logMonoTime for ent in lr], self.times)
+        lr = LogReader(self.fn, stream=stream, sort_by_time=True)
+        self.assertEqual([ent.logMonoTime for ent in lr], sorted(self.times))
+        lr = LogReader(self.fn, stream=stream, sort_by_time=True, services=["carState", "controlsState"])
+        expected = sorted(t for t, service in self.events if service != "logMessage")
+        self.assertEqual([ent.logMonoTime for ent in lr], expected)
+
+    # in file order, the services and times of every event still belong together
+    lr = LogReader(self.fn, sort_by_time=True)
+    self.assertEqual(list(lr._ts), sorted(self.times))
+    self.assertEqual([(ent.logMonoTime, ent.which()) for ent in lr], sorted(self.events))
+    self.assertEqual(lr._start_time, min(self.times))
+
+
+class TestMultiLogIterator(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    # three one minute segments with an event every 5s, the first one a bit out of order
+    self.start_time = 10 * 10**9
+    self.events, self.fns = [], []
+    for seg in range(3):
+      events = [(self.start_time + (seg * 60 + i * 5) * 10**9, SERVICES[i % len(SERVICES)]) for i in range(12)]
+      events[1], events[2] = events[2], events[1]
+      fn = os.path.join(self.tmp.name, f"{seg}", "rlog.bz2")
+      os.mkdir(os.path.dirname(fn))
+      with open(fn, "wb") as f:
+        f.write(bz2.compress(b"".join(make_event(t, service) for t, service in events)))
+      self.events += events
+      self.fns.append(fn)
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def _expected(self, ts, services):
+    # times of the events left after seeking to ts, in iteration order
+    events = [t for t, service in self.events if services is None or service in services]
+    first = next((i for i, t in enumerate(events) if t >= self.start_time + ts * 10**9), len(events))
+    return events[first:]
+
+  def test_seek_tell(self):
+    for services in (None, ["carState"], ["carState", "logMessage"]):
+      for stream in (False, True):
+        for ts in (0, 7, 12, 60, 95, 163):
+          with self.subTest(services=services, stream=stream, ts=ts):
+            lr = MultiLogIterator(self.fns, stream=stream, services=services)
+            self.assertEqual(lr.start_time, self.start_time)
+            self.assertTrue(lr.seek(ts))
+            expected = self._expected(ts, services)
+            self.assertAlmostEqual(lr.tell(), (expected[0] - self.start_time) * 1e-9)
+            self.assertEqual([ent.logMonoTime for ent in lr], expected)
+            with self.assertRaises(StopIteration):
+              lr.tell()
+
+        with self.subTest(services=services, stream=stream, ts=179):
+          # after the last event
+          lr = MultiLogIterator(self.fns, stream=stream, services=services)
+          self.assertTrue(lr.seek(179))
+          self.assertEqual(list(lr), [])
+
+    lr = MultiLogIterator(self.fns)
+    self.assertFalse(lr.seek(180))
+
+  def test_seek_loads_one_log(self):
+    lr = MultiLogIterator(self.fns, services=["carState"])
+    lr.seek(130)
+    self.assertEqual([r is not None for r in lr._log_readers], [True, False, True])
+
+  def test_seek_past_log_end(self):
+    # nothing in the first segment after 56s, continues at the start of the next one
+    lr = MultiLogIterator(self.fns, services=["carState"])
+    lr.seek(56)
+    self.assertEqual(next(lr).logMonoTime, self.start_time + 60 * 10**9)
+
+  def test_missing_segment(self):
+    lr = MultiLogIterator([self.fns[0], None, self.fns[2]])
+    self.assertFalse(lr.seek(70))
+    self.assertTrue(lr.seek(50))
+    self.assertEqual([ent.logMonoTime for ent in lr], self._expected(50, None)[:2] + self._expected(120, None))
+
+
+class TestLogIndex(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.events = [(1000 + i, SERVICES[i % len(SERVICES)]) for i in range(10)]
+    self.fn = os.path.join(self.tmp.name, "rlog.bz2")
+    self._write(self.events)
+
+    patches = [mock.patch("tools.lib.logreader.CACHE_DIR", os.path.join(self.tmp.name, "cache")),
+               mock.patch.object(log_cache, "LOG_CACHE_DIR", os.path.join(self.tmp.name, "logs"))]
+    for p in patches:
+      p.start()
+      self.addCleanup(p.stop)
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def _write(self, events):
+    with open(self.fn, "wb") as f:
+      f.write(bz2.compress(b"".join(make_event(t, service) for t, service in events)))
+
+  def test_index(self):
+    index = get_log_index(self.fn, cache=True)
+    self.assertEqual(list(index.ts), [t for t, _ in self.events])
+    self.assertEqual(list(index.which), [EVENT_WHICH_VALUES[service] for _, service in self.events])
+    self.assertEqual(list(index.event_times(_services_filter(["carState"]))), [t for t, s in self.events if s == "carState"])
+
+    # the decompressed log is cached with it, and the events are at its offsets
+    path = log_cache.lookup(self.fn)
+    self.assertIsNotNone(path)
+    with open(path, "rb") as f:
+      dat = f.read()
+    offsets = index.service_offsets("logMessage")
+    self.assertEqual(len(offsets), 3)
+    for offset in offsets:
+      self.assertEqual(capnp_log.Event.from_bytes(dat[offset:]).which(), "logMessage")
+
+  def test_cache(self):
+    self.assertEqual(len(get_log_index(self.fn, cache=False)), 10)
+    self.assertFalse(os.path.exists(log_index_path(self.fn)))
+    get_log_index(self.fn, cache=True)
+    self.assertTrue(os.path.exists(log_index_path(self.fn)))
+
+    # same size, newer mtime
+    events = [(t + 1, service) for t, service in self.events]
+    self._write(events)
+    st = os.stat(self.fn)
+    os.utime(self.fn, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    self.assertEqual(list(get_log_index(self.fn, cache=True).ts), [t for t, _ in events])
+
+
+if __name__ == "__main__":
+  unittest.main()
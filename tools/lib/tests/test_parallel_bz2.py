@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+import bz2
+import random
+import unittest
+
+from tools.lib import parallel_bz2
+
+
+class TestParallelBz2(unittest.TestCase):
+  def setUp(self):
+    random.seed(0)
+    # compressible enough to span several 100k blocks
+    self.dat = bytes(random.choice(b"abcdefgh \n") for _ in range(1000000))
+
+  def test_identical_to_serial(self):
+    for level in (1, 9):
+      comp = bz2.compress(self.dat, level)
+      self.assertEqual(parallel_bz2.decompress(comp, workers=4), self.dat)
+
+  def test_concatenated_streams(self):
+    comp = bz2.compress(self.dat[:300000], 1) + bz2.compress(self.dat[300000:], 1)
+    self.assertEqual(parallel_bz2.decompress(comp, workers=4), self.dat)
+
+  def test_errors_match_serial(self):
+    comp = bz2.compress(self.dat, 1)
+    with self.assertRaises(ValueError):
+      parallel_bz2.decompress(comp[:-100])
+
+    corrupt = bytearray(comp)
+    corrupt[len(corrupt) // 2] ^= 0xff
+    with self.assertRaises(OSError):
+      parallel_bz2.decompress(bytes(corrupt))
+
+
+if __name__ == "__main__":
+  unittest.main()
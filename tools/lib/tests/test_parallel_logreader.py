@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import bz2
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from tools.lib import parallel_bz2
+from tools.lib.parallel_logreader import ParallelLogReader
+from tools.lib.tests.test_logreader import SERVICES, make_event
+
+
+class SyncPool:
+  """multiprocessing.Pool stand-in that loads segments when their result is
+  read, and tracks how many are submitted but not read yet."""
+  outstanding = 0
+  max_outstanding = 0
+
+  def __init__(self, processes):
+    self.processes = processes
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    pass
+
+  def apply_async(self, fn, args):
+    cls = type(self)
+    cls.outstanding += 1
+    cls.max_outstanding = max(cls.max_outstanding, cls.outstanding)
+
+    def get():
+      cls.outstanding -= 1
+      return fn(*args)
+    return mock.Mock(get=get)
+
+
+class TestParallelLogReader(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.times = []
+    self.fns = []
+    for seg in range(5):
+      # consecutive segments overlap, and every one is a bit out of order
+      ts = [seg * 100 + i * 7 + seg for i in range(20)]
+      ts[3], ts[4] = ts[4], ts[3]
+      events = [(t, SERVICES[i % len(SERVICES)]) for i, t in enumerate(ts)]
+      self.fns.append(self._write(f"{seg}/rlog.bz2", events))
+      self.times += events
+    SyncPool.outstanding = SyncPool.max_outstanding = 0
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def _write(self, name, events):
+    fn = os.path.join(self.tmp.name, name)
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    dat = b"".join(make_event(t, service) for t, service in events)
+    with open(fn, "wb") as f:
+      f.write(bz2.compress(dat) if fn.endswith(".bz2") else dat)
+    return fn
+
+  def test_merge(self):
+    for services in (None, ["carState"], ["carState", "logMessage"]):
+      with self.subTest(services=services):
+        expected = sorted(t for t, service in self.times if services is None or service in services)
+        lr = ParallelLogReader(self.fns, services=services, workers=2, prefetch=2)
+        self.assertEqual([ent.logMonoTime for ent in lr], expected)
+
+  def test_missing_segments(self):
+    # None paths are skipped, empty logs and ones without the services are merged as nothing
+    empty = self._write("empty/rlog", [])
+    no_car_state = self._write("5/rlog.bz2", [(150, "logMessage"), (230, "controlsState")])
+    paths = [None, self.fns[0], empty, None, self.fns[1], no_car_state, self.fns[2], None]
+    expected = [t for t, _ in self.times[:60]] + [150, 230]
+    lr = ParallelLogReader(paths, workers=2, prefetch=1)
+    self.assertEqual([ent.logMonoTime for ent in lr], sorted(expected))
+
+    expected = sorted(t for t, service in self.times[:60] if service == "carState")
+    lr = ParallelLogReader(paths, services=["carState"], workers=2, prefetch=1)
+    self.assertEqual([ent.logMonoTime for ent in lr], expected)
+    self.assertEqual(list(ParallelLogReader([None, empty])), [])
+    self.assertEqual(list(ParallelLogReader([])), [])
+
+  @mock.patch("tools.lib.parallel_logreader.multiprocessing.Pool", SyncPool)
+  def test_prefetch(self):
+    for prefetch in (1, 2, 4):
+      SyncPool.outstanding = SyncPool.max_outstanding = 0
+      lr = ParallelLogReader(self.fns, prefetch=prefetch)
+      self.assertEqual([ent.logMonoTime for ent in lr], sorted(t for t, _ in self.times))
+      self.assertEqual(SyncPool.max_outstanding, prefetch)
+
+  @mock.patch("tools.lib.parallel_logreader.multiprocessing.Pool", SyncPool)
+  def test_serial_bz2(self):
+    # the segments are already decompressed in parallel, one per worker
+    with mock.patch.object(parallel_bz2, "decompress", wraps=parallel_bz2.decompress) as decompress:
+      self.assertEqual(len(list(ParallelLogReader(self.fns))), len(self.times))
+    self.assertEqual(decompress.call_count, len(self.fns))
+    self.assertTrue(all(call.args[1] == 1 for call in decompress.call_args_list))
+
+
+if __name__ == "__main__":
+  unittest.main()
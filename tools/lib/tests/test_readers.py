@@ -28,6 +28,9 @@ class TestReaders(unittest.TestCase):
       lr_file = LogReader(fp.name)
       _check_data(lr_file)
 
+      lr_stream = LogReader(fp.name, stream=True)
+      _check_data(lr_stream)
+
     lr_url = LogReader("https://github.com/commaai/comma2k19/blob/master/Example_1/b0c9d2329ad1606b%7C2018-08-02--08-34-47/40/raw_log.bz2?raw=true")
     _check_data(lr_url)
 
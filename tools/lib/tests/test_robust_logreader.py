@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+import unittest
+
+from cereal import log as capnp_log
+from tools.lib.robust_logreader import recover_events
+
+
+def _event(t):
+  ent = capnp_log.Event.new_message()
+  ent.logMonoTime = t
+  ent.valid = True
+  ent.init('carState').vEgo = t / 1e9
+  return ent.to_bytes()
+
+
+class TestRecoverEvents(unittest.TestCase):
+  def setUp(self):
+    self.times = [(i + 1) * 1000 for i in range(10)]
+    self.events = [_event(t) for t in self.times]
+
+  def _recovered_times(self, dat):
+    return [ent.logMonoTime for ent in recover_events(dat)]
+
+  def test_intact(self):
+    self.assertEqual(self._recovered_times(b"".join(self.events)), self.times)
+
+  def test_truncated_tail(self):
+    dat = b"".join(self.events[:-1]) + self.events[-1][:-8]
+    self.assertEqual(self._recovered_times(dat), self.times[:-1])
+
+  def test_corrupt_middle(self):
+    events = list(self.events)
+    events[5] = b"\xff" * len(events[5])
+    self.assertEqual(self._recovered_times(b"".join(events)), self.times[:5] + self.times[6:])
+
+  def test_zero_filled(self):
+    events = list(self.events)
+    events[5] = b"\x00" * len(events[5])
+    events[6] = b"\x00" * len(events[6])
+    self.assertEqual(self._recovered_times(b"".join(events)), self.times[:5] + self.times[7:])
+
+  def test_default_event(self):
+    # one segment of one zero word reads as a default Event
+    events = list(self.events)
+    events.insert(5, b"\x00\x00\x00\x00\x01\x00\x00\x00" + b"\x00" * 8)
+    self.assertEqual(self._recovered_times(b"".join(events)), self.times)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from tools.lib import route
+from tools.lib.route import Route, load_routes
+
+DONGLE_ID = "a2a0ccea32023010"
+TIME_STR = "2020-07-01--12-00-00"
+ROUTE_NAME = f"{DONGLE_ID}|{TIME_STR}"
+URL = f"https://commadata2.blob.core.windows.net/commadata2/{DONGLE_ID}/{TIME_STR}"
+
+
+class TestRouteRemote(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.files = {
+      "logs": [f"{URL}/{seg}/rlog.bz2?sig=1" for seg in (0, 2)],
+      "cameras": [f"{URL}/{seg}/fcamera.hevc?sig=1" for seg in (0, 1, 2)],
+    }
+    patches = [mock.patch.object(route, "ROUTE_CACHE_DIR", os.path.join(self.tmp.name, "routes")),
+               mock.patch.object(route, "get_token", return_value=None)]
+    for p in patches:
+      p.start()
+      self.addCleanup(p.stop)
+    patcher = mock.patch.object(route, "CommaApi")
+    self.api = patcher.start().return_value
+    self.addCleanup(patcher.stop)
+    self.api.get.return_value = self.files
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def _check(self, r):
+    self.assertEqual(r.log_paths(), [self.files["logs"][0], None, self.files["logs"][1]])
+    self.assertEqual(r.camera_paths(), self.files["cameras"])
+
+  def test_manifest(self):
+    self._check(Route(ROUTE_NAME))
+    self._check(Route(ROUTE_NAME))
+    self.api.get.assert_called_once_with(f"v1/route/{ROUTE_NAME}/files")
+
+    # the urls in it expire
+    now = time.time()
+    with mock.patch.object(route.time, "time", return_value=now + route.ROUTE_CACHE_TTL + 1):
+      self._check(Route(ROUTE_NAME))
+    self.assertEqual(self.api.get.call_count, 2)
+
+    # a manifest from another api isn't used
+    with mock.patch.object(route, "API_HOST", "http://localhost:3000"):
+      self._check(Route(ROUTE_NAME))
+      self._check(Route(ROUTE_NAME))
+    self.assertEqual(self.api.get.call_count, 3)
+
+    # neither is a broken one
+    with open(os.path.join(route.ROUTE_CACHE_DIR, ROUTE_NAME.replace("|", "_") + ".json"), "w") as f:
+      f.write("{")
+    self._check(Route(ROUTE_NAME))
+    self.assertEqual(self.api.get.call_count, 4)
+
+  def test_no_cache(self):
+    self._check(Route(ROUTE_NAME, cache=False))
+    self._check(Route(ROUTE_NAME, cache=False))
+    self.assertEqual(self.api.get.call_count, 2)
+    self.assertFalse(os.path.exists(route.ROUTE_CACHE_DIR))
+
+
+class TestRouteLocal(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.data_dir = self.tmp.name
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def _touch(self, *path):
+    fn = os.path.join(self.data_dir, *path)
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    open(fn, "w").close()
+    return fn
+
+  def test_layouts(self):
+    # explorer files, an openpilot segment dir and a route dir with a dir per segment
+    log0 = self._touch(f"{ROUTE_NAME}--0--rlog.bz2")
+    camera0 = self._touch(f"{ROUTE_NAME}--0--fcamera.hevc")
+    log1 = self._touch(f"{ROUTE_NAME}--1", "rlog.bz2")
+    qlog3 = self._touch(ROUTE_NAME, "3", "qlog.bz2")
+    self._touch(ROUTE_NAME, "notes", "rlog.bz2")
+
+    # other routes
+    self._touch(f"{DONGLE_ID}|2020-07-02--12-00-00--2--rlog.bz2")
+    self._touch(f"0123456789abcdef|{TIME_STR}--2--rlog.bz2")
+    self._touch("README")
+
+    with mock.patch.object(route.re, "match", wraps=route.re.match) as match:
+      r = Route(ROUTE_NAME, data_dir=self.data_dir)
+    self.assertEqual(r.log_paths(), [log0, log1, None, None])
+    self.assertEqual(r.camera_paths(), [camera0, None, None, None])
+    self.assertEqual(r.qlog_paths(), [None, None, None, qlog3])
+
+    # entries of other devices aren't matched
+    matched = {call.args[1] for call in match.call_args_list}
+    self.assertTrue(matched)
+    self.assertTrue(all(f.startswith(DONGLE_ID) for f in matched))
+
+    routes = load_routes([ROUTE_NAME, ROUTE_NAME], data_dir=self.data_dir, workers=2)
+    self.assertEqual([r.log_paths() for r in routes], [[log0, log1, None, None]] * 2)
+
+  def test_not_found(self):
+    self._touch(f"0123456789abcdef|{TIME_STR}--0--rlog.bz2")
+    with self.assertRaises(ValueError):
+      Route(ROUTE_NAME, data_dir=self.data_dir)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+import bz2
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from cereal import log as capnp_log
+from tools.lib.framereader import FrameReader
+from tools.lib import segment_reader
+from tools.lib.segment_reader import SegmentReader
+from tools.lib.tests.test_hevc_index import SMALL_HEVC
+
+NUM_FRAMES = 12
+
+
+def camera_state(t, frame_id, camera="roadCameraState"):
+  ent = capnp_log.Event.new_message()
+  ent.logMonoTime = t
+  ent.init(camera).frameId = frame_id
+  return ent.to_bytes()
+
+
+def car_state(t):
+  ent = capnp_log.Event.new_message()
+  ent.logMonoTime = t
+  ent.init("carState").vEgo = t / 1e3
+  return ent.to_bytes()
+
+
+def log_message(t):
+  ent = capnp_log.Event.new_message()
+  ent.logMonoTime = t
+  ent.logMessage = "message"
+  return ent.to_bytes()
+
+
+@unittest.skipIf(shutil.which("ffmpeg") is None, "ffmpeg not installed")
+class TestSegmentReader(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    with FrameReader(SMALL_HEVC) as fr:
+      cls.frames = fr.get(0, NUM_FRAMES)
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def _write_log(self, num_camera_states):
+    # every camera state is preceded by two carStates and a logMessage, and the
+    # driver camera runs alongside. The events are a bit out of order in the file
+    events = []
+    for i in range(num_camera_states):
+      t = 1000 + i * 100
+      events += [car_state(t + 10), log_message(t + 20), car_state(t + 30),
+                 camera_state(t + 50, i), camera_state(t + 60, i, "driverCameraState")]
+    events[0], events[1] = events[1], events[0]
+    fn = os.path.join(self.tmp.name, "rlog.bz2")
+    with open(fn, "wb") as f:
+      f.write(bz2.compress(b"".join(events)))
+    return fn
+
+  def test_pairing(self):
+    sr = SegmentReader(self._write_log(NUM_FRAMES), SMALL_HEVC, prefetch=3)
+    results = list(sr)
+    self.assertEqual(len(results), NUM_FRAMES)
+    for i, (frame, cs, surrounding) in enumerate(results):
+      self.assertEqual(cs.which(), "roadCameraState")
+      self.assertEqual(cs.roadCameraState.frameId, i)
+      np.testing.assert_array_equal(frame, self.frames[i])
+
+      # everything since the previous road camera state, in time order
+      t = 1000 + i * 100
+      expected = ([] if i == 0 else [(t - 40, "driverCameraState")]) + \
+                 [(t + 10, "carState"), (t + 20, "logMessage"), (t + 30, "carState")]
+      self.assertEqual([(ent.logMonoTime, ent.which()) for ent in surrounding], expected)
+
+  def test_services(self):
+    sr = SegmentReader(self._write_log(NUM_FRAMES), SMALL_HEVC, camera="driverCameraState", services=["carState"])
+    results = list(sr)
+    self.assertEqual([cs.driverCameraState.frameId for _, cs, _ in results], list(range(NUM_FRAMES)))
+    for i, (_, _, surrounding) in enumerate(results):
+      t = 1000 + i * 100
+      self.assertEqual([ent.logMonoTime for ent in surrounding], [t + 10, t + 30])
+
+    with self.assertRaises(ValueError):
+      SegmentReader(self._write_log(1), SMALL_HEVC, camera="carState")
+
+  def test_frames_run_out(self):
+    # camera states for frames that didn't make it into the video are dropped
+    results = list(SegmentReader(self._write_log(NUM_FRAMES + 3), SMALL_HEVC, prefetch=2))
+    self.assertEqual([cs.roadCameraState.frameId for _, cs, _ in results], list(range(NUM_FRAMES)))
+    np.testing.assert_array_equal(results[-1][0], self.frames[-1])
+
+  def test_early_stop(self):
+    # the prefetch thread is blocked on a full queue, stopping shuts it down
+    prefetchers = []
+    prefetcher_cls = segment_reader._FramePrefetcher
+
+    def prefetcher(*args):
+      prefetchers.append(prefetcher_cls(*args))
+      return prefetchers[-1]
+
+    with mock.patch.object(segment_reader, "_FramePrefetcher", side_effect=prefetcher):
+      it = iter(SegmentReader(self._write_log(NUM_FRAMES), SMALL_HEVC, prefetch=1))
+      for i in range(2):
+        frame, cs, _ = next(it)
+        self.assertEqual(cs.roadCameraState.frameId, i)
+        np.testing.assert_array_equal(frame, self.frames[i])
+    self.assertEqual(len(prefetchers), 1)
+    self.assertTrue(prefetchers[0]._thread.is_alive())
+    it.close()
+    self.assertFalse(prefetchers[0]._thread.is_alive())
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,13 +1,23 @@
+#!/usr/bin/env python3
 # pylint: skip-file
 
 import os
+import re
+import sys
 import time
+import zlib
+import fcntl
+import struct
+import argparse
 import tempfile
 import threading
 import urllib.parse
 import pycurl
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
 from io import BytesIO
+from array import array
+from contextlib import contextmanager
 from tenacity import retry, wait_random_exponential, stop_after_attempt
 from common.file_helpers import mkdirs_exists_ok, atomic_write_in_dir
 #  Cache chunk size
@@ -16,36 +26,379 @@ CHUNK_SIZE = 1000 * K
 
 CACHE_DIR = os.environ.get("COMMA_CACHE", "/tmp/comma_download_cache/")
 
+#  Max number of chunks downloaded at once, shared by all URLFiles in the process
+DOWNLOAD_WORKERS = int(os.environ.get("URLFILE_PARALLEL", "8"))
+#  Chunks downloaded in the background after sequential reads, when caching
+READAHEAD_CHUNKS = int(os.environ.get("URLFILE_READAHEAD", "4"))
+
+#  Least recently used files are evicted once the cache is larger than this
+CACHE_SIZE = int(os.environ.get("COMMA_CACHE_SIZE", str(20 * 1000 * 1000 * K)))
+#  Min seconds between evictions, checked after every download
+EVICT_INTERVAL = 60
+EVICT_LOCK = ".evict_lock"
+#  Every url is cached in one sparse file, next to an index of which chunks are present
+INDEX_HEADER = struct.Struct("<4sIQ")
+INDEX_MAGIC = b"UCH1"
+CACHE_FILE_RE = re.compile(r"^([0-9a-f]{64})_(data|chunks|length|logindex|[0-9]+\.[0-9]+)$")
+
 
 def hash_256(link):
   hsh = str(sha256((link.split("?")[0]).encode('utf-8')).hexdigest())
   return hsh
 
 
-class URLFile:
-  _tlocal = threading.local()
-
-  def __init__(self, url, debug=False, cache=None):
+def check_response(response_code, headers, url, data, download_range):
+  if response_code == 416:  # Requested Range Not Satisfiable
+    raise Exception(f"Error, range out of bounds {response_code} {headers} ({url}): {repr(data)[:500]}")
+  if download_range and response_code != 206:  # Partial Content
+    raise Exception(f"Error, requested range but got unexpected response {response_code} {headers} ({url}): {repr(data)[:500]}")
+  if (not download_range) and response_code != 200:  # OK
+    raise Exception(f"Error {response_code} {headers} ({url}): {repr(data)[:500]}")
+
+
+class ChunkStore:
+  """Sparse file holding the cached chunks of one url.
+
+     The index file has a bitmap of the chunks present and their crc32s. Chunk data
+     is written before its bit is set, so readers never see a chunk that isn't there.
+  """
+  def __init__(self, prefix, length):
+    self.data_path = prefix + "_data"
+    self.index_path = prefix + "_chunks"
+    self.length = length
+    self.num_chunks = (length + CHUNK_SIZE - 1) // CHUNK_SIZE
+    self._bitmap_size = (self.num_chunks + 7) // 8
+    self._crc_offset = INDEX_HEADER.size + self._bitmap_size
+    self._lock = threading.Lock()
+    self._data_fd = self._index_fd = None
+
+    self._data_fd = os.open(self.data_path, os.O_RDWR | os.O_CREAT, 0o644)
+    self._index_fd = os.open(self.index_path, os.O_RDWR | os.O_CREAT, 0o644)
+    with self._locked():
+      header = os.pread(self._index_fd, INDEX_HEADER.size, 0)
+      if header != INDEX_HEADER.pack(INDEX_MAGIC, CHUNK_SIZE, length):
+        #  New or written with a different layout, start over
+        os.ftruncate(self._index_fd, 0)
+        os.ftruncate(self._index_fd, self._crc_offset + 4 * self.num_chunks)
+        os.pwrite(self._index_fd, INDEX_HEADER.pack(INDEX_MAGIC, CHUNK_SIZE, length), 0)
+        os.ftruncate(self._data_fd, 0)
+      if os.fstat(self._data_fd).st_size != length:
+        os.ftruncate(self._data_fd, length)
+
+  def __del__(self):
+    self.close()
+
+  def close(self):
+    for fd in (self._data_fd, self._index_fd):
+      if fd is not None:
+        os.close(fd)
+    self._data_fd = self._index_fd = None
+
+  @contextmanager
+  def _locked(self):
+    #  flock excludes other processes, the lock other threads sharing the fd
+    with self._lock:
+      fcntl.flock(self._index_fd, fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(self._index_fd, fcntl.LOCK_UN)
+
+  def _chunk_range(self, chunk):
+    return chunk * CHUNK_SIZE, min((chunk + 1) * CHUNK_SIZE, self.length)
+
+  def present(self):
+    """Returns the bitmap and crcs of the chunks present."""
+    index = os.pread(self._index_fd, self._crc_offset + 4 * self.num_chunks - INDEX_HEADER.size, INDEX_HEADER.size)
+    crcs = array("I")
+    crcs.frombytes(index[self._bitmap_size:])
+    return index[:self._bitmap_size], crcs
+
+  def has(self, chunk):
+    return bool(os.pread(self._index_fd, 1, INDEX_HEADER.size + chunk // 8)[0] & (1 << (chunk % 8)))
+
+  def read_into(self, buf, first_chunk):
+    """Reads the chunks present from first_chunk on into buf. Returns the chunks
+    that are missing or fail their checksum."""
+    bitmap, crcs = self.present()
+    view = memoryview(buf)
+    base = first_chunk * CHUNK_SIZE
+    chunks = range(first_chunk, first_chunk + (len(buf) + CHUNK_SIZE - 1) // CHUNK_SIZE)
+    have = [bool(bitmap[c // 8] & (1 << (c % 8))) for c in chunks]
+
+    #  One read per run of consecutive chunks present
+    i = 0
+    while i < len(chunks):
+      if not have[i]:
+        i += 1
+        continue
+      j = i
+      while j < len(chunks) and have[j]:
+        j += 1
+      start, end = i * CHUNK_SIZE, min(j * CHUNK_SIZE, len(buf))
+      os.preadv(self._data_fd, [view[start:end]], base + start)
+      i = j
+
+    missing = []
+    for i, chunk in enumerate(chunks):
+      start, end = self._chunk_range(chunk)
+      if not have[i] or zlib.crc32(view[start - base:end - base]) != crcs[chunk]:
+        missing.append(chunk)
+    if any(have):
+      os.utime(self.data_path)  # mtime is the last access time used for eviction
+    return missing
+
+  def write(self, chunk, data):
+    start, end = self._chunk_range(chunk)
+    assert len(data) == end - start, f"chunk {chunk} is {len(data)} bytes, expected {end - start}"
+    os.pwrite(self._data_fd, data, start)
+    with self._locked():
+      os.pwrite(self._index_fd, struct.pack("<I", zlib.crc32(data)), self._crc_offset + 4 * chunk)
+      pos = INDEX_HEADER.size + chunk // 8
+      os.pwrite(self._index_fd, bytes([os.pread(self._index_fd, 1, pos)[0] | (1 << (chunk % 8))]), pos)
+
+  def verify(self):
+    """Clears the bit of every chunk that fails its checksum. Returns the number cleared."""
+    buf = bytearray(self.length)
+    bad = [c for c in self.read_into(buf, 0) if self.has(c)]
+    with self._locked():
+      for chunk in bad:
+        pos = INDEX_HEADER.size + chunk // 8
+        os.pwrite(self._index_fd, bytes([os.pread(self._index_fd, 1, pos)[0] & ~(1 << (chunk % 8))]), pos)
+    return len(bad)
+
+
+def cache_entries():
+  """Returns (mtime, size, path) of every file in the download cache. mtime is
+  updated on every read, so it's the last access time."""
+  entries = []
+  try:
+    with os.scandir(CACHE_DIR) as it:
+      for e in it:
+        if CACHE_FILE_RE.match(e.name) is None:
+          continue
+        try:
+          st = e.stat()
+        except FileNotFoundError:
+          continue
+        #  Sparse files only count the chunks actually downloaded
+        entries.append((st.st_mtime, st.st_blocks * 512, e.path))
+  except FileNotFoundError:
+    pass
+  return entries
+
+
+def cache_urls():
+  """Returns (mtime, size, paths) of every url in the download cache."""
+  urls = {}
+  for mtime, size, path in cache_entries():
+    url_hash = CACHE_FILE_RE.match(os.path.basename(path)).group(1)
+    url_mtime, url_size, paths = urls.get(url_hash, (0, 0, []))
+    urls[url_hash] = (max(mtime, url_mtime), url_size + size, paths + [path])
+  return list(urls.values())
+
+
+def evict_lru(entries, max_size, keep=None):
+  """Deletes the files of the least recently used (mtime, size, paths) entries until
+  the rest fit in max_size bytes, never the one holding keep. Returns the number of
+  files and bytes removed."""
+  total = sum(size for _, size, _ in entries)
+  removed, removed_size = 0, 0
+  for _, size, paths in sorted(entries):
+    if total <= max_size:
+      break
+    if keep in paths:
+      continue
+    for path in paths:
+      try:
+        # processes that already opened the file can keep reading it
+        os.remove(path)
+        removed += 1
+      except FileNotFoundError:
+        pass
+    removed_size += size
+    total -= size
+  return removed, removed_size
+
+
+def prune_cache(max_size=None, block=True):
+  """Evicts the least recently used urls until the cache fits in max_size bytes.
+  Returns the number of files and bytes removed."""
+  max_size = CACHE_SIZE if max_size is None else max_size
+  mkdirs_exists_ok(CACHE_DIR)
+  with open(os.path.join(CACHE_DIR, EVICT_LOCK), "a") as lock:
+    try:
+      # only one process evicts at a time, readers never take the lock
+      fcntl.flock(lock, fcntl.LOCK_EX | (0 if block else fcntl.LOCK_NB))
+    except BlockingIOError:
+      return 0, 0
+    os.utime(lock.name)
+
+    return evict_lru(cache_urls(), max_size)
+
+
+def maybe_prune_cache():
+  try:
+    last = os.path.getmtime(os.path.join(CACHE_DIR, EVICT_LOCK))
+  except FileNotFoundError:
+    last = 0
+  if time.time() - last > EVICT_INTERVAL:
+    prune_cache(block=False)
+
+
+def verify_cache():
+  """Drops every cached chunk that fails its checksum. Returns the number dropped."""
+  corrupt = 0
+  for _, _, path in cache_entries():
+    if not path.endswith("_chunks"):
+      continue
+    try:
+      with open(path, "rb") as f:
+        magic, chunk_size, length = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+    except (FileNotFoundError, struct.error):
+      continue
+    if magic == INDEX_MAGIC and chunk_size == CHUNK_SIZE:
+      corrupt += ChunkStore(path[:-len("_chunks")], length).verify()
+  return corrupt
+
+
+class BaseURLFile:
+  """Reading a url through the download cache, without the downloads.
+
+     URLFile and AsyncURLFile only differ in how they download, the length
+     cache, chunk alignment and chunk store are shared.
+  """
+  def __init__(self, url, debug=False, cache=None, parallel=None):
     self._url = url
     self._pos = 0
     self._length = None
-    self._local_file = None
     self._debug = debug
     #  True by default, false if FILEREADER_CACHE is defined, but can be overwritten by the cache input
     self._force_download = not int(os.environ.get("FILEREADER_CACHE", "0"))
     if cache is not None:
       self._force_download = not cache
+    #  Max number of chunks of one read that are downloaded concurrently
+    self._parallel = DOWNLOAD_WORKERS if parallel is None else max(1, parallel)
+    #  chunk -> future of its download in the background
+    self._readahead = {}
+    self._last_read_end = None
+    self._store = None
+
+    mkdirs_exists_ok(CACHE_DIR)
+
+  def _cached_length(self):
+    #  Returns the length if it's known without a request, None otherwise
+    if self._length is None and not self._force_download:
+      try:
+        with open(os.path.join(CACHE_DIR, hash_256(self._url) + "_length")) as file_length:
+          self._length = int(file_length.read())
+      except FileNotFoundError:
+        pass
+    return self._length
+
+  def _set_length(self, length):
+    self._length = length
+    if not self._force_download:
+      with atomic_write_in_dir(os.path.join(CACHE_DIR, hash_256(self._url) + "_length"), mode="w", overwrite=True) as file_length:
+        file_length.write(str(length))
+    return length
+
+  def _open_store(self, length):
+    if self._store is None:
+      self._store = ChunkStore(os.path.join(CACHE_DIR, hash_256(self._url)), length)
+    return self._store
+
+  def _close_store(self):
+    if self._store is not None:
+      self._store.close()
+      self._store = None
+
+  def _read_range(self, ll, length):
+    #  [begin, end) of a read of ll bytes from the current position, clamped to the file
+    return self._pos, min(self._pos + ll, length) if ll is not None else length
+
+  @staticmethod
+  def _chunk_ranges(begin, end):
+    #  [begin, end) split at every CHUNK_SIZE bytes, downloaded concurrently
+    return [(s, min(s + CHUNK_SIZE, end)) for s in range(begin, end, CHUNK_SIZE)]
+
+  @staticmethod
+  def _aligned(file_begin, file_end, length):
+    #  We have to align with chunks we store. Returns the first chunk and the range of the chunks read
+    first_chunk = file_begin // CHUNK_SIZE
+    return first_chunk, first_chunk * CHUNK_SIZE, min(((file_end - 1) // CHUNK_SIZE + 1) * CHUNK_SIZE, length)
+
+  def _finish_read(self, buf, file_begin, file_end, aligned_begin):
+    #  Returns the bytes read out of the chunks read, and whether the read was sequential
+    response = bytes(memoryview(buf)[file_begin - aligned_begin:file_end - aligned_begin])
+    sequential = file_begin == self._last_read_end
+    self._last_read_end = file_end
+    self._pos = file_end
+    return response, sequential
+
+  def _readahead_chunks(self, end):
+    #  Chunks after end to download in the background, that aren't cached or being downloaded
+    first = (end + CHUNK_SIZE - 1) // CHUNK_SIZE
+    last = min(first + READAHEAD_CHUNKS, self._store.num_chunks)
+    return [c for c in range(first, last) if c not in self._readahead and not self._store.has(c)]
+
+  def _readahead_failed(self, chunk, e):
+    print(f"readahead of chunk {chunk} of {self._url} failed: {e!r}", file=sys.stderr)
+
+  def seek(self, pos):
+    self._pos = pos
+
+
+class URLFile(BaseURLFile):
+  _tlocal = threading.local()
+  _pool = None
+  _pool_lock = threading.Lock()
+
+  def __init__(self, url, debug=False, cache=None, parallel=None):
+    super().__init__(url, debug, cache, parallel)
+    self._local_file = None
+    self._readahead_pid = os.getpid()
+    self._curl = self._thread_curl()
 
+  @classmethod
+  def _thread_curl(cls):
+    #  One connection per thread, reused across requests
     try:
-      self._curl = self._tlocal.curl
+      return cls._tlocal.curl
     except AttributeError:
-      self._curl = self._tlocal.curl = pycurl.Curl()
-    mkdirs_exists_ok(CACHE_DIR)
+      cls._tlocal.curl = pycurl.Curl()
+      return cls._tlocal.curl
+
+  @classmethod
+  def _download_pool(cls):
+    with cls._pool_lock:
+      if cls._pool is None:
+        cls._pool = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="urlfile")
+      return cls._pool
+
+  @classmethod
+  def _after_fork(cls):
+    #  The pool's threads and the curl handles' connections belong to the parent
+    cls._pool = None
+    cls._pool_lock = threading.Lock()
+    cls._tlocal = threading.local()
+
+  def _forked_readahead(self):
+    #  Read-ahead started before a fork never finishes in the child
+    if self._readahead_pid != os.getpid():
+      self._readahead = {}
+      self._readahead_pid = os.getpid()
 
   def __enter__(self):
     return self
 
   def __exit__(self, exc_type, exc_value, traceback):
+    self._forked_readahead()
+    for chunk, future in self._readahead.items():
+      if not future.cancel():
+        self._wait_readahead(chunk, future)
+    self._readahead = {}
+    self._close_store()
     if self._local_file is not None:
       os.remove(self._local_file.name)
       self._local_file.close()
@@ -53,7 +406,7 @@ class URLFile:
 
   @retry(wait=wait_random_exponential(multiplier=1, max=5), stop=stop_after_attempt(3), reraise=True)
   def get_length_online(self):
-    c = self._curl
+    c = self._thread_curl()
     c.reset()
     c.setopt(pycurl.NOSIGNAL, 1)
     c.setopt(pycurl.TIMEOUT_MS, 500000)
@@ -66,51 +419,112 @@ class URLFile:
     return length
 
   def get_length(self):
-    if self._length is not None:
-      return self._length
-    file_length_path = os.path.join(CACHE_DIR, hash_256(self._url) + "_length")
-    if os.path.exists(file_length_path) and not self._force_download:
-      with open(file_length_path) as file_length:
-          content = file_length.read()
-          self._length = int(content)
-          return self._length
-
-    self._length = self.get_length_online()
-    if not self._force_download:
-      with atomic_write_in_dir(file_length_path, mode="w") as file_length:
-        file_length.write(str(self._length))
-    return self._length
+    length = self._cached_length()
+    if length is not None:
+      return length
+    return self._set_length(self.get_length_online())
+
+  def _chunk_store(self):
+    return self._open_store(self.get_length())
+
+  def _download_chunk(self, chunk):
+    data = self._download_range(chunk * CHUNK_SIZE, min((chunk + 1) * CHUNK_SIZE, self.get_length()))
+    self._chunk_store().write(chunk, data)
+    maybe_prune_cache()
+    return data
+
+  def _readahead_chunk(self, chunk):
+    #  The data goes to the cache, the future doesn't keep it around
+    self._download_chunk(chunk)
+
+  def _wait_readahead(self, chunk, future):
+    try:
+      future.result()
+      return True
+    except Exception as e:
+      self._readahead_failed(chunk, e)
+      return False
+
+  def _read_chunks(self, first_chunk, size):
+    """Returns size bytes from the start of first_chunk, downloading missing chunks concurrently."""
+    buf = bytearray(size)
+    view = memoryview(buf)
+    store = self._chunk_store()
+    missing = store.read_into(buf, first_chunk)
+
+    self._forked_readahead()
+    to_download = []
+    for chunk in missing:
+      future = self._readahead.pop(chunk, None)
+      if future is not None and self._wait_readahead(chunk, future):
+        start = (chunk - first_chunk) * CHUNK_SIZE
+        if len(store.read_into(view[start:start + CHUNK_SIZE], chunk)) == 0:
+          continue
+      to_download.append(chunk)
+
+    if len(to_download) == 1 or self._parallel == 1:
+      downloads = [self._download_chunk(c) for c in to_download]
+    else:
+      downloads = self._map_parallel(self._download_chunk, to_download)
+
+    for chunk, data in zip(to_download, downloads):
+      start = (chunk - first_chunk) * CHUNK_SIZE
+      buf[start:start + len(data)] = data
+    return buf
+
+  def _map_parallel(self, fn, args):
+    #  Like Executor.map, but with at most self._parallel calls in flight
+    pool = self._download_pool()
+    pending = []
+    results = []
+    for arg in args:
+      if len(pending) == self._parallel:
+        results.append(pending.pop(0).result())
+      pending.append(pool.submit(fn, arg))
+    results += [f.result() for f in pending]
+    return results
+
+  def _schedule_readahead(self, end):
+    self._forked_readahead()
+    #  Finished downloads are in the cache, only failures are worth reporting
+    for chunk, future in list(self._readahead.items()):
+      if future.done():
+        del self._readahead[chunk]
+        self._wait_readahead(chunk, future)
+
+    for chunk in self._readahead_chunks(end):
+      self._readahead[chunk] = self._download_pool().submit(self._readahead_chunk, chunk)
 
   def read(self, ll=None):
-    if self._force_download:
+    if self._force_download and (self._parallel == 1 or (ll is not None and ll <= CHUNK_SIZE)):
       return self.read_aux(ll=ll)
 
-    file_begin = self._pos
-    file_end = self._pos + ll if ll is not None else self.get_length()
-    #  We have to align with chunks we store. Position is the begginiing of the latest chunk that starts before or at our file
-    position = (file_begin // CHUNK_SIZE) * CHUNK_SIZE
-    response = b""
-    while True:
-      self._pos = position
-      chunk_number = self._pos / CHUNK_SIZE
-      file_name = hash_256(self._url) + "_" + str(chunk_number)
-      full_path = os.path.join(CACHE_DIR, str(file_name))
-      data = None
-      #  If we don't have a file, download it
-      if not os.path.exists(full_path):
-        data = self.read_aux(ll=CHUNK_SIZE)
-        with atomic_write_in_dir(full_path, mode="wb") as new_cached_file:
-          new_cached_file.write(data)
-      else:
-        with open(full_path, "rb") as cached_file:
-          data = cached_file.read()
+    file_begin, file_end = self._read_range(ll, self.get_length())
+    if file_begin >= file_end:
+      return b""
+
+    if self._force_download:
+      ranges = self._chunk_ranges(file_begin, file_end)
+      response = b"".join(self._map_parallel(lambda r: self._download_range(*r), ranges))
+      self._pos = file_end
+      return response
+
+    first_chunk, aligned_begin, aligned_end = self._aligned(file_begin, file_end, self.get_length())
+    buf = self._read_chunks(first_chunk, aligned_end - aligned_begin)
+    response, sequential = self._finish_read(buf, file_begin, file_end, aligned_begin)
 
-      response += data[max(0, file_begin - position): min(CHUNK_SIZE, file_end - position)]
+    #  Sequential reads download the next chunks in the background
+    if READAHEAD_CHUNKS > 0 and sequential:
+      self._schedule_readahead(file_end)
+    return response
 
-      position += CHUNK_SIZE
-      if position >= file_end:
-        self._pos = file_end
-        return response
+  @retry(wait=wait_random_exponential(multiplier=1, max=5), stop=stop_after_attempt(3), reraise=True)
+  def _download_range(self, start, end):
+    #  Downloads [start, end), safe to call from any thread
+    if start >= end:
+      return b""
+    headers = ["Connection: keep-alive", f"Range: bytes={start}-{end - 1}"]
+    return self._perform(headers, download_range=True)
 
   @retry(wait=wait_random_exponential(multiplier=1, max=5), stop=stop_after_attempt(3), reraise=True)
   def read_aux(self, ll=None):
@@ -126,8 +540,14 @@ class URLFile:
       headers.append(f"Range: bytes={self._pos}-{end}")
       download_range = True
 
+    ret = self._perform(headers, download_range)
+    self._pos += len(ret)
+    return ret
+
+  def _perform(self, headers, download_range):
     dats = BytesIO()
-    c = self._curl
+    c = self._thread_curl()
+    c.reset()
     c.setopt(pycurl.URL, self._url)
     c.setopt(pycurl.WRITEDATA, dats)
     c.setopt(pycurl.NOSIGNAL, 1)
@@ -158,20 +578,8 @@ class URLFile:
       if t2 - t1 > 0.1:
         print(f"get {self._url} {headers!r} {t2 - t1:.f} slow")
 
-    response_code = c.getinfo(pycurl.RESPONSE_CODE)
-    if response_code == 416:  # Requested Range Not Satisfiable
-      raise Exception(f"Error, range out of bounds {response_code} {headers} ({self._url}): {repr(dats.getvalue())[:500]}")
-    if download_range and response_code != 206:  # Partial Content
-      raise Exception(f"Error, requested range but got unexpected response {response_code} {headers} ({self._url}): {repr(dats.getvalue())[:500]}")
-    if (not download_range) and response_code != 200:  # OK
-      raise Exception(f"Error {response_code} {headers} ({self._url}): {repr(dats.getvalue())[:500]}")
-
-    ret = dats.getvalue()
-    self._pos += len(ret)
-    return ret
-
-  def seek(self, pos):
-    self._pos = pos
+    check_response(c.getinfo(pycurl.RESPONSE_CODE), headers, self._url, dats.getvalue(), download_range)
+    return dats.getvalue()
 
   @property
   def name(self):
@@ -196,3 +604,30 @@ class URLFile:
       self.seek = self._local_file.seek
 
     return self._local_file.name
+
+
+os.register_at_fork(after_in_child=URLFile._after_fork)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Inspect and prune the URLFile download cache")
+  subparsers = parser.add_subparsers(dest="cmd", required=True)
+  subparsers.add_parser("info", help="Show the size of the cache")
+  prune = subparsers.add_parser("prune", help="Evict least recently used files")
+  prune.add_argument("--size", type=int, default=CACHE_SIZE, help="Size in bytes to prune the cache down to")
+  subparsers.add_parser("verify", help="Delete chunks that fail their checksum")
+  args = parser.parse_args()
+
+  if args.cmd == "info":
+    entries = cache_entries()
+    total = sum(size for _, size, _ in entries)
+    urls = cache_urls()
+    print(f"{CACHE_DIR}: {len(entries)} files from {len(urls)} urls, {total / 1e9:.2f} GB of {CACHE_SIZE / 1e9:.2f} GB")
+    if len(entries):
+      print(f"least recently used: {time.ctime(min(entries)[0])}")
+  elif args.cmd == "prune":
+    removed, removed_size = prune_cache(args.size)
+    print(f"removed {removed} files, {removed_size / 1e9:.2f} GB")
+  elif args.cmd == "verify":
+    print(f"removed {verify_cache()} corrupt chunks")
+  sys.exit(0)